@@ -1,44 +1,341 @@
+import time
+STARTED_AT: float = time.perf_counter() # taken before any other import so startup time can be reported
+
+import os
 import sys
 import getopt
 import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-from utils.helper_utils import format_json_input, BehaviorTransitionData
+from utils.helper_utils import format_json_input, validate_config, BehaviorTransitionData
 from utils import constants as const
+from utils import manifest_utils
+from utils import shard_utils
+from utils.pipeline_utils import PipelineJob, run_job_sequentially, run_pipeline, build_job, render_job
+from utils.watch_utils import PollingWatcher, IncrementalFolderCounts
+
+
+# Script usage: python3 main.py [--force] [--dry-run] [--pipeline] [--watch] [--no-render] [--shard <i/N>] [--manifest <ManifestFilePath>] <ConfigFilePath>
+#               python3 main.py --verify [--no-render] [--shard <i/N>] <ConfigFilePath>
+#               python3 main.py merge [--manifest <ManifestFilePath>] <ConfigFilePath>
+#               python3 main.py serve [--port <Port>] <ConfigFilePath>
+#               python3 main.py validate <ConfigFilePath>
+#   --force     rebuild every job, even the ones the run manifest says are up to date
+#   --dry-run   only list the jobs that would be rebuilt (and why) without running them
+#   --pipeline  run the jobs through the staged pipeline so reading, formatting and rendering of different jobs overlap
+#   --watch     after the run, keep watching the input folders and the config file and rebuild the affected jobs on changes
+#   --no-render compute-only: write the data files (CSVs unless output_format says otherwise) without building or rendering graphs
+#   --shard     only run shard i of N (1-based), for splitting one config across several machines
+#   --manifest  where the run manifest is kept (defaults to <ConfigFilePath> with a .manifest.json extension)
+#   --verify    check that the optimized paths give the same counts, probabilities and graph sources as the legacy
+#               format_data path on every selected job's input folder and on randomized scorelogs, instead of running the jobs
+#               (see verify_utils). With --no-render the graph sources are not compared
+#   merge       combine the manifests written by every shard into the config's run manifest
+#   serve       answer matrix and graph queries for the config's input folders over HTTP on localhost (see server_utils)
+#   validate    check the config for problems without running any jobs
+USAGE: str = '''Usage: python3 main.py [--force] [--dry-run] [--pipeline] [--watch] [--no-render] [--shard <i/N>] [--manifest <ManifestFilePath>] <ConfigFilePath>
+       python3 main.py --verify [--no-render] [--shard <i/N>] <ConfigFilePath>
+       python3 main.py merge [--manifest <ManifestFilePath>] <ConfigFilePath>
+       python3 main.py serve [--port <Port>] <ConfigFilePath>
+       python3 main.py validate <ConfigFilePath>'''
 
+# pandas, numpy and graphviz are imported lazily (see import_utils), so commands that don't touch any data
+# (--help, validate) must finish within this budget. validate reports a warning when it doesn't
+STARTUP_BUDGET_SECONDS: float = 0.25
+HEAVY_MODULES: list[str] = ['pandas', 'numpy', 'graphviz', 'pyarrow']
 
-# Script usage: python3 main.py <ConfigFilePath>
 def main():
     try:
-        argv = sys.argv[1:]
-        if len(argv) != 1:
-            raise Exception()
+        opts, argv = getopt.gnu_getopt(sys.argv[1:], 'hfnpws:m:', ['help', 'force', 'dry-run', 'pipeline', 'watch', 'no-render', 'verify', 'shard=', 'manifest=', 'port='])
+        options = dict(opts)
+        if '--help' in options or '-h' in options:
+            print(USAGE)
+            return
+        is_merge = len(argv) == 2 and argv[0] == 'merge'
+        is_serve = len(argv) == 2 and argv[0] == 'serve'
+        is_validate = len(argv) == 2 and argv[0] == 'validate'
+        if len(argv) != 1 and not is_merge and not is_serve and not is_validate:
+            raise Exception(USAGE)
+        config_path = argv[-1]
+        if is_validate:
+            validate(config_path)
+            return
+        force = '--force' in options or '-f' in options
+        dry_run = '--dry-run' in options or '-n' in options
+        use_pipeline = '--pipeline' in options or '-p' in options
+        watch = '--watch' in options or '-w' in options
+        render = '--no-render' not in options
+        shard = options.get('--shard') or options.get('-s')
+        manifest_path = options.get('--manifest') or options.get('-m') or manifest_utils.default_manifest_path(config_path)
 
-        config = dict()
-        with open(argv[0]) as file:
-            config = json.load(file)
-            config = format_json_input(config)
+        config = load_config(config_path)
+        jobs = config[const.JOBS]
+        if is_merge:
+            merge_shards(jobs, manifest_path)
+            return
+        if is_serve:
+            from utils import server_utils # http.server is only imported when serving
+            server_utils.serve(
+                jobs,
+                port=int(options.get('--port') or config.get(const.SERVE_PORT) or server_utils.DEFAULT_PORT),
+                render_workers=config.get(const.SERVE_RENDER_WORKERS),
+                cache_size=config.get(const.SERVE_CACHE_SIZE) or server_utils.DEFAULT_CACHE_SIZE
+            )
+            return
+        if '--verify' in options:
+            verify_jobs(jobs, select_jobs(jobs, shard), render)
+            return
 
-        print('Job processing has started')
-        jobs = config.get(const.JOBS)
+        selected_jobs = set(range(len(jobs)))
+        manifest = manifest_utils.load_manifest(manifest_path)
+        if shard is not None:
+            shard_idx, shard_count = shard_utils.parse_shard(shard)
+            selected_jobs = select_jobs(jobs, shard)
+            print(f'Running shard {shard_idx} of {shard_count} ({len(selected_jobs)} of {len(jobs)} job(s))')
+            # Results already merged into the main manifest count as up to date too
+            manifest_path = shard_utils.shard_manifest_path(manifest_path, shard_idx, shard_count)
+            manifest['jobs'].update(manifest_utils.load_manifest(manifest_path)['jobs'])
+        version = manifest_utils.code_version()
+        updated_entries = {}
+        pending: list[tuple[int, dict]] = []
+        job_keys: dict[int, str] = {}
+        fingerprints: dict[int, str] = {}
+        up_to_date_count = 0
+        failed_count = 0
+
+        print('Job processing has started' if not dry_run else 'Dry run: listing jobs that would be rebuilt')
         for idx, job in enumerate(jobs):
-            job_title = job.get(const.JOB_TITLE) or None
-            input_folder = job.get(const.INPUT_FOLDER)
-            output_folder = job.get(const.OUTPUT_FOLDER)
-            subject = job.get(const.SUBJECT)
-            env = job.get(const.ENV)
-            color_map = job.get(const.COLOR_MAP)
-            group_by = job.get(const.GROUP_BY)
-            attach_legend = job.get(const.ATTACH_LEGEND) or False
-
-            print('Now processing job #{}: {}'.format(idx + 1, job_title))
-            data = BehaviorTransitionData(input_folder, output_folder, subject, env, color_map, group_by)
-            data.create_markov_chain_graph(attach_legend)
-
-        print(f'All {len(jobs)} job(s) have been processed. Check specified output folder for results.')
+            if idx not in selected_jobs:
+                continue
+            job_title = job.get(const.JOB_NAME) or None
+            key = manifest_utils.job_key(job)
+            try:
+                fingerprint = manifest_utils.job_input_fingerprint(job)
+            except Exception as e:
+                failed_count += 1
+                print('Job #{}: {} failed ({})'.format(idx + 1, job_title, e))
+                continue
+            entry = manifest['jobs'].get(key)
+            reason = 'forced' if force else manifest_utils.rebuild_reason(entry, fingerprint, version, render)
+
+            if reason is None:
+                print('Skipping job #{}: {} (up to date)'.format(idx + 1, job_title))
+                updated_entries[key] = entry
+                up_to_date_count += 1
+                continue
+            if dry_run:
+                print('Would rebuild job #{}: {} ({})'.format(idx + 1, job_title, reason))
+                continue
+
+            print('Queued job #{}: {} ({})'.format(idx + 1, job_title, reason) if use_pipeline else 'Now processing job #{}: {} ({})'.format(idx + 1, job_title, reason))
+            pending.append((idx, job))
+            job_keys[idx] = key
+            fingerprints[idx] = fingerprint
+            if not use_pipeline:
+                finished = run_job_sequentially(PipelineJob(idx, job, render))
+                if finished.error is not None:
+                    failed_count += 1
+                    print('Job #{}: {} failed ({})'.format(idx + 1, job_title, finished.error))
+                    continue
+                updated_entries[key] = manifest_utils.make_manifest_entry(job, fingerprint, version, finished.output_files, render)
+                # saved after every job so an interrupted run keeps the progress it made
+                manifest_utils.save_manifest(manifest_path, { 'code_version': version, 'jobs': { **manifest['jobs'], **updated_entries } })
+
+        if dry_run:
+            print(f'{len(selected_jobs) - len(updated_entries)} of {len(selected_jobs)} job(s) would be rebuilt.')
+            return
+
+        if use_pipeline and len(pending):
+            for finished in run_pipeline(
+                pending,
+                ingest_workers=config.get(const.PIPELINE_INGEST_WORKERS) or 4,
+                format_workers=config.get(const.PIPELINE_FORMAT_WORKERS),
+                build_workers=config.get(const.PIPELINE_BUILD_WORKERS) or 1,
+                render_workers=config.get(const.PIPELINE_RENDER_WORKERS),
+                queue_size=config.get(const.PIPELINE_QUEUE_SIZE) or 2,
+                render=render
+            ):
+                job_title = finished.job.get(const.JOB_NAME) or None
+                if finished.error is not None:
+                    failed_count += 1
+                    print('Job #{}: {} failed ({})'.format(finished.idx + 1, job_title, finished.error))
+                    continue
+                print('Finished job #{}: {}'.format(finished.idx + 1, job_title))
+                updated_entries[job_keys[finished.idx]] = manifest_utils.make_manifest_entry(finished.job, fingerprints[finished.idx], version, finished.output_files, render)
+                manifest_utils.save_manifest(manifest_path, { 'code_version': version, 'jobs': { **manifest['jobs'], **updated_entries } })
+
+        # Only the jobs of the current config (or shard) are kept in the manifest
+        manifest_utils.save_manifest(manifest_path, { 'code_version': version, 'jobs': updated_entries })
+        print(f'All {len(selected_jobs)} job(s) have been processed ({up_to_date_count} up to date{f", {failed_count} failed" if failed_count else ""}). Check specified output folder for results.')
+
+        if watch:
+            watch_jobs(config_path, manifest_path, shard, render)
     except Exception as e:
         print(e)
 
 
+def validate(config_path: str):
+    with open(config_path) as file:
+        try:
+            problems = validate_config(json.load(file))
+        except json.JSONDecodeError as e:
+            problems = [f'not valid JSON ({e})']
+    for problem in problems:
+        print(f'Problem: {problem}')
+    elapsed = time.perf_counter() - STARTED_AT
+    print(f'{config_path} is {"valid" if len(problems) == 0 else "invalid"} (checked in {elapsed * 1000:.0f} ms)')
+    if elapsed > STARTUP_BUDGET_SECONDS:
+        loaded = ', '.join(name for name in HEAVY_MODULES if name in sys.modules) or 'no heavy modules'
+        print(f'Warning: validating took longer than the {STARTUP_BUDGET_SECONDS * 1000:.0f} ms startup budget ({loaded} imported)')
+    if len(problems):
+        sys.exit(1)
+
+
+# Seeds of the randomized scorelogs checked by --verify, next to the jobs' own input folders
+VERIFY_SEEDS: list[int] = [0, 1, 2]
+
+def verify_jobs(jobs: list[dict], selected_jobs: set[int], render: bool = True):
+    from utils import verify_utils # only needed when verifying
+
+    checked_folders = set()
+    problems = []
+    # The shared memory counting is checked through a worker process, like the pipeline's format stage runs it
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for idx in sorted(selected_jobs):
+            job = jobs[idx]
+            folder_key = (os.path.abspath(job[const.INPUT_FOLDER]), job[const.GROUP_BY], job.get(const.FPS))
+            if folder_key in checked_folders:
+                continue
+            checked_folders.add(folder_key)
+            print('Verifying job #{}: {}'.format(idx + 1, job.get(const.JOB_NAME) or None))
+            problems += verify_utils.verify_folder(
+                job[const.INPUT_FOLDER],
+                job[const.GROUP_BY],
+                job.get(const.FPS),
+                executor=executor,
+                graphs=render,
+                color_map=dict(job[const.COLOR_MAP])
+            )
+        print(f'Verifying randomized scorelogs (seeds {", ".join(str(seed) for seed in VERIFY_SEEDS)})')
+        problems += verify_utils.verify_random(VERIFY_SEEDS, executor=executor, graphs=render)
+
+    for problem in problems:
+        print(f'Divergence: {problem}')
+    print(f'Verified {len(checked_folders)} input folder(s) and {len(VERIFY_SEEDS)} randomized scorelog set(s): '
+        + ('the optimized and legacy paths match' if len(problems) == 0 else f'{len(problems)} divergence(s) found'))
+    if len(problems):
+        sys.exit(1)
+
+
+def load_config(config_path: str) -> dict:
+    with open(config_path) as file:
+        return format_json_input(json.load(file))
+
+
+# Indices of the jobs this run is responsible for (all of them, or those of the given 'i/N' shard)
+def select_jobs(jobs: list[dict], shard: str | None) -> set[int]:
+    if shard is None:
+        return set(range(len(jobs)))
+    shard_idx, shard_count = shard_utils.parse_shard(shard)
+    return set(shard_utils.jobs_for_shard(jobs, shard_idx, shard_count))
+
+
+# Watches every selected job's input folder and the config file until interrupted with Ctrl+C
+# - a changed input folder only has its new or changed files re-read and re-counted, then the jobs using it are rebuilt
+# - a changed config rebuilds the jobs whose settings changed (or that are new)
+def watch_jobs(config_path: str, manifest_path: str, shard: str | None, render: bool = True):
+    jobs = load_config(config_path)[const.JOBS]
+    selected_jobs = select_jobs(jobs, shard)
+    folder_counts: dict[tuple, IncrementalFolderCounts] = {}
+
+    def counts_key(job: dict) -> tuple:
+        return (os.path.abspath(job[const.INPUT_FOLDER]), job[const.GROUP_BY], job.get(const.FPS))
+
+    def watched_paths() -> list[str]:
+        return [config_path] + sorted({ counts_key(jobs[idx])[0] for idx in selected_jobs })
+
+    # The current per-file counts of every folder are read once up front so later changes only touch the changed files
+    for idx in selected_jobs:
+        key = counts_key(jobs[idx])
+        if key not in folder_counts:
+            folder_counts[key] = IncrementalFolderCounts(*key)
+            try:
+                folder_counts[key].update()
+            except Exception as e:
+                print(f'Could not read {key[0]} ({e})')
+
+    watcher = PollingWatcher(watched_paths())
+    print(f'Watching {len(watcher.snapshots) - 1} input folder(s) and {config_path} for changes. Press Ctrl+C to stop.')
+    try:
+        while True:
+            changed = watcher.wait_for_changes()
+            affected: set[int] = set()
+            if config_path in changed:
+                try:
+                    new_jobs = load_config(config_path)[const.JOBS]
+                    new_selected_jobs = select_jobs(new_jobs, shard)
+                except Exception as e:
+                    print(f'Could not reload {config_path}, keeping the previous config ({e})')
+                else:
+                    previous_keys = { manifest_utils.job_key(jobs[idx]) for idx in selected_jobs }
+                    jobs, selected_jobs = new_jobs, new_selected_jobs
+                    affected |= { idx for idx in selected_jobs if manifest_utils.job_key(jobs[idx]) not in previous_keys }
+                    watcher.set_paths(watched_paths())
+                    in_use = { counts_key(jobs[idx]) for idx in selected_jobs }
+                    folder_counts = { key: counts for key, counts in folder_counts.items() if key in in_use }
+            affected |= { idx for idx in selected_jobs if counts_key(jobs[idx])[0] in changed }
+            if len(affected):
+                rebuild_watched_jobs(jobs, sorted(affected), folder_counts, counts_key, manifest_path, render)
+    except KeyboardInterrupt:
+        print('Stopped watching.')
+
+
+def rebuild_watched_jobs(jobs: list[dict], job_indices: list[int], folder_counts: dict[tuple, IncrementalFolderCounts], counts_key, manifest_path: str, render: bool = True):
+    manifest = manifest_utils.load_manifest(manifest_path)
+    version = manifest_utils.code_version()
+    updates: dict[tuple, tuple] = {}
+    for idx in job_indices:
+        job = jobs[idx]
+        job_title = job.get(const.JOB_NAME) or None
+        try:
+            # Each folder is brought up to date once, even when several jobs use it
+            key = counts_key(job)
+            if key not in folder_counts:
+                folder_counts[key] = IncrementalFolderCounts(*key)
+            if key not in updates:
+                updates[key] = folder_counts[key].update()
+            transition_df, behavior_df, recounted = updates[key]
+
+            work = PipelineJob(idx, job, render)
+            work.formatted_data = (transition_df, behavior_df)
+            work.ingest_errors = dict(folder_counts[key].errors)
+            build_job(work)
+            render_job(work)
+            manifest['jobs'][manifest_utils.job_key(job)] = manifest_utils.make_manifest_entry(job, manifest_utils.job_input_fingerprint(job), version, work.output_files, render)
+            print('Rebuilt job #{}: {} ({} file(s) re-read)'.format(idx + 1, job_title, len(recounted)))
+        except Exception as e:
+            print('Job #{}: {} failed ({})'.format(idx + 1, job_title, e))
+    manifest['code_version'] = version
+    manifest_utils.save_manifest(manifest_path, manifest)
+
+
+def merge_shards(jobs: list[dict], manifest_path: str):
+    shard_manifests = shard_utils.find_shard_manifests(manifest_path)
+    if len(shard_manifests) == 0:
+        raise Exception(f'No shard manifests were found next to {manifest_path}')
+
+    # Jobs that no shard had to rebuild are still covered by the existing main manifest
+    existing = manifest_utils.load_manifest(manifest_path)
+    expected_keys = [manifest_utils.job_key(job) for job in jobs]
+    merged, problems = shard_utils.merge_manifests(shard_manifests, expected_keys, existing['jobs'])
+
+    manifest_utils.save_manifest(manifest_path, merged)
+    print(f'Merged {len(shard_manifests)} shard manifest(s) covering {len(merged["jobs"])} of {len(jobs)} job(s) into {manifest_path}')
+    for problem in problems:
+        print(f'Warning: {problem}')
+
+
 def main_alt():
     input = 'some/input/folder'
     output = 'some/output/folder'
@@ -102,4 +399,4 @@ def main_alt():
 
 
 if __name__ == '__main__':
-    main_alt()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,72 @@
+import math
+
+import numpy as np
+import pytest
+
+from utils import constants as const
+from utils.distance_utils import pairwise_distances, dendrogram_order
+
+IDENTITY = [[1, 0], [0, 1]]
+SWAPPED = [[0, 1], [1, 0]]
+FIRST_ROW_ONLY = [[1, 0], [0, 0]]
+
+
+def test_frobenius():
+    # Every entry of the identity and the swapped matrix differs by 1, so the distance is sqrt(4)
+    distances = pairwise_distances(np.array([IDENTITY, SWAPPED, IDENTITY]), const.FROBENIUS)
+    assert distances == pytest.approx(np.array([[0, 2, 0], [2, 0, 2], [0, 2, 0]]))
+
+
+def test_frobenius_uses_probabilities():
+    distances = pairwise_distances(np.array([[[1, 1], [0, 2]], [[5, 5], [0, 7]]]), const.FROBENIUS)
+    assert distances[0, 1] == pytest.approx(0)
+
+
+def test_jensen_shannon():
+    # Disjoint rows are 1 bit apart. A row with transitions in only one of the matrices counts as 1 too, and is averaged
+    # with the matching first row
+    distances = pairwise_distances(np.array([IDENTITY, SWAPPED, FIRST_ROW_ONLY]), const.JENSEN_SHANNON)
+    assert distances == pytest.approx(np.array([[0, 1, 0.5], [1, 0, 1], [0.5, 1, 0]]))
+
+
+def test_jensen_shannon_of_overlapping_rows():
+    # JS([1, 0], [0.5, 0.5]) = H([0.75, 0.25]) - (0 + 1) / 2
+    distances = pairwise_distances(np.array([[[1, 0], [0, 0]], [[1, 1], [0, 0]]]), const.JENSEN_SHANNON)
+    expected = -(0.75 * math.log2(0.75) + 0.25 * math.log2(0.25)) - 0.5
+    assert distances[0, 1] == pytest.approx(expected)
+
+
+def test_jensen_shannon_blocks_match():
+    counts = np.random.default_rng(0).integers(0, 5, size=(7, 4, 4))
+    unblocked = pairwise_distances(counts, const.JENSEN_SHANNON)
+    assert pairwise_distances(counts, const.JENSEN_SHANNON, chunk_bytes=1) == pytest.approx(unblocked)
+
+
+def test_kl():
+    # P_b is smoothed to [0.9995, 0.0005] rows, so KL(identity || identity) is -log2(0.9995) per row
+    distances = pairwise_distances(np.array([IDENTITY, IDENTITY, SWAPPED]), const.KL)
+    assert distances[0, 1] == pytest.approx(-math.log2(0.9995))
+    assert distances[0, 2] == pytest.approx(-math.log2(0.0005))
+    assert np.diag(distances) == pytest.approx(np.zeros(3))
+
+
+def test_unknown_metric():
+    with pytest.raises(Exception, match='Unknown distance metric'):
+        pairwise_distances(np.array([IDENTITY]), 'NOT_A_METRIC')
+
+
+def test_dendrogram_order():
+    # 0 and 1 merge first, then cluster 3 joins 2 at the average of their distances to it ((4 + 5) / 2)
+    distances = np.array([[0, 1, 4], [1, 0, 5], [4, 5, 0]], dtype=np.float64)
+    order, merges = dendrogram_order(distances)
+    assert order == [0, 1, 2]
+    assert merges == [(0, 1, 1.0, 2), (3, 2, 4.5, 3)]
+
+
+def test_dendrogram_order_of_asymmetric_distances():
+    distances = np.array([[0, 2], [4, 0]], dtype=np.float64)
+    assert dendrogram_order(distances) == ([0, 1], [(0, 1, 3.0, 2)])
+
+
+def test_dendrogram_order_of_nothing():
+    assert dendrogram_order(np.zeros((0, 0))) == ([], [])
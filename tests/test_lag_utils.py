@@ -0,0 +1,73 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import constants as const
+from utils.lag_utils import lag_sequential_table, lag_statistics
+
+
+# A scorelog with one event per second
+def scorelog(behaviors: list[str]) -> pd.DataFrame:
+    return pd.DataFrame({ 'Behavior': behaviors, 'Time': np.arange(1, len(behaviors) + 1, dtype=np.float64) })
+
+
+# (lag, behavior, next behavior) -> OBSERVED
+def observed_counts(lag_df: pd.DataFrame) -> dict[tuple[int, str, str], int]:
+    rows = zip(lag_df['LAG'], lag_df[const.BEHAVIOR], lag_df[const.BEHAVIOR_NEXT], lag_df['OBSERVED'])
+    return { (int(lag), str(behavior), str(next_behavior)): int(observed) for lag, behavior, next_behavior, observed in rows }
+
+
+def test_counts_every_lag():
+    lag_df = lag_sequential_table({ 'log': scorelog(['A', 'B', 'A', 'B']) }, 2)
+    assert observed_counts(lag_df) == {
+        (1, 'A', 'A'): 0, (1, 'A', 'B'): 2, (1, 'B', 'A'): 1, (1, 'B', 'B'): 0,
+        (2, 'A', 'A'): 1, (2, 'A', 'B'): 0, (2, 'B', 'A'): 0, (2, 'B', 'B'): 1,
+    }
+
+
+def test_pairs_stay_within_a_scorelog():
+    lag_df = lag_sequential_table({ 'first': scorelog(['A', 'B']), 'second': scorelog(['B', 'A']) }, 2)
+    assert observed_counts(lag_df) == { (1, 'A', 'A'): 0, (1, 'A', 'B'): 1, (1, 'B', 'A'): 1, (1, 'B', 'B'): 0 }
+
+
+def test_out_of_view_is_dropped_before_lagging():
+    lag_df = lag_sequential_table({ 'log': scorelog(['A', 'Out of view', 'B']) }, 1)
+    assert observed_counts(lag_df) == { (1, 'A', 'A'): 0, (1, 'A', 'B'): 1 }
+
+
+def test_adjusted_residuals():
+    # x_A+ = 30, x_+A = 40, x_++ = 100, so e_AA = 12 and its variance is 12 * (1 - 0.3) * (1 - 0.4)
+    observed = np.array([[10, 20], [30, 40]]).reshape(1, 2, 2, 1)
+    expected, z_scores = lag_statistics(observed, np.array([[40], [60]]), const.ADJUSTED_RESIDUAL)
+    assert expected[0, :, :, 0] == pytest.approx(np.array([[12, 18], [28, 42]]))
+    assert z_scores[0, 0, 0, 0] == pytest.approx(-2 / math.sqrt(12 * 0.7 * 0.6))
+
+
+def test_allison_liker_z_scores():
+    # p_A = 0.4 and p_B = 0.6, so e_AB = x_A+ * p_B = 18 and its variance is 18 * (1 - 0.6) * (1 - 0.4)
+    observed = np.array([[10, 20], [30, 40]]).reshape(1, 2, 2, 1)
+    expected, z_scores = lag_statistics(observed, np.array([[40], [60]]), const.ALLISON_LIKER)
+    assert expected[0, 0, 1, 0] == pytest.approx(18)
+    assert z_scores[0, 0, 1, 0] == pytest.approx(2 / math.sqrt(18 * 0.4 * 0.6))
+
+
+def test_undefined_z_scores_are_nan():
+    observed = np.array([[0, 5], [0, 0]]).reshape(1, 2, 2, 1)
+    _, z_scores = lag_statistics(observed, np.array([[5], [5]]), const.ADJUSTED_RESIDUAL)
+    assert np.isnan(z_scores[0, 1, 0, 0])
+
+
+def test_significance():
+    # 50 A -> B then 50 B -> A steps make A -> A and B -> B far rarer than chance
+    lag_df = lag_sequential_table({ 'log': scorelog(['A', 'B'] * 50) }, 1)
+    significant = { (row[const.BEHAVIOR], row[const.BEHAVIOR_NEXT]): row['SIGNIFICANT'] for _, row in lag_df.iterrows() }
+    assert significant == { ('A', 'A'): -1, ('A', 'B'): 1, ('B', 'A'): 1, ('B', 'B'): -1 }
+
+
+def test_invalid_arguments():
+    with pytest.raises(Exception, match='at least 1'):
+        lag_sequential_table({ 'log': scorelog(['A', 'B']) }, 0)
+    with pytest.raises(Exception, match='Unknown lag statistic'):
+        lag_statistics(np.zeros((1, 1, 1, 1)), np.zeros((1, 1)), 'NOT_A_STATISTIC')
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from utils import constants as const
+from utils.manifest_utils import make_manifest_entry, rebuild_reason
+
+FINGERPRINT = 'inputs-v1'
+VERSION = 'code-v1'
+
+
+@pytest.fixture
+def output_file(tmp_path) -> str:
+    path = tmp_path / 'BASIC' / 'BlueFish_BlueEnv.svg'
+    path.parent.mkdir()
+    path.write_text('<svg/>')
+    return str(path)
+
+
+@pytest.fixture
+def entry(output_file) -> dict:
+    return make_manifest_entry({ const.JOB_NAME: 'Blue' }, FINGERPRINT, VERSION, [output_file])
+
+
+def test_up_to_date(entry):
+    assert rebuild_reason(entry, FINGERPRINT, VERSION) is None
+
+
+def test_new_job():
+    assert rebuild_reason(None, FINGERPRINT, VERSION) == 'new or changed job config'
+
+
+def test_changed_inputs(entry):
+    assert rebuild_reason(entry, 'inputs-v2', VERSION) == 'input files changed'
+
+
+def test_changed_code(entry):
+    assert rebuild_reason(entry, FINGERPRINT, 'code-v2') == 'code changed'
+
+
+def test_render_mode_changed(output_file):
+    compute_only = make_manifest_entry({}, FINGERPRINT, VERSION, [output_file], rendered=False)
+    assert rebuild_reason(compute_only, FINGERPRINT, VERSION) == 'graphs not rendered yet'
+    assert rebuild_reason(compute_only, FINGERPRINT, VERSION, render=False) is None
+    rendered = make_manifest_entry({}, FINGERPRINT, VERSION, [output_file])
+    assert rebuild_reason(rendered, FINGERPRINT, VERSION, render=False) == 'previous run rendered graphs'
+
+
+def test_entries_without_rendered_count_as_rendered(entry):
+    del entry['rendered']
+    assert rebuild_reason(entry, FINGERPRINT, VERSION) is None
+
+
+def test_no_outputs(tmp_path):
+    entry = make_manifest_entry({}, FINGERPRINT, VERSION, [str(tmp_path / 'never_written.svg')])
+    assert rebuild_reason(entry, FINGERPRINT, VERSION) == 'no outputs recorded'
+
+
+def test_missing_output(entry, output_file):
+    os.remove(output_file)
+    assert rebuild_reason(entry, FINGERPRINT, VERSION) == f'output missing: {output_file}'
+
+
+def test_modified_output(entry, output_file):
+    with open(output_file, 'w') as file:
+        file.write('<svg>edited</svg>')
+    assert rebuild_reason(entry, FINGERPRINT, VERSION) == f'output modified: {output_file}'
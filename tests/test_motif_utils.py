@@ -0,0 +1,67 @@
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.motif_utils import mine_motifs
+
+
+def scorelog(behaviors: list[str]) -> pd.DataFrame:
+    return pd.DataFrame({ 'Behavior': behaviors, 'Time': np.arange(1, len(behaviors) + 1, dtype=np.float64) })
+
+
+# Motif -> support of every run of `length` behaviors, counted run by run
+def brute_force_support(scorelogs: dict[str, list[str]], length: int) -> Counter:
+    runs = Counter()
+    for behaviors in scorelogs.values():
+        runs.update(' > '.join(behaviors[start:start + length]) for start in range(len(behaviors) - length + 1))
+    return runs
+
+
+def test_ranked_motifs():
+    motif_df = mine_motifs({ 'log': scorelog(['A', 'B', 'C', 'A', 'B', 'C']) }, (2, 3))
+    assert motif_df[['LENGTH', 'RANK', 'MOTIF', 'SUPPORT', 'FILE_COUNT', 'FILES']].values.tolist() == [
+        [2, 1, 'A > B', 2, 1, 'log'],
+        [2, 2, 'B > C', 2, 1, 'log'],
+        [3, 1, 'A > B > C', 2, 1, 'log'],
+    ]
+
+
+def test_runs_stay_within_a_scorelog():
+    motif_df = mine_motifs({ 'first': scorelog(['A', 'B']), 'second': scorelog(['A', 'B']) }, (2, 2))
+    assert motif_df[['MOTIF', 'SUPPORT', 'FILE_COUNT', 'FILES']].values.tolist() == [['A > B', 2, 2, 'first;second']]
+
+
+def test_more_files_rank_first_on_ties():
+    motif_df = mine_motifs({ 'first': scorelog(['A', 'A', 'A', 'B', 'B']), 'second': scorelog(['B', 'B']) }, (2, 2))
+    assert motif_df['MOTIF'].tolist() == ['B > B', 'A > A']
+
+
+def test_top_and_min_support():
+    scorelogs = { 'log': scorelog(['A', 'B', 'A', 'B', 'A', 'C', 'A']) }
+    assert mine_motifs(scorelogs, (2, 2), top=1)['MOTIF'].tolist() == ['A > B']
+    assert mine_motifs(scorelogs, (2, 2), min_support=3)['MOTIF'].tolist() == []
+    assert len(mine_motifs(scorelogs, (2, 2), min_support=1)) == 4
+
+
+def test_out_of_view_is_dropped():
+    motif_df = mine_motifs({ 'log': scorelog(['A', 'Out of view', 'B', 'A', 'B']) }, (2, 2))
+    assert motif_df[['MOTIF', 'SUPPORT']].values.tolist() == [['A > B', 2]]
+
+
+def test_overflowing_keys_fall_back_to_rows():
+    # With 10 behaviors, keys of 19 behaviors would reach 10^19 > 2^63, so lengths 17 and 18 are counted as packed keys
+    # and length 19 as rows. Both have to agree with counting the runs one by one
+    behaviors = [f'B{idx}' for idx in range(10)] * 4 + ['B0', 'B5']
+    motif_df = mine_motifs({ 'log': scorelog(behaviors) }, (17, 19), top=100)
+    for length in [17, 18, 19]:
+        expected = { motif: support for motif, support in brute_force_support({ 'log': behaviors }, length).items() if support >= 2 }
+        rows = motif_df[motif_df['LENGTH'] == length]
+        assert dict(zip(rows['MOTIF'], rows['SUPPORT'])) == expected
+    assert motif_df[motif_df['LENGTH'] == 19]['MOTIF'].iloc[0] == ' > '.join(f'B{idx % 10}' for idx in range(19))
+
+
+def test_invalid_lengths():
+    with pytest.raises(Exception, match='Invalid motif lengths'):
+        mine_motifs({ 'log': scorelog(['A', 'B']) }, (3, 2))
@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import constants as const
+from utils.passage_utils import transition_matrices, mean_first_passage_times, absorption_probabilities
+
+
+def test_transition_matrices_are_row_stochastic():
+    transition_df = pd.DataFrame({
+        const.BEHAVIOR: ['A', 'A', 'B'],
+        const.BEHAVIOR_NEXT: ['A', 'B', 'A'],
+        'TRANSITION_COUNTS': [1, 3, 2],
+    })
+    matrices, groups = transition_matrices(transition_df, ['A', 'B'])
+    assert groups == [None]
+    assert matrices[0] == pytest.approx(np.array([[0.25, 0.75], [1, 0]]))
+
+
+def test_transition_matrices_by_hour():
+    transition_df = pd.DataFrame({
+        const.BEHAVIOR: ['A', 'B'],
+        const.BEHAVIOR_NEXT: ['B', 'B'],
+        'HOUR_PERFORMED': [2, 1],
+        'TRANSITION_COUNTS': [4, 1],
+    })
+    matrices, groups = transition_matrices(transition_df, ['A', 'B'], const.TIME)
+    assert groups == [1, 2]
+    assert matrices[0] == pytest.approx(np.array([[0, 0], [0, 1]]))
+    assert matrices[1] == pytest.approx(np.array([[0, 1], [0, 0]]))
+
+
+def test_alternating_chain():
+    # Every passage takes one step, every return two
+    passage = mean_first_passage_times(np.array([[[0.0, 1.0], [1.0, 0.0]]]))
+    assert passage[0] == pytest.approx(np.array([[2, 1], [1, 2]]))
+
+
+def test_fair_coin_chain():
+    # Leaving a behavior takes 2 steps on average (geometric with p = 0.5), returning takes 1 + 0.5 * 2
+    passage = mean_first_passage_times(np.array([[[0.5, 0.5], [0.5, 0.5]]]))
+    assert passage[0] == pytest.approx(np.array([[2, 2], [2, 2]]))
+
+
+def test_unreachable_targets_are_infinite():
+    passage = mean_first_passage_times(np.array([[[1.0, 0.0], [0.0, 1.0]]]))
+    assert passage[0, 0, 0] == pytest.approx(1)
+    assert np.isinf(passage[0, 0, 1]) and np.isinf(passage[0, 1, 0])
+
+
+def test_passages_that_may_never_happen_are_infinite():
+    # From A, half the time the chain gets stuck in C and never reaches B
+    passage = mean_first_passage_times(np.array([[[0.0, 0.5, 0.5], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]]]))
+    assert np.isinf(passage[0, 0, 1])
+    assert passage[0, 1, 0] == pytest.approx(1)
+
+
+def test_absorption_probabilities():
+    # A stays put half the time and is absorbed by B or C a quarter of the time each, so absorption takes 2 steps
+    matrices = np.array([[[0.5, 0.25, 0.25], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]])
+    probabilities, steps = absorption_probabilities(matrices, [1, 2])
+    assert probabilities[0] == pytest.approx(np.array([[0.5, 0.5], [1, 0], [0, 1]]))
+    assert steps[0] == pytest.approx(np.array([2, 0, 0]))
+
+
+def test_behaviors_that_are_never_absorbed():
+    # C only ever goes back to itself, so it is never absorbed by B
+    matrices = np.array([[[0.0, 1.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]])
+    probabilities, steps = absorption_probabilities(matrices, [1])
+    assert probabilities[0, :, 0] == pytest.approx(np.array([1, 1, 0]))
+    assert steps[0, 0] == pytest.approx(1)
+    assert np.isinf(steps[0, 2])
@@ -0,0 +1,39 @@
+import pytest
+
+from utils import constants as const
+from utils.shard_utils import assign_shards, jobs_for_shard, parse_shard
+
+
+def test_assign_shards_balances_costs():
+    # 5 goes to shard 0, then both 3s to shard 1 (loads 5 and 6), then 1 to the lighter shard 0
+    assert assign_shards([5, 3, 3, 1], 2) == [0, 1, 1, 0]
+
+
+def test_assign_shards_breaks_ties_by_index():
+    assert assign_shards([1, 1, 1], 2) == [0, 1, 0]
+    assert assign_shards([2, 1, 2], 3) == [0, 2, 1]
+
+
+def test_assign_shards_with_more_shards_than_jobs():
+    assert assign_shards([4], 3) == [0]
+    assert assign_shards([], 2) == []
+
+
+def test_parse_shard():
+    assert parse_shard('2/4') == (2, 4)
+    assert parse_shard(' 1 / 1 ') == (1, 1)
+    for value in ['0/4', '5/4', '1/0', '1-4', 'one/four']:
+        with pytest.raises(Exception, match='Invalid shard'):
+            parse_shard(value)
+
+
+def test_every_job_is_in_exactly_one_shard(tmp_path):
+    jobs = []
+    for idx, row_count in enumerate([30, 10, 20, 10, 5]):
+        folder = tmp_path / f'folder{idx}'
+        folder.mkdir()
+        (folder / 'log.csv').write_text('Time,Behavior\n' + '1,BITE\n' * row_count)
+        jobs.append({ const.INPUT_FOLDER: str(folder) })
+    shards = [jobs_for_shard(jobs, shard_idx, 3) for shard_idx in [1, 2, 3]]
+    assert sorted(job_idx for shard in shards for job_idx in shard) == list(range(len(jobs)))
+    assert shards[0] == [0]
@@ -4,7 +4,18 @@ from typing import Final
 GLOBAL_INPUT_FOLDER: Final[str] = 'GLOBAL_INPUT_FOLDER'
 GLOBAL_OUTPUT_FOLDER: Final[str] = 'GLOBAL_OUTPUT_FOLDER'
 GLOBAL_ATTACH_LEGEND: Final[str] = 'GLOBAL_ATTACH_LEGEND'
+GLOBAL_DATASET_FOLDER: Final[str] = 'GLOBAL_DATASET_FOLDER'
+GLOBAL_OUTPUT_BACKEND: Final[str] = 'GLOBAL_OUTPUT_BACKEND'
+GLOBAL_KEEP_GRAPH_SOURCES: Final[str] = 'GLOBAL_KEEP_GRAPH_SOURCES'
 PARENT_OUTPUT_FOLDER: Final[str] = 'PARENT_OUTPUT_FOLDER'
+PIPELINE_INGEST_WORKERS: Final[str] = 'PIPELINE_INGEST_WORKERS'
+PIPELINE_FORMAT_WORKERS: Final[str] = 'PIPELINE_FORMAT_WORKERS'
+PIPELINE_BUILD_WORKERS: Final[str] = 'PIPELINE_BUILD_WORKERS'
+PIPELINE_RENDER_WORKERS: Final[str] = 'PIPELINE_RENDER_WORKERS'
+PIPELINE_QUEUE_SIZE: Final[str] = 'PIPELINE_QUEUE_SIZE'
+SERVE_PORT: Final[str] = 'SERVE_PORT'
+SERVE_RENDER_WORKERS: Final[str] = 'SERVE_RENDER_WORKERS'
+SERVE_CACHE_SIZE: Final[str] = 'SERVE_CACHE_SIZE'
 JOBS: Final[str] = 'JOBS'
 # JOBS sub param names
 JOB_NAME: Final[str] = 'JOB_NAME'
@@ -15,6 +26,27 @@ ENV: Final[str] = 'ENVIRONMENT'
 COLOR_MAP: Final[str] = 'COLOR_MAP'
 GROUP_BY: Final[str] = 'GROUP_BY'
 ATTACH_LEGEND: Final[str] = 'ATTACH_LEGEND'
+INGEST_WORKERS: Final[str] = 'INGEST_WORKERS'
+INGEST_WITH_PROCESSES: Final[str] = 'INGEST_WITH_PROCESSES'
+FPS: Final[str] = 'FPS'
+OUTPUT_FORMAT: Final[str] = 'OUTPUT_FORMAT'
+DATASET_FOLDER: Final[str] = 'DATASET_FOLDER'
+OUTPUT_BACKEND: Final[str] = 'OUTPUT_BACKEND'
+KEEP_GRAPH_SOURCES: Final[str] = 'KEEP_GRAPH_SOURCES'
+LAG_SEQUENTIAL: Final[str] = 'LAG_SEQUENTIAL'
+LAG_STATISTIC: Final[str] = 'LAG_STATISTIC'
+LAG_SIGNIFICANCE: Final[str] = 'LAG_SIGNIFICANCE'
+INTERACTION_WINDOW: Final[str] = 'INTERACTION_WINDOW'
+SUBJECT_COLUMN: Final[str] = 'SUBJECT_COLUMN'
+FIRST_PASSAGE: Final[str] = 'FIRST_PASSAGE'
+ABSORBING_BEHAVIORS: Final[str] = 'ABSORBING_BEHAVIORS'
+MOTIFS: Final[str] = 'MOTIFS'
+MOTIF_LENGTHS: Final[str] = 'MOTIF_LENGTHS'
+MOTIF_TOP: Final[str] = 'MOTIF_TOP'
+PER_INDIVIDUAL: Final[str] = 'PER_INDIVIDUAL'
+INDIVIDUAL_GRAPHS: Final[str] = 'INDIVIDUAL_GRAPHS'
+DISTANCE_METRIC: Final[str] = 'DISTANCE_METRIC'
+DENDROGRAM_ORDER: Final[str] = 'DENDROGRAM_ORDER'
 
 # Data input column names/group by options
 BASIC: Final[str] = 'BASIC'
@@ -24,6 +56,26 @@ TIME: Final[str] = 'TIME'
 BEHAVIORAL_CATEGORY: Final[str] = 'BEHAVIORAL_CATEGORY'
 STATUS: Final[str] = 'STATUS' # this one is currently not in use
 
+# Data output formats
+CSV: Final[str] = 'CSV'
+PARQUET: Final[str] = 'PARQUET'
+ARROW: Final[str] = 'ARROW'
+
+# Output backends
+FILES: Final[str] = 'FILES'
+ZIP: Final[str] = 'ZIP'
+TAR: Final[str] = 'TAR'
+CONTENT_ADDRESSED: Final[str] = 'CONTENT_ADDRESSED'
+
+# Lag sequential z scores
+ADJUSTED_RESIDUAL: Final[str] = 'ADJUSTED_RESIDUAL'
+ALLISON_LIKER: Final[str] = 'ALLISON_LIKER'
+
+# Matrix distances
+FROBENIUS: Final[str] = 'FROBENIUS'
+JENSEN_SHANNON: Final[str] = 'JENSEN_SHANNON'
+KL: Final[str] = 'KL'
+
 # Hex Color codes for making color gradients
 MAX_HEX_VALUE: Final[int] = 0xFFFFFF
 WHITE_FULL: Final[str] = '#FFFFFF'
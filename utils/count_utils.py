@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+from concurrent.futures import Executor
+from typing import TYPE_CHECKING
+
+from utils import constants as const
+from utils.helper_utils import add_probability_columns
+from utils.scorelog_utils import ScoreLogSet, scorelogs_from_frames, share_scorelogs, attach_scorelogs
+from utils.import_utils import lazy_import
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+else:
+    np = lazy_import('numpy')
+    pd = lazy_import('pandas')
+
+# Array based equivalent of format_data.
+# Scorelogs are factorized into flat integer code arrays, which are counted into per-file tensors with np.bincount:
+#   transition counts: (files, behaviors, behaviors, groups)  [file, behavior, next behavior, group]
+#   behavior counts:   (files, behaviors, groups)
+# where groups are hour bins in TIME mode, behavioral categories in BEHAVIORAL_CATEGORY mode and a single group otherwise.
+# Formatting can run in a worker process, which reads the compact scorelogs from shared memory rather than having any
+# DataFrames pickled to it (see format_data_shared).
+
+
+class EncodedScorelogs:
+    def __init__(self, arrays: dict[str, np.ndarray], behaviors: list[str], groups: list, file_names: list[str], group_by: str):
+        self.arrays = arrays # behavior_codes, group_codes, transition_valid, behavior_valid, file_offsets
+        self.behaviors = behaviors # behavior code -> canonical behavior name (sorted)
+        self.groups = groups # group code -> hour bin or category name (sorted)
+        self.file_names = file_names
+        self.group_by = group_by
+
+    def count_shapes(self) -> dict[str, tuple[int, ...]]:
+        n_files, n_behaviors, n_groups = len(self.file_names), len(self.behaviors), len(self.groups)
+        return {
+            'transition_counts': (n_files, n_behaviors, n_behaviors, n_groups),
+            'transition_seen': (n_files, n_behaviors, n_behaviors, n_groups),
+            'behavior_counts': (n_files, n_behaviors, n_groups),
+            'behavior_seen': (n_files, n_behaviors, n_groups),
+        }
+
+
+def smallest_code_dtype(n_codes: int) -> np.dtype:
+    return np.dtype(np.int16) if n_codes <= np.iinfo(np.int16).max else np.dtype(np.int32)
+
+
+# Factorizes every scorelog into one flat set of code arrays (OUT_OF_VIEW rows removed), with file_offsets marking
+# where each file's rows start and end. Scorelogs given as DataFrames are made compact first (see scorelog_utils);
+# fps is only used for those, compact scorelogs already had their times converted.
+# Follows the same rules as format_data:
+# - a transition only counts when its row and the next raw row both have a time
+# - a behavior only counts when its row has a time
+def encode_scorelogs(scorelogs: dict[str, pd.DataFrame] | ScoreLogSet, group_by: str = '', fps: float | None = None) -> EncodedScorelogs:
+    if not isinstance(scorelogs, ScoreLogSet):
+        scorelogs = scorelogs_from_frames(scorelogs, fps)
+    codes = scorelogs.behavior_codes
+    offsets = scorelogs.offsets
+    has_time = ~np.isnan(scorelogs.times)
+    next_has_time = np.append(has_time[1:], False)
+    next_has_time[offsets[1:][offsets[1:] > offsets[:-1]] - 1] = False # the last row of a scorelog has no next row
+    keep = codes != scorelogs.behaviors.codes.get('OUT_OF_VIEW', -1)
+
+    if group_by == const.TIME:
+        if not has_time.all():
+            raise ValueError('Time column contains missing values, so rows cannot be grouped by hour')
+        groups = scorelogs.hours[keep]
+    elif group_by == const.BEHAVIORAL_CATEGORY:
+        missing = np.unique(scorelogs.file_index()[scorelogs.category_codes < 0])
+        if len(missing):
+            raise Exception(f'{scorelogs.names[missing[0]]} has no Behavioral category column')
+        groups = scorelogs.category_codes[keep]
+    else:
+        groups = np.zeros(int(keep.sum()), dtype=np.int64)
+
+    # Codes are renumbered in name order, which gives codes in the same order format_data's groupby sorts its keys
+    behavior_vocab, behavior_codes = _sorted_codes(codes[keep], scorelogs.behaviors.names)
+    if group_by == const.BEHAVIORAL_CATEGORY:
+        group_vocab, group_codes = _sorted_codes(groups, scorelogs.categories.names)
+    else:
+        group_vocab, group_codes = np.unique(groups, return_inverse=True)
+        group_vocab = group_vocab.tolist() if group_by == const.TIME else [0]
+
+    arrays = {
+        'behavior_codes': behavior_codes.astype(smallest_code_dtype(len(behavior_vocab))),
+        'group_codes': group_codes.astype(smallest_code_dtype(max(len(group_vocab), 1))),
+        'transition_valid': (has_time & next_has_time)[keep],
+        'behavior_valid': has_time[keep],
+        'file_offsets': np.concatenate([[0], np.cumsum(np.bincount(scorelogs.file_index()[keep], minlength=len(scorelogs)))]).astype(np.int64),
+    }
+    return EncodedScorelogs(arrays, behavior_vocab, group_vocab, list(scorelogs.names), group_by)
+
+
+# (sorted names of the codes that occur, codes renumbered to index them) for codes into a vocabulary's names
+def _sorted_codes(codes: np.ndarray, names: list[str]) -> tuple[list[str], np.ndarray]:
+    used = np.unique(codes)
+    used_names = np.array(names, dtype=object)[used] if len(used) else np.array([], dtype=object)
+    order = np.argsort(used_names, kind='stable')
+    renumbered = np.zeros(len(names), dtype=np.int64)
+    renumbered[used[order]] = np.arange(len(used))
+    return (used_names[order].tolist(), renumbered[codes] if len(codes) else np.zeros(0, dtype=np.int64))
+
+
+# Fills the per-file count tensors (see EncodedScorelogs.count_shapes) from the code arrays
+# "seen" marks keys that occurred at all, so keys whose every occurrence lacked a time still get a 0 count row like in format_data
+def count_encoded_arrays(arrays: dict[str, np.ndarray], counts: dict[str, np.ndarray]):
+    n_files, n_behaviors, _, n_groups = counts['transition_counts'].shape
+    codes = arrays['behavior_codes'].astype(np.int64)
+    group_codes = arrays['group_codes'].astype(np.int64)
+    offsets = arrays['file_offsets']
+    file_idx = np.repeat(np.arange(n_files, dtype=np.int64), np.diff(offsets))
+
+    # The last row of each file has no next behavior
+    has_next = np.ones(len(codes), dtype=bool)
+    file_ends = offsets[1:][offsets[1:] > offsets[:-1]] - 1
+    has_next[file_ends] = False
+    next_codes = np.roll(codes, -1)
+
+    transition_keys = (((file_idx * n_behaviors + codes) * n_behaviors + next_codes) * n_groups + group_codes)[has_next]
+    transition_size = n_files * n_behaviors * n_behaviors * n_groups
+    transition_valid = arrays['transition_valid'][has_next]
+    counts['transition_seen'][...] = (np.bincount(transition_keys, minlength=transition_size) > 0).reshape(counts['transition_seen'].shape)
+    counts['transition_counts'][...] = np.bincount(transition_keys[transition_valid], minlength=transition_size).reshape(counts['transition_counts'].shape)
+
+    behavior_keys = (file_idx * n_behaviors + codes) * n_groups + group_codes
+    behavior_size = n_files * n_behaviors * n_groups
+    behavior_valid = arrays['behavior_valid']
+    counts['behavior_seen'][...] = (np.bincount(behavior_keys, minlength=behavior_size) > 0).reshape(counts['behavior_seen'].shape)
+    counts['behavior_counts'][...] = np.bincount(behavior_keys[behavior_valid], minlength=behavior_size).reshape(counts['behavior_counts'].shape)
+
+
+def empty_counts(encoded: EncodedScorelogs) -> dict[str, np.ndarray]:
+    return {
+        name: np.zeros(shape, dtype=bool if name.endswith('_seen') else np.int64)
+        for name, shape in encoded.count_shapes().items()
+    }
+
+
+# Worker side of format_data_shared: encodes and counts the shared scorelogs (see share_scorelogs) and returns the
+# formatted frames. Only the spec is pickled to the worker and only the frames back
+def format_shared_scorelogs(spec: dict, group_by: str = '') -> tuple[pd.DataFrame, pd.DataFrame]:
+    logs, shared = attach_scorelogs(spec)
+    try:
+        encoded = encode_scorelogs(logs, group_by) # copies what it keeps, so nothing refers to the shared arrays after this
+        del logs
+        counts = empty_counts(encoded)
+        count_encoded_arrays(encoded.arrays, counts)
+        return counts_to_frames(encoded, counts)
+    finally:
+        shared.close()
+
+
+# Pools the per-file count tensors into the same (transition_df, behavior_df) that format_data returns
+def counts_to_frames(encoded: EncodedScorelogs, counts: dict[str, np.ndarray]) -> tuple[pd.DataFrame, pd.DataFrame]:
+    behaviors = np.array(encoded.behaviors, dtype=object)
+    groups = np.array(encoded.groups, dtype=object if encoded.group_by == const.BEHAVIORAL_CATEGORY else np.int64)
+    group_column = {
+        const.TIME: 'HOUR_PERFORMED',
+        const.BEHAVIORAL_CATEGORY: const.BEHAVIORAL_CATEGORY,
+    }.get(encoded.group_by)
+
+    # np.nonzero walks the pooled tensors in (behavior, next behavior, group) order, i.e. already sorted like groupby output
+    transition_counts = counts['transition_counts'].sum(axis=0)
+    behavior_idx, next_idx, group_idx = np.nonzero(counts['transition_seen'].any(axis=0))
+    transition_columns = { const.BEHAVIOR: behaviors[behavior_idx], const.BEHAVIOR_NEXT: behaviors[next_idx] }
+    if group_column is not None:
+        transition_columns[group_column] = groups[group_idx]
+    transition_columns['TRANSITION_COUNTS'] = transition_counts[behavior_idx, next_idx, group_idx].astype(np.int64)
+    transition_dataframe = pd.DataFrame(transition_columns)
+
+    behavior_counts = counts['behavior_counts'].sum(axis=0)
+    behavior_idx, group_idx = np.nonzero(counts['behavior_seen'].any(axis=0))
+    behavior_columns = { const.BEHAVIOR: behaviors[behavior_idx] }
+    if group_column is not None:
+        behavior_columns[group_column] = groups[group_idx]
+    behavior_columns['BEHAVIOR_COUNTS'] = behavior_counts[behavior_idx, group_idx].astype(np.int64)
+    behavior_dataframe = pd.DataFrame(behavior_columns)
+
+    add_probability_columns(transition_dataframe, behavior_dataframe, encoded.group_by)
+    return (transition_dataframe, behavior_dataframe)
+
+
+# Per-individual (per-file) summaries of the count tensors, as extra columns on counts_to_frames' rows:
+#   AVG_/MEDIAN_/STDERR_TRANSITION_COUNTS         over every file (a file without the transition counts 0)
+#   AVG_/MEDIAN_/STDERR_TRANSITION_PROBABILITY    over the files that have the behavior (N_INDIVIDUALS of them)
+#   AVG_/MEDIAN_/STDERR_BEHAVIOR_COUNTS/PROBABILITY likewise for behaviors
+# so every individual weighs the same, unlike the pooled counts, which are dominated by the longest recordings.
+# STDERR is the standard error of the mean (NaN with fewer than two individuals)
+def cohort_frames(encoded: EncodedScorelogs, counts: dict[str, np.ndarray]) -> tuple[pd.DataFrame, pd.DataFrame]:
+    transition_dataframe, behavior_dataframe = counts_to_frames(encoded, counts)
+    transition_counts = counts['transition_counts'].astype(np.float64)
+    behavior_counts = counts['behavior_counts'].astype(np.float64)
+
+    transition_totals = transition_counts.sum(axis=2, keepdims=True)
+    transition_probabilities = np.divide(transition_counts, transition_totals, out=np.full(transition_counts.shape, np.nan), where=transition_totals > 0)
+    # Like add_probability_columns, behavior probabilities are per hour for TIME and over every behavior otherwise
+    behavior_totals = behavior_counts.sum(axis=(1, 2) if encoded.group_by == const.BEHAVIORAL_CATEGORY else 1, keepdims=True)
+    behavior_probabilities = np.divide(behavior_counts, behavior_totals, out=np.full(behavior_counts.shape, np.nan), where=behavior_totals > 0)
+
+    behavior_idx, next_idx, group_idx = np.nonzero(counts['transition_seen'].any(axis=0))
+    for name, stacked in [('TRANSITION_COUNTS', transition_counts), ('TRANSITION_PROBABILITY', transition_probabilities)]:
+        for stat, values in _individual_stats(stacked).items():
+            transition_dataframe[f'{stat}_{name}'] = values[behavior_idx, next_idx, group_idx]
+    transition_dataframe['N_INDIVIDUALS'] = (transition_totals[:, :, 0, :] > 0).sum(axis=0)[behavior_idx, group_idx]
+
+    behavior_idx, group_idx = np.nonzero(counts['behavior_seen'].any(axis=0))
+    for name, stacked in [('BEHAVIOR_COUNTS', behavior_counts), ('BEHAVIOR_PROBABILITY', behavior_probabilities)]:
+        for stat, values in _individual_stats(stacked).items():
+            behavior_dataframe[f'{stat}_{name}'] = values[behavior_idx, group_idx]
+    behavior_dataframe['N_INDIVIDUALS'] = (behavior_counts > 0).sum(axis=0)[behavior_idx, group_idx]
+    return (transition_dataframe, behavior_dataframe)
+
+
+# Mean, median and standard error over the file axis (axis 0), ignoring NaNs
+def _individual_stats(stacked: np.ndarray) -> dict[str, np.ndarray]:
+    valid = ~np.isnan(stacked)
+    n = valid.sum(axis=0)
+    filled = np.where(valid, stacked, 0)
+    mean = np.divide(filled.sum(axis=0), n, out=np.full(n.shape, np.nan), where=n > 0)
+    squares = np.where(valid, (stacked - mean) ** 2, 0).sum(axis=0)
+    stderr = np.sqrt(np.divide(squares, n * (n - 1), out=np.full(n.shape, np.nan), where=n > 1))
+    # Sorting puts NaNs last, so each median sits in the first n entries along the file axis
+    ordered = np.sort(stacked, axis=0)
+    lower = np.take_along_axis(ordered, np.maximum((n - 1) // 2, 0)[None, ...], axis=0)[0]
+    upper = np.take_along_axis(ordered, np.maximum(n // 2, 0)[None, ...], axis=0)[0]
+    median = np.where(n > 0, (lower + upper) / 2, np.nan)
+    return { 'AVG': mean, 'MEDIAN': median, 'STDERR': stderr }
+
+
+# Counts of a single file, sliced out of the per-file tensors
+def file_counts_slice(counts: dict[str, np.ndarray], file_idx: int) -> dict[str, np.ndarray]:
+    return { name: tensor[file_idx:file_idx + 1] for name, tensor in counts.items() }
+
+
+# Drop-in replacement for format_data. Given an executor, the encoding, counting and building of the frames all run in a
+# worker process (see format_shared_scorelogs), so this thread only copies the compact scorelogs into shared memory and
+# waits. DataFrame scorelogs are made compact here first
+def format_data_shared(
+    df_map: dict[str, pd.DataFrame] | ScoreLogSet,
+    group_by: str = '',
+    fps: float | None = None,
+    executor: Executor | None = None
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    if executor is None:
+        encoded = encode_scorelogs(df_map, group_by, fps)
+        counts = empty_counts(encoded)
+        count_encoded_arrays(encoded.arrays, counts)
+        return counts_to_frames(encoded, counts)
+
+    logs = df_map if isinstance(df_map, ScoreLogSet) else scorelogs_from_frames(df_map, fps)
+    shared, spec = share_scorelogs(logs)
+    try:
+        return executor.submit(format_shared_scorelogs, spec, group_by).result()
+    finally:
+        shared.release()
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import math
+from typing import TYPE_CHECKING
+
+from utils import constants as const
+from utils.import_utils import lazy_import
+
+if TYPE_CHECKING:
+    import numpy as np
+else:
+    np = lazy_import('numpy')
+
+# Pairwise distances between transition matrices (e.g. one per scorelog) for clustering individuals by their transition
+# structure. The matrices are stacked as (matrices, behaviors, behaviors) counts on one shared behavior index (the
+# per-file tensors of count_utils already are), turned into row stochastic matrices, and compared all at once:
+#   FROBENIUS       || P_a - P_b ||_F, from one Gram matrix product
+#   JENSEN_SHANNON  mean over behaviors of the Jensen-Shannon divergence (in bits, so 0 to 1) between the two rows of a
+#                   behavior. A behavior with transitions in only one of the two matrices counts as 1, behaviors
+#                   missing from both are left out
+#   KL              mean over the behaviors of P_a of KL(P_a row || P_b row) in bits. P_b is smoothed towards uniform
+#                   rows so the divergence stays finite. Not symmetric: row a column b is KL(a || b)
+# Jensen-Shannon has no product form, so it is computed by broadcasting blocks of matrix pairs, sized to stay within
+# chunk_bytes of memory however many matrices there are.
+
+# Memory budget of one block of Jensen-Shannon pairs
+DEFAULT_CHUNK_BYTES: int = 64 * 2 ** 20
+# Weight of the uniform distribution mixed into the second matrix of KL
+KL_SMOOTHING: float = 1e-3
+
+
+# (row stochastic matrices, rows that have any transitions) of (matrices, behaviors, behaviors) counts
+def row_normalize(counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    counts = counts.astype(np.float64)
+    row_totals = counts.sum(axis=2, keepdims=True)
+    return (np.divide(counts, row_totals, out=np.zeros(counts.shape), where=row_totals > 0), row_totals[..., 0] > 0)
+
+
+def _frobenius(probabilities: np.ndarray) -> np.ndarray:
+    flat = probabilities.reshape(len(probabilities), -1)
+    squares = (flat * flat).sum(axis=1)
+    distances = squares[:, None] + squares[None, :] - 2 * (flat @ flat.T)
+    distances = np.sqrt(np.maximum(distances, 0))
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+def _plogp(values: np.ndarray) -> np.ndarray:
+    return values * np.log2(values, out=np.zeros(values.shape), where=values > 0)
+
+
+def _jensen_shannon(probabilities: np.ndarray, has_row: np.ndarray, chunk_bytes: int) -> np.ndarray:
+    n_matrices, n_behaviors = probabilities.shape[0], probabilities.shape[1]
+    block = max(1, math.isqrt(max(chunk_bytes // (8 * max(n_behaviors, 1) ** 2 * 3), 1)))
+    # JS(p, q) = H((p + q) / 2) - (H(p) + H(q)) / 2, with H(p) = -sum p log p
+    row_entropies = -_plogp(probabilities).sum(axis=2)
+    distances = np.zeros((n_matrices, n_matrices))
+    for start_a in range(0, n_matrices, block):
+        stop_a = min(start_a + block, n_matrices)
+        for start_b in range(start_a, n_matrices, block):
+            stop_b = min(start_b + block, n_matrices)
+            mixed = (probabilities[start_a:stop_a, None] + probabilities[None, start_b:stop_b]) / 2
+            divergence = -_plogp(mixed).sum(axis=3) - (row_entropies[start_a:stop_a, None] + row_entropies[None, start_b:stop_b]) / 2
+            in_a, in_b = has_row[start_a:stop_a, None], has_row[None, start_b:stop_b]
+            divergence = np.where(in_a & in_b, np.clip(divergence, 0, 1), 1.0)
+            compared = in_a | in_b
+            n_compared = compared.sum(axis=2)
+            values = np.divide((divergence * compared).sum(axis=2), n_compared, out=np.zeros(n_compared.shape), where=n_compared > 0)
+            distances[start_a:stop_a, start_b:stop_b] = values
+            distances[start_b:stop_b, start_a:stop_a] = values.T
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+def _kl(probabilities: np.ndarray, has_row: np.ndarray) -> np.ndarray:
+    n_matrices, n_behaviors = probabilities.shape[0], probabilities.shape[1]
+    uniform_rows = np.where(has_row[..., None], probabilities, 1 / max(n_behaviors, 1))
+    smoothed = (1 - KL_SMOOTHING) * uniform_rows + KL_SMOOTHING / max(n_behaviors, 1)
+    # Mean over the rows of a of sum p_a log p_a - p_a log p_b: the cross term is one product over every pair
+    weights = np.divide(has_row, has_row.sum(axis=1, keepdims=True), out=np.zeros(has_row.shape), where=has_row.any(axis=1, keepdims=True))
+    weighted = (probabilities * weights[..., None]).reshape(n_matrices, -1)
+    self_terms = (_plogp(probabilities) * weights[..., None]).reshape(n_matrices, -1).sum(axis=1)
+    cross_terms = weighted @ np.log2(smoothed).reshape(n_matrices, -1).T
+    distances = np.maximum(self_terms[:, None] - cross_terms, 0)
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+# (matrices, matrices) distances between every pair of (matrices, behaviors, behaviors) transition counts
+def pairwise_distances(counts: np.ndarray, metric: str = const.JENSEN_SHANNON, chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> np.ndarray:
+    probabilities, has_row = row_normalize(counts)
+    if metric == const.FROBENIUS:
+        return _frobenius(probabilities)
+    if metric == const.JENSEN_SHANNON:
+        return _jensen_shannon(probabilities, has_row, chunk_bytes)
+    if metric == const.KL:
+        return _kl(probabilities, has_row)
+    raise Exception(f'Unknown distance metric: {metric}')
+
+
+# (leaf order, merges) of average linkage (UPGMA) clustering, asymmetric distances being averaged with their transpose
+# Each merge is (left cluster, right cluster, distance, size), clusters < n being the matrices themselves and cluster
+# n + k the one made by merge k (the same layout as scipy's linkage matrices)
+def dendrogram_order(distances: np.ndarray) -> tuple[list[int], list[tuple[int, int, float, int]]]:
+    n = len(distances)
+    remaining = (distances + distances.T) / 2
+    remaining = remaining.astype(np.float64)
+    np.fill_diagonal(remaining, np.inf)
+    sizes = np.ones(n)
+    cluster_ids = list(range(n))
+    leaves = [[idx] for idx in range(n)]
+    active = np.ones(n, dtype=bool)
+    merges = []
+    for step in range(n - 1):
+        masked = np.where(active[:, None] & active[None, :], remaining, np.inf)
+        first, second = np.unravel_index(np.argmin(masked), masked.shape)
+        first, second = min(first, second), max(first, second)
+        merges.append((cluster_ids[first], cluster_ids[second], float(remaining[first, second]), int(sizes[first] + sizes[second])))
+
+        # The merged cluster takes the place of first, its distances being the size weighted average of both
+        merged = (sizes[first] * remaining[first] + sizes[second] * remaining[second]) / (sizes[first] + sizes[second])
+        remaining[first], remaining[:, first] = merged, merged
+        remaining[first, first] = np.inf
+        sizes[first] += sizes[second]
+        active[second] = False
+        cluster_ids[first] = n + step
+        leaves[first] = leaves[first] + leaves[second]
+    return (leaves[int(np.argmax(active))] if n > 0 else [], merges)
@@ -1,12 +1,40 @@
+from __future__ import annotations
+
+import io
 import os
+import re
 import math
 import random
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable, TypeVar, overload
 from string import hexdigits
-
-import pandas as pd
-import graphviz as gv
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from utils import constants as const
+from utils.import_utils import lazy_import
+from utils.input_utils import list_data_files, read_data_source, data_file_stem
+from utils.output_utils import OutputWriter, make_output_writer, write_if_changed
+from utils.passage_utils import transition_matrices, mean_first_passage_times, absorption_probabilities
+from utils.distance_utils import pairwise_distances, dendrogram_order
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+    import graphviz as gv
+    # Only for annotations, these modules import this one
+    from utils.count_utils import EncodedScorelogs
+    from utils.matrix_api import TransitionMatrices
+    from utils.scorelog_utils import ScoreLogSet
+else:
+    np = lazy_import('numpy')
+    pd = lazy_import('pandas')
+    gv = lazy_import('graphviz', 'needed to render graphs, use --no-render to skip rendering')
+
+# What import_data_from_dir's convert turns each scorelog into
+Converted = TypeVar('Converted')
 
 
 class BehaviorTransitionData:
@@ -18,27 +46,223 @@ class BehaviorTransitionData:
         environment: str,
         color_map: dict[str, str],
         group_by: str = 'BASIC',
-        edge_visibility_threshold: float = 0.05
+        edge_visibility_threshold: float = 0.05,
+        ingest_workers: int | None = None,
+        ingest_with_processes: bool = False,
+        fps: float | None = None,
+        use_cache: bool = True,
+        formatted_data: tuple[pd.DataFrame, pd.DataFrame] | None = None,
+        raw_data: dict[str, pd.DataFrame] | ScoreLogSet | None = None,
+        output_backend: str = const.FILES,
+        keep_graph_sources: bool = True
     ):
-        raw_data = import_data_from_dir(input_dir_path)
-        trans_df_formatted, behave_df_formatted = format_data(raw_data, group_by)
-
-        self.transition_df = trans_df_formatted
-        self.behavior_df = behave_df_formatted
+        self.input_dir_path = input_dir_path
+        self.ingest_workers = ingest_workers
+        self.ingest_with_processes = ingest_with_processes
+        self.use_cache = use_cache
+        self.ingest_errors: dict[str, str] = {}
 
         self.subject = subject
         self.environment = environment
-        self.group_by = group_by
-        self.edge_visibility_threshold = edge_visibility_threshold
-
+        self.__group_by = group_by
+        self.__fps = fps
+        self.__edge_visibility_threshold = edge_visibility_threshold
         self.color_map = color_map
-        self.color_map['DEFAULT'] = self.__get_color('DEFAULT')
-        self.color_map['ENV_YELLOW'] = self.__get_color('ENV_YELLOW', default='#FFFFCC')
-        self.color_map['ENV_BLUE'] = self.__get_color('ENV_BLUE', default='#CCFFFF')
+
+        # formatted_data lets callers that already ran format_data (e.g. the staged pipeline) skip loading the input folder
+        if formatted_data is not None:
+            self.__dict__['formatted_data'] = formatted_data
+        # raw_data does the same for analyses that need the scorelogs themselves (e.g. lag sequential analysis). It may be
+        # compact scorelogs (see scorelog_utils) when the interactions, which need full DataFrames, aren't used
+        if raw_data is not None:
+            self.__dict__['raw_data'] = raw_data
 
         self.output_dir_path = output_dir_path
+        self.output_files: list[str] = [] # every file written by this object, in the order they were written
+        # Outputs go through an OutputWriter (see output_utils), bundles and indexes are only written by close_outputs
+        self.output_backend = output_backend
+        self.keep_graph_sources = keep_graph_sources
+        self.__output_writer: OutputWriter | None = None
+
+    # Every stage below is computed on first access from the stage before it and kept until a setting it depends on changes:
+    #   raw_data -> file_counts -> formatted_data (transition_df/behavior_df) -> graph_cache
+    #   raw_data -> individual_counts (per-file count tensors, only made for per-individual outputs)
+    # group_by and fps invalidate file_counts onwards (the files are not read again), edge_visibility_threshold and
+    # color_map only invalidate graph_cache. Assign a new color_map rather than editing the current one in place
+    STAGES: list[str] = ['raw_data', 'file_counts', 'individual_counts', 'formatted_data', 'graph_cache']
+
+    def __invalidate(self, first_stage: str):
+        for stage in BehaviorTransitionData.STAGES[BehaviorTransitionData.STAGES.index(first_stage):]:
+            self.__dict__.pop(stage, None)
+
+    @property
+    def group_by(self) -> str:
+        return self.__group_by
+
+    @group_by.setter
+    def group_by(self, group_by: str):
+        if group_by != self.__group_by:
+            self.__group_by = group_by
+            self.__invalidate('file_counts')
+
+    @property
+    def fps(self) -> float | None:
+        return self.__fps
+
+    @fps.setter
+    def fps(self, fps: float | None):
+        if fps != self.__fps:
+            self.__fps = fps
+            # Compact scorelogs had their frame numbers converted with the old fps, so the files are read again
+            self.__invalidate('file_counts' if isinstance(self.__dict__.get('raw_data', {}), dict) else 'raw_data')
+
+    @property
+    def edge_visibility_threshold(self) -> float:
+        return self.__edge_visibility_threshold
+
+    @edge_visibility_threshold.setter
+    def edge_visibility_threshold(self, edge_visibility_threshold: float):
+        if edge_visibility_threshold != self.__edge_visibility_threshold:
+            self.__edge_visibility_threshold = edge_visibility_threshold
+            self.__invalidate('graph_cache')
+
+    @property
+    def color_map(self) -> dict[str, str]:
+        return self.__color_map
+
+    @color_map.setter
+    def color_map(self, color_map: dict[str, str]):
+        self.__color_map = color_map
+        self.__color_map['DEFAULT'] = self.__get_color('DEFAULT')
+        self.__color_map['ENV_YELLOW'] = self.__get_color('ENV_YELLOW', default='#FFFFCC')
+        self.__color_map['ENV_BLUE'] = self.__get_color('ENV_BLUE', default='#CCFFFF')
+        self.__invalidate('graph_cache')
+
+    # Names of the data files in the input folder, without reading any of them
+    @property
+    def data_files(self) -> list[str]:
+        return list_data_files(self.input_dir_path)
+
+    @functools.cached_property
+    def raw_data(self) -> dict[str, pd.DataFrame] | ScoreLogSet:
+        errors: dict[str, str] = {}
+        raw_data = import_data_from_dir(
+            self.input_dir_path,
+            max_workers=self.ingest_workers,
+            use_processes=self.ingest_with_processes,
+            errors=errors
+        )
+        self.__report_ingest_errors(errors)
+        return raw_data
+
+    # Per-file (transition counts, behavior counts), with behavior and category names normalized
+    @functools.cached_property
+    def file_counts(self) -> dict[str, tuple[pd.DataFrame, pd.DataFrame]]:
+        return { name: count_scorelog(sub_df, self.group_by, self.fps) for name, sub_df in self.raw_data.items() }
+
+    # (EncodedScorelogs, per-file count tensors) of the scorelogs, see count_utils
+    @functools.cached_property
+    def individual_counts(self) -> tuple[EncodedScorelogs, dict[str, np.ndarray]]:
+        from utils.count_utils import encode_scorelogs, empty_counts, count_encoded_arrays # count_utils imports this module
+
+        encoded = encode_scorelogs(self.raw_data, self.group_by, self.fps)
+        counts = empty_counts(encoded)
+        count_encoded_arrays(encoded.arrays, counts)
+        return (encoded, counts)
+
+    # (transition_df, behavior_df) with probabilities. Taken from the in-process memo when the input folder
+    # was already formatted the same way, unless this object already has per-file counts of its own
+    @functools.cached_property
+    def formatted_data(self) -> tuple[pd.DataFrame, pd.DataFrame]:
+        cache_key = None
+        if self.use_cache and 'file_counts' not in self.__dict__:
+            cache_key = formatted_data_cache_key(self.input_dir_path, self.group_by, self.fps)
+            cached = get_cached_formatted_data(cache_key)
+            if cached is not None:
+                self.__report_ingest_errors(cached[2])
+                return (cached[0], cached[1])
+
+        if not isinstance(self.raw_data, dict):
+            from utils.count_utils import format_data_shared # count_utils imports this module
+
+            result = format_data_shared(self.raw_data, self.group_by, self.fps) # compact scorelogs, see scorelog_utils
+        else:
+            file_counts = list(self.file_counts.values())
+            result = pool_counts([counts[0] for counts in file_counts], [counts[1] for counts in file_counts], self.group_by)
+        if cache_key is not None:
+            cache_formatted_data(cache_key, (result[0], result[1], dict(self.ingest_errors)))
+        return result
+
+    @property
+    def transition_df(self) -> pd.DataFrame:
+        return self.formatted_data[0]
+
+    @property
+    def behavior_df(self) -> pd.DataFrame:
+        return self.formatted_data[1]
+
+    # Sorted behavior codes that occur in the data
+    @property
+    def behaviors(self) -> list[str]:
+        return sorted(self.behavior_df[const.BEHAVIOR].unique().tolist())
+
+    # attach_legend -> the render tasks built for it, see build_markov_chain_graphs
+    @functools.cached_property
+    def graph_cache(self) -> dict[bool | None, list[tuple[gv.Digraph | gv.Source, str, bool]]]:
+        return {}
+
+    def __report_ingest_errors(self, errors: dict[str, str]):
+        self.ingest_errors = errors
+        for filename, message in errors.items():
+            print(f'Skipped {os.path.join(self.input_dir_path, filename)} ({message})')
+
+    def output_dfs(self, file_format: str = const.CSV, compression: str = 'zstd'):
+        if file_format.upper() == const.CSV:
+            self.output_dfs_as_csvs()
+        else:
+            self.output_dfs_as_columnar(file_format, compression)
 
     def output_dfs_as_csvs(self):
+        behaviors_sorted, transitions_sorted = self.__sorted_output_dfs()
+        output_dir, file_name = self.__output_file_location()
+
+        self.__write_output(f'{output_dir}/{file_name}_Behavior_data.csv', behaviors_sorted.to_csv(index=False).encode())
+        self.__write_output(f'{output_dir}/{file_name}_Transitions_data.csv', transitions_sorted.to_csv(index=False).encode())
+
+    # file_format is either 'parquet' or 'arrow' (Arrow IPC/Feather v2). Requires pyarrow
+    def output_dfs_as_columnar(self, file_format: str = const.PARQUET, compression: str = 'zstd'):
+        behaviors_sorted, transitions_sorted = self.__sorted_output_dfs()
+        output_dir, file_name = self.__output_file_location()
+        ext = file_format.lower()
+
+        self.__write_output(f'{output_dir}/{file_name}_Behavior_data.{ext}', columnar_bytes(behaviors_sorted, file_format, compression))
+        self.__write_output(f'{output_dir}/{file_name}_Transitions_data.{ext}', columnar_bytes(transitions_sorted, file_format, compression))
+
+    # Adds this job's results to a dataset shared by every job, laid out as hive style partitions so that
+    # cross-job queries only need to read the relevant subject/environment folders:
+    #   <dataset_dir>/<group_by>/<Behaviors|Transitions>/SUBJECT=<subject>/ENVIRONMENT=<env>/<job_name>-<hash>.<ext>
+    # Re-running a job replaces its own part file rather than duplicating its rows (the dataset is always kept as plain
+    # files whatever the output backend, so it stays readable as one dataset)
+    def append_to_dataset(self, dataset_dir: str, job_name: str, file_format: str = const.PARQUET, compression: str = 'zstd'):
+        behaviors_sorted, transitions_sorted = self.__sorted_output_dfs()
+        # Each group_by has its own columns (e.g. HOUR_PERFORMED or BEHAVIORAL_CATEGORY), so each gets its own datasets
+        # Partition values are made path safe like the file name, so e.g. a '/' or '=' in a subject can't add directories
+        # or break hive style partition parsing
+        partition = os.path.join(*[
+            f'{key}=' + re.sub(r'[^\w.-]', '_', value)
+            for key, value in [(const.SUBJECT, self.subject or 'NONE'), (const.ENV, self.environment or 'NONE')]
+        ])
+        # The part name keeps a short hash of the raw job name, so two jobs whose names only differ in replaced characters
+        # don't overwrite each other's part
+        part_name = re.sub(r'[^\w.-]', '_', job_name) + '-' + hashlib.sha256(job_name.encode()).hexdigest()[:8]
+        ext = file_format.lower()
+        for kind, df in [('Behaviors', behaviors_sorted), ('Transitions', transitions_sorted)]:
+            partition_dir = os.path.join(dataset_dir, self.group_by, kind, partition)
+            df.insert(0, const.JOB_NAME, job_name)
+            write_if_changed(os.path.join(partition_dir, f'{part_name}.{ext}'), columnar_bytes(df, file_format, compression))
+            self.output_files.append(os.path.join(partition_dir, f'{part_name}.{ext}'))
+
+    def __sorted_output_dfs(self) -> tuple[pd.DataFrame, pd.DataFrame]:
         sort_by_vals_bdf = ['BEHAVIOR']
         sort_by_vals_tdf = ['BEHAVIOR', 'BEHAVIOR_NEXT']
         if self.group_by == 'TIME':
@@ -46,37 +270,71 @@ class BehaviorTransitionData:
             sort_by_vals_bdf = ['HOUR_PERFORMED', 'BEHAVIOR']
             sort_by_vals_tdf = ['HOUR_PERFORMED', 'BEHAVIOR', 'BEHAVIOR_NEXT']
 
-        behaviors_copy = self.behavior_df.copy()
-        transitions_copy = self.transition_df.copy()
-
-        behaviors_copy.sort_values(by=sort_by_vals_bdf, inplace=True)
-        transitions_copy.sort_values(by=sort_by_vals_tdf, inplace=True)
+        # sort_values already returns a new frame, so no extra copies are made beforehand
+        behaviors_sorted = self.behavior_df.sort_values(by=sort_by_vals_bdf)
+        transitions_sorted = self.transition_df.sort_values(by=sort_by_vals_tdf)
+        return (behaviors_sorted, transitions_sorted)
 
+    def __output_file_location(self) -> tuple[str, str]:
         output_dir = f'{self.output_dir_path}/{self.group_by}'
         environment_append = f'{self.environment}Env' if self.group_by != 'BEHAVIORAL_CATEGORY' else 'BehaviorCategory'
         file_name = f'{self.subject}Fish_{environment_append}'
-
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        behaviors_copy.to_csv(f'{output_dir}/{file_name}_Behavior_data.csv', index=False)
-        transitions_copy.to_csv(f'{output_dir}/{file_name}_Transitions_data.csv', index=False)
+        return (output_dir, file_name)
+
+    def __write_output(self, file_path: str, data: bytes):
+        if self.__output_writer is None:
+            output_dir, file_name = self.__output_file_location()
+            self.__output_writer = make_output_writer(
+                self.output_backend,
+                self.output_dir_path,
+                output_dir,
+                f'{output_dir}/{file_name}'
+            )
+        written_path = self.__output_writer.write(file_path, data)
+        if written_path is not None:
+            self.output_files.append(written_path)
+
+    # Writes out the bundle/index of the outputs written so far (nothing to do for the FILES backend)
+    # Returns how many outputs were (re)written and how many were left as they were since the last close
+    def close_outputs(self) -> tuple[int, int]:
+        if self.__output_writer is None:
+            return (0, 0)
+        writer, self.__output_writer = self.__output_writer, None
+        self.output_files += writer.close()
+        return (writer.written_count, writer.unchanged_count)
 
     def create_markov_chain_graph(self, attach_legend: bool | None = None):
+        self.render_graphs(self.build_markov_chain_graphs(attach_legend))
+        if self.group_by == const.BEHAVIORAL_CATEGORY:
+            self.output_category_chain()
+            self.render_graphs(self.build_category_chain_graph())
+        self.close_outputs()
+
+    # Renders the (graph, file path, cleanup) tasks produced by build_markov_chain_graphs to svg
+    # Rendering runs the Graphviz executables, so this is the slow part for larger graphs
+    def render_graphs(self, render_tasks: list[tuple[gv.Digraph | gv.Source, str, bool]]):
+        for graph, file_path, cleanup in render_tasks:
+            self.__write_output(f'{file_path}.svg', graph.pipe(format='svg', quiet=True))
+            if cleanup is False and self.keep_graph_sources:
+                self.__write_output(file_path, graph.source.encode()) # the Graphviz source is kept alongside the svg
+
+    # Builds the chain graphs (and their legends) without rendering them
+    # Returns (graph, file path, cleanup) render tasks to pass to render_graphs. The tasks are kept in graph_cache,
+    # so building again with the same settings returns the same graph objects
+    def build_markov_chain_graphs(self, attach_legend: bool | None = None) -> list[tuple[gv.Digraph | gv.Source, str, bool]]:
+        if attach_legend not in self.graph_cache:
+            self.graph_cache[attach_legend] = self.__build_markov_chain_graphs(attach_legend)
+        return self.graph_cache[attach_legend]
+
+    def __build_markov_chain_graphs(self, attach_legend: bool | None) -> list[tuple[gv.Digraph | gv.Source, str, bool]]:
         graph_list: list[gv.Digraph] = [self.__init_new_digraph(add_label=True, hour=1 if self.group_by == 'TIME' else None)]
         behavior_list: list[list[tuple[str, str, str, float]]] = [[]]
-        color_map_categorical = {
-            'AGGRESSIVE': '#e7298a', # pinkish red
-            'REPRODUCTIVE': '#a6ce69', # olive green
-            'AVERSIVE': '#8c564b', # brown
-            'DEFAULT': '000000', # black
-            'ENV_YELLOW': self.color_map['ENV_YELLOW'],
-            'ENV_BLUE': self.color_map['ENV_BLUE'],
-        }
+        color_map_categorical = self.__categorical_color_map()
         behavior_map = {}
         sub_graphs: dict[str, gv.Digraph] = dict()
         if self.group_by == 'BEHAVIORAL_CATEGORY':
             behavior_map = map_two_columns(self.behavior_df, 'BEHAVIOR', 'BEHAVIORAL_CATEGORY')
-            self.color_map = color_map_categorical
+            self.__color_map = color_map_categorical # set directly, this must not invalidate the graphs being built
 
         for idx, row in self.behavior_df.iterrows():
             behavior_name = str(row['BEHAVIOR'])
@@ -170,9 +428,7 @@ class BehaviorTransitionData:
             )
 
         output_dir = f'{self.output_dir_path}/{self.group_by}'
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
+        render_tasks: list[tuple[gv.Digraph | gv.Source, str, bool]] = []
         for idx, g in enumerate(graph_list):
             file_name = f'{self.subject}FishBehavior{self.environment}ChainModel'
             file_name += f'Hour{idx+1}' if self.group_by == 'TIME' else ''
@@ -185,33 +441,18 @@ class BehaviorTransitionData:
                     g.body += legend_lines
                     g.unflatten(stagger=3)
                 else:
-                    if not os.path.exists(f'{output_dir}/Legends'):
-                        os.makedirs(f'{output_dir}/Legends')
-                    legend.render(
-                        filename=f'{output_dir}/Legends/{file_name}_Legend',
-                        quiet=True,
-                        format='svg',
-                        cleanup=True
-                    )
-            g.render(
-                filename=f'{output_dir}/{file_name}',
-                quiet=True,
-                format='svg',
-                cleanup=False
-            )
+                    render_tasks.append((legend, f'{output_dir}/Legends/{file_name}_Legend', True))
+            render_tasks.append((g, f'{output_dir}/{file_name}', False))
+
+        return render_tasks
 
 
     def __create_graph_legend(self, behavior_list: list[tuple[str, str, str, float]], show_freqency: bool = True, show_category: bool = False) -> gv.Source:
         formatted = []
         for idx, (behavior, category, color_to_use, freqency) in enumerate(behavior_list):
             # color = self.color_map.get(behavior) if self.color_map.get(behavior) is not None else self.color_map['DEFAULT']
-            formatted_behavior = behavior.lower().capitalize().split("_")
-            if formatted_behavior[-1] == '\\u2640': # weird formatting issue that needs to be fixed manually here
-                formatted_behavior[-1] = str('\u2640')
-            elif formatted_behavior[-1] == '\\u2642':
-                formatted_behavior[-1] = str('\u2642')
             formatted.append(f'''<tr>
-                <td BGCOLOR="transparent">{" ".join(formatted_behavior)}</td>
+                <td BGCOLOR="transparent">{behavior_display_name(behavior)}</td>
                     {f'<td BGCOLOR="transparent">{freqency}%</td>' if show_freqency is True else ""}
                     {f'<td BGCOLOR="transparent">{category}</td>' if show_category is True else ""}
                     <td cellpadding="4">
@@ -253,19 +494,8 @@ class BehaviorTransitionData:
 
         formatted = []
         for _, row in tdf.iterrows():
-            behavior = str(row['BEHAVIOR']).lower().capitalize().split('_')
-            if behavior[-1] == '\\u2640': # weird formatting issue that needs to be fixed manually here
-                behavior[-1] = str('\u2640')
-            elif behavior[-1] == '\\u2642':
-                behavior[-1] = str('\u2642')
-            fixed_behavior = " ".join(behavior)
-
-            behavior_next = str(row['BEHAVIOR_NEXT']).lower().capitalize().split('_')
-            if behavior_next[-1] == '\\u2640': # same as before
-                behavior_next[-1] = str('\u2640')
-            elif behavior_next[-1] == '\\u2642':
-                behavior_next[-1] = str('\u2642')
-            fixed_behavior_next = " ".join(behavior_next)
+            fixed_behavior = behavior_display_name(str(row['BEHAVIOR']))
+            fixed_behavior_next = behavior_display_name(str(row['BEHAVIOR_NEXT']))
 
             raw_frequency = row['TRANSITION_PROBABILITY']
             if raw_frequency < self.edge_visibility_threshold:
@@ -302,18 +532,312 @@ class BehaviorTransitionData:
         }}''')
 
         output_dir = f"{self.output_dir_path}/{self.group_by}"
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
         file_name = f'{self.subject}Fish{f"_{self.environment}Env" if len(self.environment) else ""}'
-        source_str.render(
-            filename=f'{output_dir}/{file_name}_Transition_Table',
-            quiet=True,
-            format='svg',
-            cleanup=True
+        self.__write_output(f'{output_dir}/{file_name}_Transition_Table.svg', source_str.pipe(format='svg', quiet=True))
+
+    # Category -> category chain of a BEHAVIORAL_CATEGORY job, collapsed from the behavior counts already in
+    # transition_df/behavior_df (the scorelogs are not read again). With W the (behaviors, categories) indicator matrix,
+    # weighted by the share of each behavior's counts that fall in each category (so a behavior filed under two
+    # categories is split between them), the category transition counts are W^T X W for the behavior transition counts X.
+    # Returns (category_transition_df, category_df) shaped like format_data's frames, with BEHAVIORAL_CATEGORY(_NEXT) columns
+    def category_chain(self) -> tuple[pd.DataFrame, pd.DataFrame]:
+        if self.group_by != const.BEHAVIORAL_CATEGORY:
+            raise Exception('A category chain can only be made for group_by=behavioral category')
+        behaviors = self.behaviors
+        behavior_idx = pd.Index(behaviors)
+        categories = sorted(self.behavior_df[const.BEHAVIORAL_CATEGORY].astype(str).unique().tolist())
+        category_idx = pd.Index(categories)
+
+        behavior_category_counts = np.zeros((len(behaviors), len(categories)))
+        np.add.at(
+            behavior_category_counts,
+            (behavior_idx.get_indexer(self.behavior_df[const.BEHAVIOR]), category_idx.get_indexer(self.behavior_df[const.BEHAVIORAL_CATEGORY].astype(str))),
+            self.behavior_df['BEHAVIOR_COUNTS'].to_numpy(dtype=np.float64)
+        )
+        behavior_totals = behavior_category_counts.sum(axis=1, keepdims=True)
+        indicator = np.divide(behavior_category_counts, behavior_totals, out=np.zeros(behavior_category_counts.shape), where=behavior_totals > 0)
+
+        transition_counts = np.zeros((len(behaviors), len(behaviors)))
+        np.add.at(
+            transition_counts,
+            (behavior_idx.get_indexer(self.transition_df[const.BEHAVIOR]), behavior_idx.get_indexer(self.transition_df[const.BEHAVIOR_NEXT])),
+            self.transition_df['TRANSITION_COUNTS'].to_numpy(dtype=np.float64)
+        )
+        category_transitions = indicator.T @ transition_counts @ indicator
+        category_counts = behavior_category_counts.sum(axis=0)
+
+        from_idx, to_idx = np.nonzero(category_transitions > 0)
+        row_totals = category_transitions.sum(axis=1)
+        names = np.array(categories, dtype=object)
+        category_transition_df = pd.DataFrame({
+            const.BEHAVIORAL_CATEGORY: names[from_idx],
+            f'{const.BEHAVIORAL_CATEGORY}_NEXT': names[to_idx],
+            'TRANSITION_COUNTS': category_transitions[from_idx, to_idx],
+            'TRANSITION_TOTALS': row_totals[from_idx],
+            'TRANSITION_PROBABILITY': category_transitions[from_idx, to_idx] / row_totals[from_idx],
+        })
+        category_df = pd.DataFrame({
+            const.BEHAVIORAL_CATEGORY: names,
+            'BEHAVIOR_COUNTS': category_counts,
+            'BEHAVIOR_PROBABILITY': category_counts / category_counts.sum() if category_counts.sum() > 0 else category_counts,
+        })
+        return (category_transition_df, category_df)
+
+    def output_category_chain(self):
+        category_transition_df, category_df = self.category_chain()
+        output_dir, file_name = self.__output_file_location()
+        self.__write_output(f'{output_dir}/{file_name}_Category_data.csv', category_df.to_csv(index=False).encode())
+        self.__write_output(f'{output_dir}/{file_name}_Category_Transitions_data.csv', category_transition_df.to_csv(index=False).encode())
+
+    # The collapsed category chain as a single small graph (one node per category), returned as render tasks
+    def build_category_chain_graph(self) -> list[tuple[gv.Digraph | gv.Source, str, bool]]:
+        category_transition_df, category_df = self.category_chain()
+        category_colors = self.__categorical_color_map()
+        g = self.__init_new_digraph(add_label=False)
+        g.attr(label=f'{g.name}: Category Transition Probability >{self.edge_visibility_threshold * 100}%')
+        for _, row in category_df.iterrows():
+            g.node(
+                name=str(row[const.BEHAVIORAL_CATEGORY]),
+                color=category_colors.get(str(row[const.BEHAVIORAL_CATEGORY]), category_colors['DEFAULT']),
+                label=split_to_spaced(str(row[const.BEHAVIORAL_CATEGORY])),
+                fontcolor='black',
+                shape='circle',
+                style='filled',
+                penwidth='4',
+                fillcolor='white',
+                fixedsize='true',
+                width=str(constrain_value(row['BEHAVIOR_PROBABILITY'] * 10, 1.5, 3))
+            )
+        for _, row in category_transition_df.iterrows():
+            if row['TRANSITION_PROBABILITY'] < self.edge_visibility_threshold:
+                continue
+            g.edge(
+                tail_name=str(row[const.BEHAVIORAL_CATEGORY]),
+                head_name=str(row[f'{const.BEHAVIORAL_CATEGORY}_NEXT']),
+                color=category_colors.get(str(row[const.BEHAVIORAL_CATEGORY]), category_colors['DEFAULT']),
+                penwidth=str(constrain_value(row['TRANSITION_PROBABILITY'] * 20, 0.5, 7)),
+            )
+        return [(g, f'{self.output_dir_path}/{self.group_by}/{self.subject}FishBehaviorCategoryChainModel', False)]
+
+    # Mean first passage times between every pair of behaviors (see passage_utils) as a matrix:
+    # one row per source behavior, one column per target behavior, stacked by HOUR_PERFORMED for group_by=time
+    def mean_first_passage_df(self) -> pd.DataFrame:
+        behaviors = self.behaviors
+        matrices, groups = transition_matrices(self.transition_df, behaviors, self.group_by)
+        return self.__group_matrix_frames(groups, behaviors, mean_first_passage_times(matrices), behaviors)
+
+    # Probability of reaching each of absorbing_behaviors first from every behavior, and the expected number of
+    # transitions until one of them is reached (EXPECTED_STEPS), stacked by HOUR_PERFORMED for group_by=time
+    def absorption_df(self, absorbing_behaviors: list[str]) -> pd.DataFrame:
+        behaviors = self.behaviors
+        absorbing = [canonical_code(behavior) for behavior in absorbing_behaviors]
+        unknown = [behavior for behavior in absorbing if behavior not in behaviors]
+        if len(unknown):
+            raise Exception(f'Absorbing behaviors {", ".join(unknown)} do not occur in {self.input_dir_path}')
+        matrices, groups = transition_matrices(self.transition_df, behaviors, self.group_by)
+        probabilities, steps = absorption_probabilities(matrices, [behaviors.index(behavior) for behavior in absorbing])
+        return self.__group_matrix_frames(groups, behaviors, np.concatenate([probabilities, steps[:, :, None]], axis=2), absorbing + ['EXPECTED_STEPS'])
+
+    def __group_matrix_frames(self, groups: list, behaviors: list[str], matrices: np.ndarray, columns: list[str]) -> pd.DataFrame:
+        frames = []
+        for group, matrix in zip(groups, matrices):
+            frame = pd.DataFrame(matrix, columns=pd.Index(columns))
+            frame.insert(0, const.BEHAVIOR, pd.Index(behaviors))
+            if group is not None:
+                frame.insert(0, 'HOUR_PERFORMED', group)
+            frames.append(frame)
+        return pd.concat(frames, ignore_index=True)
+
+    # Writes <...>_Mean_first_passage.csv, and <...>_Absorption_probabilities.csv when absorbing behaviors are given
+    def output_first_passage(self, absorbing_behaviors: list[str] | None = None):
+        output_dir, file_name = self.__output_file_location()
+        self.__write_output(f'{output_dir}/{file_name}_Mean_first_passage.csv', self.mean_first_passage_df().to_csv(index=False).encode())
+        if absorbing_behaviors:
+            self.__write_output(f'{output_dir}/{file_name}_Absorption_probabilities.csv', self.absorption_df(absorbing_behaviors).to_csv(index=False).encode())
+
+    # The job's counts and probabilities as NumPy arrays (see matrix_api.TransitionMatrices), sharing individual_counts
+    def matrices(self) -> TransitionMatrices:
+        from utils.matrix_api import TransitionMatrices # matrix_api builds on count_utils, which imports this module
+
+        return TransitionMatrices(*self.individual_counts)
+
+    # Pooled frames with the per-individual mean/median/standard error columns added (see count_utils.cohort_frames)
+    def cohort_dfs(self) -> tuple[pd.DataFrame, pd.DataFrame]:
+        from utils.count_utils import cohort_frames
+
+        return cohort_frames(*self.individual_counts)
+
+    # Writes the cohort summaries (<...>_Cohort_Behavior_data.csv, <...>_Cohort_Transitions_data.csv) and every
+    # individual's counts as stacked arrays in <...>_Individual_matrices.npz:
+    #   transition_counts (files, behaviors, behaviors, groups), behavior_counts (files, behaviors, groups),
+    #   behaviors, groups and files (the scorelog names, in the order of the first axis)
+    def output_individuals(self):
+        encoded, counts = self.individual_counts
+        behaviors_cohort, transitions_cohort = self.cohort_dfs()[::-1]
+        output_dir, file_name = self.__output_file_location()
+        self.__write_output(f'{output_dir}/{file_name}_Cohort_Behavior_data.csv', behaviors_cohort.to_csv(index=False).encode())
+        self.__write_output(f'{output_dir}/{file_name}_Cohort_Transitions_data.csv', transitions_cohort.to_csv(index=False).encode())
+
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            transition_counts=counts['transition_counts'],
+            behavior_counts=counts['behavior_counts'],
+            behaviors=np.array(encoded.behaviors, dtype=str),
+            groups=np.array(encoded.groups, dtype=str),
+            files=np.array(encoded.file_names, dtype=str)
         )
+        self.__write_output(f'{output_dir}/{file_name}_Individual_matrices.npz', buffer.getvalue())
+
+    # One BehaviorTransitionData per scorelog, written to <output folder>/INDIVIDUALS so each can be output and graphed
+    def build_individual_data(self, color_map: dict[str, str] | None = None) -> list[BehaviorTransitionData]:
+        from utils.count_utils import counts_to_frames, file_counts_slice
+
+        encoded, counts = self.individual_counts
+        individuals = []
+        for file_idx, name in enumerate(encoded.file_names):
+            individuals.append(BehaviorTransitionData(
+                self.input_dir_path,
+                f'{self.output_dir_path}/INDIVIDUALS',
+                re.sub(r'[^\w.-]', '_', f'{self.subject}_{name}'),
+                self.environment,
+                dict(color_map if color_map is not None else self.color_map),
+                self.group_by,
+                self.edge_visibility_threshold,
+                fps=self.fps,
+                formatted_data=counts_to_frames(encoded, file_counts_slice(counts, file_idx)),
+                output_backend=self.output_backend,
+                keep_graph_sources=self.keep_graph_sources
+            ))
+        return individuals
+
+    # Distances between the transition matrices of every pair of scorelogs (see distance_utils), with hour bins or
+    # categories summed into one matrix per scorelog. Written as <...>_Distances.csv, a square table with a FILE column.
+    # With dendrogram=True the scorelogs are put in average linkage dendrogram order and the merges are written to
+    # <...>_Dendrogram.csv (LEFT and RIGHT being scorelog names or CLUSTER_<merge step>)
+    def output_distances(self, metric: str = const.JENSEN_SHANNON, dendrogram: bool = False) -> pd.DataFrame:
+        encoded, counts = self.individual_counts
+        distances = pairwise_distances(counts['transition_counts'].sum(axis=3), metric)
+        names = list(encoded.file_names)
+        order = list(range(len(names)))
+        output_dir, file_name = self.__output_file_location()
+        if dendrogram:
+            order, merges = dendrogram_order(distances)
+            label = lambda cluster: names[cluster] if cluster < len(names) else f'CLUSTER_{cluster - len(names) + 1}'
+            dendrogram_df = pd.DataFrame(
+                [(step + 1, label(left), label(right), distance, size) for step, (left, right, distance, size) in enumerate(merges)],
+                columns=pd.Index(['STEP', 'LEFT', 'RIGHT', 'DISTANCE', 'SIZE'])
+            )
+            self.__write_output(f'{output_dir}/{file_name}_Dendrogram.csv', dendrogram_df.to_csv(index=False).encode())
+
+        ordered_names = pd.Index([names[idx] for idx in order])
+        distance_df = pd.DataFrame(distances[np.ix_(order, order)], columns=ordered_names)
+        distance_df.insert(0, 'FILE', ordered_names)
+        self.__write_output(f'{output_dir}/{file_name}_Distances.csv', distance_df.to_csv(index=False).encode())
+        return distance_df
+
+    # Most frequent behavior sequences of every length in lengths (min, max) across the scorelogs (see motif_utils),
+    # the top ones of each length written to <...>_Motifs.csv
+    def output_motifs(self, lengths: tuple[int, int] = (3, 8), top: int = 20, min_support: int = 2) -> pd.DataFrame:
+        from utils.motif_utils import mine_motifs # motif_utils builds on count_utils, which imports this module
+
+        motif_df = mine_motifs(self.raw_data, lengths, top, min_support, self.fps)
+        output_dir, file_name = self.__output_file_location()
+        self.__write_output(f'{output_dir}/{file_name}_Motifs.csv', motif_df.to_csv(index=False).encode())
+        return motif_df
+
+    # Lag sequential analysis of the scorelogs for lags 1 to max_lag (see lag_utils), written as <...>_Lag_sequential.csv
+    # Returns the table so it can be passed on to build_lag_graphs
+    def output_lag_sequential(self, max_lag: int, statistic: str = const.ADJUSTED_RESIDUAL, significance: float = 1.96) -> pd.DataFrame:
+        from utils.lag_utils import lag_sequential_table # lag_utils builds on count_utils, which imports this module
+
+        lag_df = lag_sequential_table(self.raw_data, max_lag, self.group_by, self.fps, statistic, significance)
+        output_dir, file_name = self.__output_file_location()
+        self.__write_output(f'{output_dir}/{file_name}_Lag_sequential.csv', lag_df.to_csv(index=False).encode())
+        return lag_df
+
+    # Actor -> partner interaction data of every pair of subjects in the scorelogs (see interaction_utils), one
+    # BehaviorTransitionData per pair written to <output folder>/INTERACTIONS, so they are output and graphed like any job
+    def build_interaction_data(
+        self,
+        window: float,
+        subject_column: str = 'Subject',
+        color_map: dict[str, str] | None = None
+    ) -> list[BehaviorTransitionData]:
+        from utils.interaction_utils import interaction_frames # interaction_utils imports this module
+
+        # Compact scorelogs don't keep the subject column (see PipelineJob.needs_frames)
+        if not isinstance(self.raw_data, dict):
+            raise Exception('Interactions need the scorelogs as DataFrames')
+        interactions = []
+        for (actor, partner), formatted in interaction_frames(self.raw_data, window, subject_column, self.fps).items():
+            interactions.append(BehaviorTransitionData(
+                self.input_dir_path,
+                f'{self.output_dir_path}/INTERACTIONS',
+                re.sub(r'[^\w.-]', '_', f'{actor}_to_{partner}'),
+                self.environment,
+                dict(color_map if color_map is not None else self.color_map),
+                const.BASIC,
+                self.edge_visibility_threshold,
+                fps=self.fps,
+                formatted_data=formatted,
+                output_backend=self.output_backend,
+                keep_graph_sources=self.keep_graph_sources
+            ))
+        return interactions
+
+    # One graph per lag (and hour, for group_by=time) from an output_lag_sequential table, returned as render tasks
+    # Only significant edges are drawn: solid when the behavior follows more often than chance, dashed when less often
+    def build_lag_graphs(self, lag_df: pd.DataFrame, significance: float = 1.96) -> list[tuple[gv.Digraph | gv.Source, str, bool]]:
+        output_dir = f'{self.output_dir_path}/{self.group_by}/Lags'
+        hours = sorted(lag_df['HOUR_PERFORMED'].unique().tolist()) if 'HOUR_PERFORMED' in lag_df.columns else [None]
+        render_tasks: list[tuple[gv.Digraph | gv.Source, str, bool]] = []
+        for lag in sorted(lag_df['LAG'].unique().tolist()):
+            for hour in hours:
+                if hour is not None and hour > 3:
+                    continue
+                lag_rows = lag_df[(lag_df['LAG'] == lag) & ((lag_df['HOUR_PERFORMED'] == hour) if hour is not None else True)]
+                g = self.__init_new_digraph(add_label=False, hour=hour)
+                g.attr(label=f'{g.name}: Lag {lag} Transitions, |z| >= {significance}')
+
+                observed_rows = lag_rows[lag_rows['OBSERVED'] > 0]
+                for behavior in sorted(set(observed_rows[const.BEHAVIOR]) | set(observed_rows[const.BEHAVIOR_NEXT])):
+                    g.node(
+                        name=behavior,
+                        color=self.__get_color(behavior),
+                        label=' ',
+                        shape='circle',
+                        style='filled',
+                        penwidth='4',
+                        fillcolor='white',
+                        fixedsize='true',
+                        width='1'
+                    )
+                for _, row in lag_rows[lag_rows['SIGNIFICANT'] != 0].iterrows():
+                    g.edge(
+                        tail_name=str(row[const.BEHAVIOR]),
+                        head_name=str(row[const.BEHAVIOR_NEXT]),
+                        color=self.__get_color(str(row[const.BEHAVIOR])),
+                        penwidth=str(constrain_value(abs(row['Z_SCORE']) / 2, 0.5, 7)),
+                        style='solid' if row['SIGNIFICANT'] > 0 else 'dashed'
+                    )
+
+                file_name = f'{self.subject}FishBehavior{self.environment}Lag{lag}Model'
+                file_name += f'Hour{hour}' if hour is not None else ''
+                render_tasks.append((g, f'{output_dir}/{file_name}', False))
+        return render_tasks
 
 
+    def __categorical_color_map(self) -> dict[str, str]:
+        return {
+            'AGGRESSIVE': '#e7298a', # pinkish red
+            'REPRODUCTIVE': '#a6ce69', # olive green
+            'AVERSIVE': '#8c564b', # brown
+            'DEFAULT': '000000', # black
+            'ENV_YELLOW': self.color_map['ENV_YELLOW'],
+            'ENV_BLUE': self.color_map['ENV_BLUE'],
+        }
+
     def __get_color(self, key: str, default: str = 'antiquewhite') -> str:
         return self.color_map[key] if self.color_map.get(key) is not None else default
 
@@ -364,69 +888,188 @@ class BehaviorTransitionData:
         return g
 
 
-def import_data_from_dir(dir_path: str, column_names: list[str] = []) -> dict[str, pd.DataFrame]:
-    df: dict[str, pd.DataFrame] = {}
-    filenames = [filename for filename in os.listdir(dir_path) if filename.endswith('.csv') or filename.endswith('.tsv')]
-    for filename in filenames:
-        name, ext = filename.split('.')
-        if ext == 'csv':
-            temp_df = pd.read_csv(os.path.join(dir_path, filename))
-            df[name] = pd.DataFrame(temp_df[column_names]) if len(column_names) else temp_df.copy()
-        elif ext == 'tsv':
-            temp_df = pd.read_csv(os.path.join(dir_path, filename), sep='\t')
-            df[name] = pd.DataFrame(temp_df[column_names]) if len(column_names) else temp_df.copy()
+# Fingerprint of an input folder's data files based on their names, sizes and modification times
+# Changes whenever a file is added, removed or rewritten
+def input_fingerprint(dir_path: str) -> str:
+    digest = hashlib.sha256()
+    for filename in list_data_files(dir_path):
+        stat = os.stat(os.path.join(dir_path, filename))
+        digest.update(f'{filename}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+
+# In-process memo of formatted results so that jobs sharing an input folder and group_by
+# (e.g. jobs that only differ by COLOR_MAP or ATTACH_LEGEND) skip re-reading and re-formatting the data.
+# The least recently used entry is evicted once FORMATTED_DATA_CACHE_SIZE entries are held.
+# Cached frames are shared between BehaviorTransitionData objects, so treat them as read-only
+FORMATTED_DATA_CACHE_SIZE: int = 8
+_formatted_data_cache: OrderedDict[tuple, tuple[pd.DataFrame, pd.DataFrame, dict[str, str]]] = OrderedDict()
+_formatted_data_cache_lock = threading.Lock()
+
+def formatted_data_cache_key(input_dir_path: str, group_by: str = 'BASIC', fps: float | None = None) -> tuple:
+    return (os.path.abspath(input_dir_path), input_fingerprint(input_dir_path), group_by, fps)
+
+def get_cached_formatted_data(cache_key: tuple) -> tuple[pd.DataFrame, pd.DataFrame, dict[str, str]] | None:
+    with _formatted_data_cache_lock:
+        if cache_key not in _formatted_data_cache:
+            return None
+        _formatted_data_cache.move_to_end(cache_key)
+        return _formatted_data_cache[cache_key]
+
+def cache_formatted_data(cache_key: tuple, result: tuple[pd.DataFrame, pd.DataFrame, dict[str, str]]):
+    with _formatted_data_cache_lock:
+        _formatted_data_cache[cache_key] = result
+        _formatted_data_cache.move_to_end(cache_key)
+        while len(_formatted_data_cache) > FORMATTED_DATA_CACHE_SIZE:
+            _formatted_data_cache.popitem(last=False)
+
+def clear_formatted_data_cache():
+    with _formatted_data_cache_lock:
+        _formatted_data_cache.clear()
+
+
+@overload
+def import_data_from_dir(
+    dir_path: str,
+    column_names: list[str] = ...,
+    max_workers: int | None = ...,
+    use_processes: bool = ...,
+    max_in_flight: int | None = ...,
+    errors: dict[str, str] | None = ...,
+    convert: None = ...
+) -> dict[str, pd.DataFrame]: ...
+@overload
+def import_data_from_dir(
+    dir_path: str,
+    column_names: list[str] = ...,
+    max_workers: int | None = ...,
+    use_processes: bool = ...,
+    max_in_flight: int | None = ...,
+    errors: dict[str, str] | None = ...,
+    *,
+    convert: Callable[[str, pd.DataFrame], Converted]
+) -> dict[str, Converted]: ...
+def import_data_from_dir(
+    dir_path: str,
+    column_names: list[str] = [],
+    max_workers: int | None = None,
+    use_processes: bool = False,
+    max_in_flight: int | None = None,
+    errors: dict[str, str] | None = None,
+    convert: Callable[[str, pd.DataFrame], Any] | None = None
+) -> dict[str, Any]:
+    # Files are read concurrently since per-file latency (network shares especially) dominates the load time.
+    # Set use_processes to parse large files in separate processes instead of threads.
+    # At most max_in_flight reads are pending at once. Every result is kept until the folder is read, so memory is
+    # only bounded when convert shrinks each one.
+    # Files that fail to load are recorded in errors (filename -> message) rather than failing the whole folder.
+    # Compressed files and archives are supported, see input_utils
+    # convert(name, df) is applied to every scorelog as soon as its file is read, and its results are returned instead
+    filenames = list_data_files(dir_path)
+    if max_workers is None:
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+    if max_in_flight is None:
+        max_in_flight = max_workers * 2
+
+    loaded: list[dict[str, Any] | None] = [None] * len(filenames)
+    failed: dict[str, str] = {}
+    executor_type = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_type(max_workers=max_workers) as executor:
+        in_flight: dict[Future, int] = {}
+        next_idx = 0
+        while next_idx < len(filenames) or len(in_flight):
+            while next_idx < len(filenames) and len(in_flight) < max_in_flight:
+                file_path = os.path.join(dir_path, filenames[next_idx])
+                in_flight[executor.submit(read_data_source, file_path, column_names)] = next_idx
+                next_idx += 1
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx = in_flight.pop(future)
+                try:
+                    frames, member_errors = future.result()
+                    failed.update(member_errors)
+                    loaded[idx] = frames if convert is None else { name: convert(name, file_df) for name, file_df in frames.items() }
+                except Exception as e:
+                    failed[filenames[idx]] = f'{type(e).__name__}: {e}'
+
+    # Results are keyed in sorted filename order regardless of which file finished first
+    # A name that is already taken (e.g. log.csv next to log.csv.gz) keeps its full file name instead
+    df: dict[str, Any] = {}
+    for filename, frames in zip(filenames, loaded):
+        stem = data_file_stem(filename)
+        for name, file_df in (frames or {}).items():
+            df[name if name not in df else filename + name[len(stem):]] = file_df
+
+    if errors is not None:
+        errors.update(failed)
+    else:
+        for filename, message in failed.items():
+            print(f'Skipped {os.path.join(dir_path, filename)} ({message})')
 
     return df
 
 
-def format_data(df_map: dict[str, pd.DataFrame], group_by: str = '') -> tuple[pd.DataFrame, pd.DataFrame]:
+
+def format_data(df_map: dict[str, pd.DataFrame], group_by: str = '', fps: float | None = None) -> tuple[pd.DataFrame, pd.DataFrame]:
     transitions = {}
     behaviors = {}
-    for idx, (name, sub_df) in enumerate(df_map.items()):
-        sub_transition = pd.DataFrame()
-        sub_behavior = pd.DataFrame()
-
-        sub_transition[const.BEHAVIOR] = sub_df['Behavior'].map(lambda x: upper_snake(str(x)))
-        if group_by == const.BEHAVIORAL_CATEGORY:
-            sub_transition[const.BEHAVIORAL_CATEGORY] = sub_df['Behavioral category'].map(lambda x: upper_snake(str(x)))
-
-        t_idx_label = sub_transition[sub_transition['BEHAVIOR'] == 'OUT_OF_VIEW'].index
-        # You can ignore the generated warning below. The above variable works fine as an argument
-        sub_transition.drop(t_idx_label, inplace=True)
-
-        sub_behavior['BEHAVIOR'] = sub_transition['BEHAVIOR'].copy()
-        if group_by == const.BEHAVIORAL_CATEGORY:
-            sub_behavior[const.BEHAVIORAL_CATEGORY] = sub_transition[const.BEHAVIORAL_CATEGORY].copy()
-
-        sub_transition['BEHAVIOR_NEXT'] = sub_transition['BEHAVIOR'].shift(-1)
-
-        # comment line below when we figure out minutes to seconds conversions
-        if sub_df.get('frame') is not None:
-            sub_df['Time'] = sub_df['Time'].map(lambda _: 1)
-        time_next = sub_df['Time'].shift(-1)
-        sub_transition['BEHAVIOR_DURATION'] = time_next - sub_df['Time']
-        sub_behavior['BEHAVIOR_DURATION'] = time_next = sub_df['Time']
-
-        if group_by == 'TIME':
-            sub_behavior['HOUR_PERFORMED'] = sub_df['Time'].transform(lambda x: math.ceil(x / 3600))
-            sub_transition['HOUR_PERFORMED'] = sub_df['Time'].transform(lambda x: math.ceil(x / 3600))
-
-            transitions[name] = sub_transition.groupby(['BEHAVIOR', 'BEHAVIOR_NEXT', 'HOUR_PERFORMED']).count()
-            behaviors[name] = sub_behavior.groupby(['BEHAVIOR', 'HOUR_PERFORMED']).count()
-        elif group_by == 'BEHAVIORAL_CATEGORY':
-            transitions[name] = sub_transition.groupby([const.BEHAVIOR, const.BEHAVIOR_NEXT, const.BEHAVIORAL_CATEGORY]).count()
-            behaviors[name] = sub_behavior.groupby([const.BEHAVIOR, const.BEHAVIORAL_CATEGORY]).count()
-        else:
-            transitions[name] = sub_transition.groupby(['BEHAVIOR', 'BEHAVIOR_NEXT']).count()
-            behaviors[name] = sub_behavior.groupby(['BEHAVIOR']).count()
+    for name, sub_df in df_map.items():
+        transitions[name], behaviors[name] = count_scorelog(sub_df, group_by, fps)
+
+    return pool_counts(list(transitions.values()), list(behaviors.values()), group_by)
+
+
+# Transition and behavior counts of a single scorelog, grouped by the group_by keys
+# format_data pools these over every file of a folder with pool_counts
+def count_scorelog(sub_df: pd.DataFrame, group_by: str = '', fps: float | None = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    sub_transition = pd.DataFrame()
+    sub_behavior = pd.DataFrame()
+
+    sub_transition[const.BEHAVIOR] = canonicalize_column(sub_df.loc[:, 'Behavior'])
+    if group_by == const.BEHAVIORAL_CATEGORY:
+        sub_transition[const.BEHAVIORAL_CATEGORY] = canonicalize_column(sub_df.loc[:, 'Behavioral category'])
+
+    t_idx_label = sub_transition[sub_transition['BEHAVIOR'] == 'OUT_OF_VIEW'].index
+    # You can ignore the generated warning below. The above variable works fine as an argument
+    sub_transition.drop(t_idx_label, inplace=True)
 
-        transitions[name].rename(columns={ 'BEHAVIOR_DURATION': 'TRANSITION_COUNTS' }, inplace=True)
-        behaviors[name].rename(columns={ 'BEHAVIOR_DURATION': 'BEHAVIOR_COUNTS' }, inplace=True)
+    sub_behavior['BEHAVIOR'] = sub_transition['BEHAVIOR'].copy()
+    if group_by == const.BEHAVIORAL_CATEGORY:
+        sub_behavior[const.BEHAVIORAL_CATEGORY] = sub_transition[const.BEHAVIORAL_CATEGORY].copy()
 
-    transition_dataframe = pd.concat(transitions.values(), sort=False)
+    sub_transition['BEHAVIOR_NEXT'] = sub_transition['BEHAVIOR'].shift(-1)
+
+    time_seconds = pd.Series(normalize_time_column(sub_df, fps), index=sub_df.index)
+    time_next = time_seconds.shift(-1)
+    sub_transition['BEHAVIOR_DURATION'] = time_next - time_seconds
+    sub_behavior['BEHAVIOR_DURATION'] = time_seconds
+
+    if group_by == 'TIME':
+        hour_performed = pd.Series(seconds_to_hour_bins(time_seconds.to_numpy()), index=sub_df.index)
+        sub_behavior['HOUR_PERFORMED'] = hour_performed
+        sub_transition['HOUR_PERFORMED'] = hour_performed
+
+        transition_counts = sub_transition.groupby(['BEHAVIOR', 'BEHAVIOR_NEXT', 'HOUR_PERFORMED']).count()
+        behavior_counts = sub_behavior.groupby(['BEHAVIOR', 'HOUR_PERFORMED']).count()
+    elif group_by == 'BEHAVIORAL_CATEGORY':
+        transition_counts = sub_transition.groupby([const.BEHAVIOR, const.BEHAVIOR_NEXT, const.BEHAVIORAL_CATEGORY]).count()
+        behavior_counts = sub_behavior.groupby([const.BEHAVIOR, const.BEHAVIORAL_CATEGORY]).count()
+    else:
+        transition_counts = sub_transition.groupby(['BEHAVIOR', 'BEHAVIOR_NEXT']).count()
+        behavior_counts = sub_behavior.groupby(['BEHAVIOR']).count()
+
+    transition_counts.rename(columns={ 'BEHAVIOR_DURATION': 'TRANSITION_COUNTS' }, inplace=True)
+    behavior_counts.rename(columns={ 'BEHAVIOR_DURATION': 'BEHAVIOR_COUNTS' }, inplace=True)
+    return (transition_counts, behavior_counts)
+
+
+# Sums per-file counts from count_scorelog into the pooled frames returned by format_data
+def pool_counts(transitions: list[pd.DataFrame], behaviors: list[pd.DataFrame], group_by: str = '') -> tuple[pd.DataFrame, pd.DataFrame]:
+    transition_dataframe = pd.concat(transitions, sort=False)
     transition_dataframe.fillna(0, inplace=True)
 
-    behavior_dataframe = pd.concat(behaviors.values(), sort=False)
+    behavior_dataframe = pd.concat(behaviors, sort=False)
     behavior_dataframe.fillna(0, inplace=True)
 
     if group_by == const.TIME:
@@ -435,7 +1078,27 @@ def format_data(df_map: dict[str, pd.DataFrame], group_by: str = '') -> tuple[pd
 
         behavior_dataframe = pd.DataFrame(behavior_dataframe.groupby(['BEHAVIOR', 'HOUR_PERFORMED']).sum())
         behavior_dataframe.reset_index(level=[0, 1], inplace=True)
+    elif group_by == const.BEHAVIORAL_CATEGORY:
+        transition_dataframe = pd.DataFrame(transition_dataframe.groupby([const.BEHAVIOR, const.BEHAVIOR_NEXT, const.BEHAVIORAL_CATEGORY]).sum())
+        transition_dataframe.reset_index(level=[0, 1, 2], inplace=True)
 
+        behavior_dataframe = pd.DataFrame(behavior_dataframe.groupby([const.BEHAVIOR, const.BEHAVIORAL_CATEGORY]).sum())
+        behavior_dataframe.reset_index(level=[0, 1], inplace=True)
+    else:
+        transition_dataframe = pd.DataFrame(transition_dataframe.groupby(['BEHAVIOR', 'BEHAVIOR_NEXT']).sum())
+        transition_dataframe.reset_index(level=[0, 1], inplace=True)
+
+        behavior_dataframe = pd.DataFrame(behavior_dataframe.groupby(['BEHAVIOR']).sum())
+        behavior_dataframe.reset_index(level=[0], inplace=True)
+
+    add_probability_columns(transition_dataframe, behavior_dataframe, group_by)
+    return (transition_dataframe, behavior_dataframe)
+
+
+# Adds the totals/probability columns to pooled TRANSITION_COUNTS/BEHAVIOR_COUNTS frames (in place)
+# Shared by format_data and the array based counting in count_utils so both produce the same columns
+def add_probability_columns(transition_dataframe: pd.DataFrame, behavior_dataframe: pd.DataFrame, group_by: str = ''):
+    if group_by == const.TIME:
         transition_dataframe['TRANSITION_TOTALS'] = transition_dataframe.groupby(['BEHAVIOR', 'HOUR_PERFORMED'])[['TRANSITION_COUNTS']].transform('sum')
         transition_dataframe['TRANSITION_PROBABILITY'] = transition_dataframe['TRANSITION_COUNTS'] / transition_dataframe['TRANSITION_TOTALS']
         transition_dataframe['ALL_TRANSITION_TOTALS_BY_HOUR'] = transition_dataframe.groupby(['HOUR_PERFORMED'])[['TRANSITION_COUNTS']].transform('sum')
@@ -443,12 +1106,6 @@ def format_data(df_map: dict[str, pd.DataFrame], group_by: str = '') -> tuple[pd
         behavior_dataframe['ALL_BEHAVIOR_TOTALS_BY_HOUR'] = behavior_dataframe.groupby(['HOUR_PERFORMED'])[['BEHAVIOR_COUNTS']].transform('sum')
         behavior_dataframe['BEHAVIOR_PROBABILITY'] = behavior_dataframe['BEHAVIOR_COUNTS'] / behavior_dataframe['ALL_BEHAVIOR_TOTALS_BY_HOUR']
     elif group_by == const.BEHAVIORAL_CATEGORY:
-        transition_dataframe = pd.DataFrame(transition_dataframe.groupby([const.BEHAVIOR, const.BEHAVIOR_NEXT, const.BEHAVIORAL_CATEGORY]).sum())
-        transition_dataframe.reset_index(level=[0, 1, 2], inplace=True)
-
-        behavior_dataframe = pd.DataFrame(behavior_dataframe.groupby([const.BEHAVIOR, const.BEHAVIORAL_CATEGORY]).sum())
-        behavior_dataframe.reset_index(level=[0, 1], inplace=True)
-
         transition_dataframe['TRANSITION_TOTALS'] = transition_dataframe.groupby([const.BEHAVIOR, const.BEHAVIORAL_CATEGORY])[['TRANSITION_COUNTS']].transform('sum')
         transition_dataframe['TRANSITION_PROBABILITY'] = transition_dataframe['TRANSITION_COUNTS'] / transition_dataframe['TRANSITION_TOTALS']
         transition_dataframe['ALL_TRANSITIONS_TOTAL'] = transition_dataframe['TRANSITION_COUNTS'].sum()
@@ -456,12 +1113,6 @@ def format_data(df_map: dict[str, pd.DataFrame], group_by: str = '') -> tuple[pd
         behavior_dataframe['ALL_BEHAVIORS_TOTAL'] = behavior_dataframe['BEHAVIOR_COUNTS'].sum()
         behavior_dataframe['BEHAVIOR_PROBABILITY'] = behavior_dataframe['BEHAVIOR_COUNTS'] / behavior_dataframe['ALL_BEHAVIORS_TOTAL']
     else:
-        transition_dataframe = pd.DataFrame(transition_dataframe.groupby(['BEHAVIOR', 'BEHAVIOR_NEXT']).sum())
-        transition_dataframe.reset_index(level=[0, 1], inplace=True)
-
-        behavior_dataframe = pd.DataFrame(behavior_dataframe.groupby(['BEHAVIOR']).sum())
-        behavior_dataframe.reset_index(level=[0], inplace=True)
-
         transition_dataframe['TRANSITION_TOTALS'] = transition_dataframe.groupby(['BEHAVIOR'])[['TRANSITION_COUNTS']].transform('sum')
         transition_dataframe['TRANSITION_PROBABILITY'] = transition_dataframe['TRANSITION_COUNTS'] / transition_dataframe['TRANSITION_TOTALS']
         transition_dataframe['ALL_TRANSITIONS_TOTAL'] = transition_dataframe['TRANSITION_COUNTS'].sum()
@@ -469,8 +1120,26 @@ def format_data(df_map: dict[str, pd.DataFrame], group_by: str = '') -> tuple[pd
         behavior_dataframe['ALL_BEHAVIORS_TOTAL'] = behavior_dataframe['BEHAVIOR_COUNTS'].sum()
         behavior_dataframe['BEHAVIOR_PROBABILITY'] = behavior_dataframe['BEHAVIOR_COUNTS'] / behavior_dataframe['ALL_BEHAVIORS_TOTAL']
 
-    return (transition_dataframe, behavior_dataframe)
 
+# Serializes a DataFrame as Parquet or Arrow IPC. pyarrow is only needed (and imported) when this is used
+def columnar_bytes(df: pd.DataFrame, file_format: str = const.PARQUET, compression: str = 'zstd') -> bytes:
+    try:
+        import pyarrow as pa
+        import pyarrow.feather as feather
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception(f'pyarrow is required to write {file_format} files. Install it with `python3 -m pip install pyarrow`')
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    if file_format.upper() == const.PARQUET:
+        pq.write_table(table, sink, compression=compression)
+    elif file_format.upper() == const.ARROW:
+        # Arrow IPC only supports lz4 and zstd compression
+        feather.write_feather(table, sink, compression=compression)
+    else:
+        raise Exception(f'Unsupported output format: {file_format}')
+    return sink.getvalue().to_pybytes()
 
 
 def constrain_value(val: float, min_val: float, max_val: float) -> float:
@@ -525,14 +1194,105 @@ def format_json_input(d: dict) -> dict[str, str | list[object]]:
         if formatted_job.get(const.ATTACH_LEGEND) is None:
             formatted_job[const.ATTACH_LEGEND] = result.get(const.GLOBAL_ATTACH_LEGEND)
 
+        if formatted_job.get(const.DATASET_FOLDER) is None:
+            formatted_job[const.DATASET_FOLDER] = result.get(const.GLOBAL_DATASET_FOLDER)
+
+        if formatted_job.get(const.OUTPUT_FORMAT) is not None:
+            formatted_job[const.OUTPUT_FORMAT] = upper_snake(formatted_job[const.OUTPUT_FORMAT])
 
-        formatted_job[const.COLOR_MAP] = { upper_snake(key): val for (key, val) in formatted_job.get(const.COLOR_MAP).items() }
+        if formatted_job.get(const.OUTPUT_BACKEND) is None:
+            formatted_job[const.OUTPUT_BACKEND] = result.get(const.GLOBAL_OUTPUT_BACKEND)
+        formatted_job[const.OUTPUT_BACKEND] = upper_snake(formatted_job.get(const.OUTPUT_BACKEND) or const.FILES)
+
+        if formatted_job.get(const.KEEP_GRAPH_SOURCES) is None:
+            formatted_job[const.KEEP_GRAPH_SOURCES] = result.get(const.GLOBAL_KEEP_GRAPH_SOURCES)
+
+        if formatted_job.get(const.SUBJECT_COLUMN) is None:
+            formatted_job[const.SUBJECT_COLUMN] = 'Subject'
+
+        if formatted_job.get(const.PER_INDIVIDUAL) is None:
+            formatted_job[const.PER_INDIVIDUAL] = bool(formatted_job.get(const.INDIVIDUAL_GRAPHS))
+
+        if formatted_job.get(const.DISTANCE_METRIC) is not None:
+            formatted_job[const.DISTANCE_METRIC] = upper_snake(formatted_job[const.DISTANCE_METRIC])
+
+        if formatted_job.get(const.LAG_STATISTIC) is not None:
+            formatted_job[const.LAG_STATISTIC] = upper_snake(formatted_job[const.LAG_STATISTIC])
+
+
+        formatted_job[const.COLOR_MAP] = { canonical_code(key): val for (key, val) in formatted_job.get(const.COLOR_MAP).items() }
         formatted_job[const.GROUP_BY] = upper_snake(formatted_job.get(const.GROUP_BY))
 
         result[const.JOBS][idx] = formatted_job
 
     return result
 
+# Checks a raw (not yet formatted) config for problems that would make jobs fail, without reading any scorelogs
+# Returns a list of problems, empty when the config is valid
+def validate_config(d: dict) -> list[str]:
+    if not isinstance(d, dict):
+        return ['the config must be a JSON object']
+    config = { key.upper(): val for (key, val) in d.items() }
+    jobs = config.get(const.JOBS)
+    if not isinstance(jobs, list) or len(jobs) == 0:
+        return ['"jobs" must be a non-empty list']
+
+    problems = []
+    job_names = set()
+    for idx, job in enumerate(jobs):
+        if not isinstance(job, dict):
+            problems.append(f'job #{idx + 1} must be a JSON object')
+            continue
+        job = { key.upper(): val for (key, val) in job.items() }
+        title = f'job #{idx + 1}{f" ({job[const.JOB_NAME]})" if job.get(const.JOB_NAME) else ""}'
+        # Job names name the jobs' dataset parts, so two jobs with the same name would overwrite each other's part
+        if job.get(const.JOB_NAME):
+            if job[const.JOB_NAME] in job_names:
+                problems.append(f'{title} has the same job_name as an earlier job')
+            job_names.add(job[const.JOB_NAME])
+        input_folder = job.get(const.INPUT_FOLDER) or config.get(const.GLOBAL_INPUT_FOLDER)
+        if input_folder is None:
+            problems.append(f'{title} has no input_folder (and there is no global_input_folder)')
+        elif not os.path.isdir(input_folder):
+            problems.append(f'{title} input folder {input_folder} does not exist')
+        if (job.get(const.OUTPUT_FOLDER) or config.get(const.GLOBAL_OUTPUT_FOLDER)) is None:
+            problems.append(f'{title} has no output_folder (and there is no global_output_folder)')
+        if not isinstance(job.get(const.COLOR_MAP), dict):
+            problems.append(f'{title} needs a color_map object')
+        if job.get(const.GROUP_BY) is not None and upper_snake(job[const.GROUP_BY]) not in [const.BASIC, const.TIME, const.BEHAVIORAL_CATEGORY]:
+            problems.append(f'{title} has an unknown group_by "{job[const.GROUP_BY]}"')
+        if job.get(const.OUTPUT_FORMAT) is not None and upper_snake(job[const.OUTPUT_FORMAT]) not in [const.CSV, const.PARQUET, const.ARROW]:
+            problems.append(f'{title} has an unknown output_format "{job[const.OUTPUT_FORMAT]}"')
+        output_backend = job.get(const.OUTPUT_BACKEND) or config.get(const.GLOBAL_OUTPUT_BACKEND)
+        if output_backend is not None and upper_snake(output_backend) not in [const.FILES, const.ZIP, const.TAR, const.CONTENT_ADDRESSED]:
+            problems.append(f'{title} has an unknown output_backend "{output_backend}"')
+        lag = job.get(const.LAG_SEQUENTIAL)
+        if lag is not None and (isinstance(lag, bool) or not isinstance(lag, int) or lag < 1):
+            problems.append(f'{title} lag_sequential must be a whole number of at least 1')
+        if job.get(const.LAG_STATISTIC) is not None and upper_snake(job[const.LAG_STATISTIC]) not in [const.ADJUSTED_RESIDUAL, const.ALLISON_LIKER]:
+            problems.append(f'{title} has an unknown lag_statistic "{job[const.LAG_STATISTIC]}"')
+        motif_lengths = job.get(const.MOTIF_LENGTHS)
+        if motif_lengths is not None and (
+            not isinstance(motif_lengths, list) or len(motif_lengths) != 2 or not all(isinstance(length, int) and length >= 1 for length in motif_lengths)
+            or motif_lengths[0] > motif_lengths[1]
+        ):
+            problems.append(f'{title} motif_lengths must be [shortest, longest] with 1 <= shortest <= longest')
+        absorbing = job.get(const.ABSORBING_BEHAVIORS)
+        if absorbing is not None and (not isinstance(absorbing, list) or not all(isinstance(behavior, str) for behavior in absorbing)):
+            problems.append(f'{title} absorbing_behaviors must be a list of behavior names')
+        if job.get(const.DISTANCE_METRIC) is not None and upper_snake(job[const.DISTANCE_METRIC]) not in [const.FROBENIUS, const.JENSEN_SHANNON, const.KL]:
+            problems.append(f'{title} has an unknown distance_metric "{job[const.DISTANCE_METRIC]}"')
+        for flag in [const.PER_INDIVIDUAL, const.INDIVIDUAL_GRAPHS, const.DENDROGRAM_ORDER]:
+            if job.get(flag) is not None and not isinstance(job[flag], bool):
+                problems.append(f'{title} {flag.lower()} must be true or false')
+        window = job.get(const.INTERACTION_WINDOW)
+        if window is not None and (isinstance(window, bool) or not isinstance(window, (int, float)) or window <= 0):
+            problems.append(f'{title} interaction_window must be a positive number of seconds')
+        fps = job.get(const.FPS)
+        if fps is not None and (isinstance(fps, bool) or not isinstance(fps, (int, float)) or fps <= 0):
+            problems.append(f'{title} fps must be a positive number')
+    return problems
+
 # Formats strings from 'xxxx xxxx xxxx' to 'XXXX_XXXX_XXXX'
 def upper_snake(s: str) -> str:
     return '_'.join(str(s).upper().split(' '))
@@ -541,6 +1301,26 @@ def upper_snake(s: str) -> str:
 def split_to_spaced(s: str) -> str:
     return ' '.join(str(s).lower().capitalize().split('_'))
 
+# Canonical behavior/category codes ('Flee from \\u2642' -> 'FLEE_FROM_\\U2642')
+# Cached so every distinct raw value is only ever normalized once per process
+@functools.cache
+def canonical_code(value: str) -> str:
+    return upper_snake(value)
+
+# Canonicalizes a whole column by normalizing its unique values only and mapping the results back onto the rows
+def canonicalize_column(col: pd.Series) -> pd.Series:
+    codes, uniques = pd.factorize(col, use_na_sentinel=False)
+    canonical = np.array([canonical_code(str(val)) for val in uniques], dtype=object)
+    return pd.Series(canonical[codes], index=col.index, name=col.name)
+
+UNICODE_ESCAPE_PATTERN: re.Pattern = re.compile(r'\\u([0-9a-f]{4})')
+
+# Formats canonical codes for display, decoding any escaped unicode characters left in the raw data
+# Example: 'CHASE_\\U2640' -> 'Chase \u2640'
+@functools.cache
+def behavior_display_name(code: str) -> str:
+    return UNICODE_ESCAPE_PATTERN.sub(lambda m: chr(int(m.group(1), 16)), split_to_spaced(code))
+
 def map_two_columns(df: pd.DataFrame, keys_col: str, values_col: str) -> dict[str, list[str]]:
     results = dict()
     df_dict = df.to_dict('records')
@@ -558,4 +1338,36 @@ def hms_to_seconds(time_str: str, no_hours: bool = False) -> float:
         mapped_over.insert(0, 0)
     h, m, s = mapped_over
 
-    return h * 3600 + m * 60 + s
\ No newline at end of file
+    return h * 3600 + m * 60 + s
+
+# Vectorized hms_to_seconds for a whole column of 'HH:MM:SS(.fff)', 'MM:SS(.fff)' or plain seconds strings
+def hms_to_seconds_array(values: pd.Series) -> np.ndarray:
+    parts = values.astype(str).str.strip().str.split(':', expand=True)
+    fields = parts.astype(np.float64).to_numpy()
+    field_counts = parts.notna().sum(axis=1).to_numpy()
+
+    # Fields are left aligned after the split, so the last present field of each row is seconds, the one before it minutes, etc
+    exponents = field_counts[:, None] - 1 - np.arange(fields.shape[1])
+    weighted = fields * np.power(60.0, np.clip(exponents, 0, None))
+    return np.where(exponents >= 0, weighted, 0.0).sum(axis=1)
+
+# Converts a scorelog's time information into float seconds
+# Frame indices are used when an fps is provided, otherwise the Time column is read as numeric seconds or 'HH:MM:SS(.fff)' strings
+def normalize_time_column(df: pd.DataFrame, fps: float | None = None) -> np.ndarray:
+    if fps is not None and 'frame' in df.columns:
+        return df['frame'].to_numpy(dtype=np.float64) / fps
+
+    time_col = df.loc[:, 'Time']
+    if pd.api.types.is_numeric_dtype(time_col):
+        return time_col.to_numpy(dtype=np.float64)
+    try:
+        return hms_to_seconds_array(time_col)
+    except ValueError as e:
+        hint = ' (set "fps" for this job to use the frame column instead)' if 'frame' in df.columns else ''
+        raise ValueError(f'Could not convert Time column to seconds: {e}{hint}')
+
+# Hour in which each time occurred, where (0, 3600] seconds is hour 1
+def seconds_to_hour_bins(seconds: np.ndarray) -> np.ndarray:
+    if np.isnan(seconds).any():
+        raise ValueError('Time column contains missing values, so rows cannot be grouped by hour')
+    return np.ceil(seconds / 3600).astype(np.int64)
\ No newline at end of file
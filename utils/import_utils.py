@@ -0,0 +1,42 @@
+import importlib
+import threading
+from types import ModuleType
+
+# pandas, numpy and graphviz take most of the program's startup time, and graphviz is only needed when graphs are rendered.
+# Modules use them through lazy_import so they are only imported once something actually uses them:
+#   if TYPE_CHECKING:
+#       import numpy as np
+#   else:
+#       np = lazy_import('numpy')
+#   np.zeros(3)  # numpy is imported here
+# Type checkers see the real module, so type hints like np.ndarray still resolve. Modules doing this also use
+# `from __future__ import annotations`, so those hints don't trigger the import at runtime.
+
+
+class LazyModule:
+    def __init__(self, name: str, install_hint: str | None = None):
+        self.__name = name
+        self.__install_hint = install_hint
+        self.__module: ModuleType | None = None
+        self.__lock = threading.Lock()
+
+    def __load(self) -> ModuleType:
+        if self.__module is None:
+            with self.__lock:
+                if self.__module is None:
+                    try:
+                        self.__module = importlib.import_module(self.__name)
+                    except ImportError as e:
+                        hint = f' ({self.__install_hint})' if self.__install_hint is not None else ''
+                        raise ImportError(f'{self.__name} is required for this step but could not be imported{hint}: {e}') from e
+        return self.__module
+
+    def __getattr__(self, attr: str):
+        return getattr(self.__load(), attr)
+
+    def __repr__(self) -> str:
+        return f'<lazy module {self.__name}{" (loaded)" if self.__module is not None else ""}>'
+
+
+def lazy_import(name: str, install_hint: str | None = None) -> LazyModule:
+    return LazyModule(name, install_hint)
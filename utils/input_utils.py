@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import io
+import os
+import posixpath
+import tarfile
+import zipfile
+from typing import IO, TYPE_CHECKING, Literal
+
+from utils.import_utils import lazy_import
+
+if TYPE_CHECKING:
+    import pandas as pd
+else:
+    pd = lazy_import('pandas')
+zstandard = lazy_import('zstandard', 'needed to read .zst files, install it with python3 -m pip install zstandard')
+
+# Scorelogs can be kept as plain .csv/.tsv files, single compressed files (.csv.gz, .tsv.zst, ...) or bundled into
+# zip/tar archives. Everything is streamed straight into pandas.read_csv, nothing is extracted to disk:
+#   log.csv, log.tsv                        one scorelog
+#   log.csv.gz, log.csv.bz2, log.tsv.zst    one scorelog, decompressed while it is parsed
+#   bundle.zip, bundle.tar, bundle.tar.gz   every scorelog inside (which may be compressed themselves)
+# Scorelogs inside an archive are named <archive name>/<path inside the archive> (without their extensions).
+
+# Compressions of single scorelog files, as pandas names them
+Compression = Literal['gzip', 'bz2', 'zstd', 'xz']
+
+DATA_SUFFIXES: list[str] = ['.csv', '.tsv']
+COMPRESSION_SUFFIXES: dict[str, Compression] = { '.gz': 'gzip', '.bz2': 'bz2', '.zst': 'zstd', '.xz': 'xz' }
+ARCHIVE_SUFFIXES: list[str] = ['.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.tar.zst']
+# Input files are read through a large buffer so network shares see a few big reads rather than many small ones
+READ_BUFFER_BYTES: int = 1 << 20
+
+
+def archive_suffix(filename: str) -> str | None:
+    lowered = filename.lower()
+    return next((suffix for suffix in ARCHIVE_SUFFIXES if lowered.endswith(suffix)), None)
+
+
+# (name without data/compression suffixes, csv separator, pandas compression) of a scorelog file name,
+# or None if it isn't one. 'log.v2.csv.gz' -> ('log.v2', ',', 'gzip')
+def parse_data_file_name(filename: str) -> tuple[str, str, Compression | None] | None:
+    base, compression = filename, None
+    for suffix, method in COMPRESSION_SUFFIXES.items():
+        if base.lower().endswith(suffix):
+            base, compression = base[:-len(suffix)], method
+            break
+    for suffix in DATA_SUFFIXES:
+        if base.lower().endswith(suffix):
+            return (base[:-len(suffix)], '\t' if suffix == '.tsv' else ',', compression)
+    return None
+
+
+def is_data_file(filename: str) -> bool:
+    return archive_suffix(filename) is not None or parse_data_file_name(filename) is not None
+
+
+# True for files whose size on disk is not their data size (compressed files and archives)
+def is_packed_file(filename: str) -> bool:
+    parsed = parse_data_file_name(filename)
+    return parsed is None or parsed[2] is not None
+
+
+# Sorted names of the files in dir_path that import_data_from_dir will read
+def list_data_files(dir_path: str) -> list[str]:
+    return sorted(filename for filename in os.listdir(dir_path) if is_data_file(filename) and os.path.isfile(os.path.join(dir_path, filename)))
+
+
+# Name a file's scorelogs are keyed by: the file name without its extensions
+def data_file_stem(filename: str) -> str:
+    suffix = archive_suffix(filename)
+    if suffix is not None:
+        return filename[:-len(suffix)]
+    parsed = parse_data_file_name(filename)
+    return parsed[0] if parsed is not None else filename
+
+
+# Members of a tar stream can't answer seekable(), which pandas asks every file it reads
+class _ForwardOnlyReader(io.RawIOBase):
+    def __init__(self, file: IO[bytes]):
+        self.file = file
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.file.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def _read_csv(file: IO[bytes], sep: str, compression: Compression | None, column_names: list[str]) -> pd.DataFrame:
+    if compression == 'zstd':
+        # Streamed through zstandard directly, so the same code path works for files and archive members
+        file, compression = zstandard.ZstdDecompressor().stream_reader(file), None
+    temp_df = pd.read_csv(file, sep=sep, compression=compression)
+    return pd.DataFrame(temp_df[column_names]) if len(column_names) else temp_df
+
+
+# Reads one (possibly compressed) scorelog file
+def read_data_file(file_path: str, column_names: list[str] = []) -> pd.DataFrame:
+    parsed = parse_data_file_name(os.path.basename(file_path))
+    sep, compression = (parsed[1], parsed[2]) if parsed is not None else (',', None)
+    with open(file_path, 'rb', buffering=READ_BUFFER_BYTES) as file:
+        return _read_csv(file, sep, compression, column_names)
+
+
+# Reads every scorelog of a data file: just the file itself, or every scorelog inside an archive
+# Returns ({ scorelog name: DataFrame }, { archive member: error message }) in sorted name order.
+# Errors reading a plain or compressed file are raised, while a broken archive member only skips that member
+def read_data_source(file_path: str, column_names: list[str] = []) -> tuple[dict[str, pd.DataFrame], dict[str, str]]:
+    filename = os.path.basename(file_path)
+    suffix = archive_suffix(filename)
+    if suffix is None:
+        return ({ data_file_stem(filename): read_data_file(file_path, column_names) }, {})
+
+    frames: dict[str, pd.DataFrame] = {}
+    errors: dict[str, str] = {}
+
+    def read_member(member_name: str, member_file: IO[bytes]):
+        parsed = parse_data_file_name(posixpath.basename(member_name))
+        if parsed is None:
+            return
+        name = f'{data_file_stem(filename)}/{posixpath.join(posixpath.dirname(member_name), parsed[0])}'
+        try:
+            frames[name] = _read_csv(member_file, parsed[1], parsed[2], column_names)
+        except Exception as e:
+            errors[f'{filename}/{member_name}'] = f'{type(e).__name__}: {e}'
+
+    with open(file_path, 'rb', buffering=READ_BUFFER_BYTES) as file:
+        if suffix == '.zip':
+            with zipfile.ZipFile(file) as archive:
+                for member in sorted(archive.infolist(), key=lambda info: info.filename):
+                    if not member.is_dir():
+                        with archive.open(member) as member_file:
+                            read_member(member.filename, member_file)
+        else:
+            # Tar archives are read as a stream, one member after the other, so they are never seeked through
+            stream = zstandard.ZstdDecompressor().stream_reader(file) if suffix == '.tar.zst' else file
+            with tarfile.open(fileobj=stream, mode='r|' if suffix == '.tar.zst' else 'r|*') as archive:
+                for member in archive:
+                    member_file = archive.extractfile(member) if member.isfile() else None
+                    if member_file is not None:
+                        read_member(member.name, io.BufferedReader(_ForwardOnlyReader(member_file), READ_BUFFER_BYTES))
+
+    return ({ name: frames[name] for name in sorted(frames) }, errors)
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from utils import constants as const
+from utils.helper_utils import canonicalize_column, normalize_time_column, add_probability_columns
+from utils.import_utils import lazy_import
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+else:
+    np = lazy_import('numpy')
+    pd = lazy_import('pandas')
+
+# Interaction matrices for scorelogs that record several subjects in one file (e.g. the focal fish and its opponent).
+# For every ordered (actor, partner) pair, each of the actor's behaviors is paired with the partner's next behavior
+# that starts strictly after it and within window seconds, if there is one. The pairing is a single sorted as-of join
+# (pandas.merge_asof) over every file, matched by file and partner, rather than a scan over every pair of events.
+#
+# The result of each pair has the same shape as format_data's BASIC output, so it is rendered like any chain graph:
+#   BEHAVIOR -> BEHAVIOR_NEXT  the actor did BEHAVIOR and the partner responded with BEHAVIOR_NEXT
+#   BEHAVIOR_COUNTS            how often either of the two did the behavior (the graph's node sizes)
+
+DEFAULT_SUBJECT_COLUMN: str = 'Subject'
+
+
+def interaction_events(df_map: dict[str, pd.DataFrame], subject_column: str = DEFAULT_SUBJECT_COLUMN, fps: float | None = None) -> pd.DataFrame:
+    parts = []
+    for file_idx, (name, sub_df) in enumerate(df_map.items()):
+        if subject_column not in sub_df.columns:
+            raise Exception(f'{name} has no {subject_column} column, so its subjects cannot be told apart')
+        parts.append(pd.DataFrame({
+            'FILE': file_idx,
+            'TIME': normalize_time_column(sub_df, fps),
+            'ACTOR': sub_df[subject_column].astype('string').str.strip().to_numpy(),
+            const.BEHAVIOR: canonicalize_column(sub_df.loc[:, 'Behavior']).to_numpy(),
+        }))
+    if len(parts) == 0:
+        return pd.DataFrame({ 'FILE': [], 'TIME': [], 'ACTOR': [], const.BEHAVIOR: [] })
+
+    events = pd.concat(parts, ignore_index=True)
+    keep = (events[const.BEHAVIOR] != 'OUT_OF_VIEW') & events['TIME'].notna() & events['ACTOR'].notna() & (events['ACTOR'] != '')
+    return events.loc[keep].reset_index(drop=True)
+
+
+# (actor, partner) -> (transition_df, behavior_df) for every ordered pair of subjects that occur in the same file
+def interaction_frames(
+    df_map: dict[str, pd.DataFrame],
+    window: float,
+    subject_column: str = DEFAULT_SUBJECT_COLUMN,
+    fps: float | None = None
+) -> dict[tuple[str, str], tuple[pd.DataFrame, pd.DataFrame]]:
+    if window <= 0:
+        raise Exception(f'The interaction window must be a positive number of seconds, not {window}')
+    events = interaction_events(df_map, subject_column, fps)
+
+    # Each actor event is repeated once per partner it shares a file with, then joined to that partner's next event
+    subjects = events.loc[:, ['FILE', 'ACTOR']].drop_duplicates()
+    pairs = subjects.merge(subjects.rename(columns={ 'ACTOR': 'PARTNER' }), on='FILE')
+    pairs = pairs[pairs['ACTOR'] != pairs['PARTNER']]
+    actions = events.merge(pairs, on=['FILE', 'ACTOR']).sort_values('TIME', kind='stable')
+    responses = events.rename(columns={ 'ACTOR': 'PARTNER', const.BEHAVIOR: const.BEHAVIOR_NEXT }).sort_values('TIME', kind='stable')
+    matched = pd.merge_asof(
+        actions,
+        responses,
+        on='TIME',
+        by=['FILE', 'PARTNER'],
+        direction='forward',
+        tolerance=float(window), # pyright: ignore[reportArgumentType] (pandas only annotates int and Timedelta tolerances)
+        allow_exact_matches=False
+    )
+    matched = matched[matched[const.BEHAVIOR_NEXT].notna()]
+
+    transitions = matched.groupby(['ACTOR', 'PARTNER', const.BEHAVIOR, const.BEHAVIOR_NEXT]).size().to_frame('TRANSITION_COUNTS').reset_index()
+    actor_counts = events.groupby(['ACTOR', const.BEHAVIOR]).size().to_frame('BEHAVIOR_COUNTS').reset_index()
+    result: dict[tuple[str, str], tuple[pd.DataFrame, pd.DataFrame]] = {}
+    for actor, partner in sorted(set(zip(pairs['ACTOR'], pairs['PARTNER']))):
+        pair_transitions = (transitions['ACTOR'] == actor) & (transitions['PARTNER'] == partner)
+        transition_dataframe = transitions.loc[pair_transitions].drop(columns=['ACTOR', 'PARTNER']).reset_index(drop=True)
+        behavior_dataframe = pd.DataFrame(
+            actor_counts[actor_counts['ACTOR'].isin([actor, partner])].groupby(const.BEHAVIOR)['BEHAVIOR_COUNTS'].sum()
+        ).reset_index()
+
+        add_probability_columns(transition_dataframe, behavior_dataframe)
+        result[(str(actor), str(partner))] = (transition_dataframe, behavior_dataframe)
+    return result
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from utils import constants as const
+from utils.count_utils import encode_scorelogs
+from utils.import_utils import lazy_import
+from utils.scorelog_utils import ScoreLogSet
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+else:
+    np = lazy_import('numpy')
+    pd = lazy_import('pandas')
+
+# Lag sequential analysis: how often behavior B follows behavior A exactly k events later (k = 1..max_lag), compared
+# with how often it would by chance. Every lag is counted at once from the factorized code arrays (see count_utils):
+#   observed: (lags, behaviors, behaviors, groups)  [lag - 1, behavior, behavior k events later, group]
+#   expected and z scores have the same shape
+# Only pairs within the same scorelog count. OUT_OF_VIEW events are dropped before lagging, like they are for the chain
+# graphs. A lag 1 pair counts under the same rule as the transition counts of format_data (the event and the raw row
+# after it both have a time, see count_utils), so lag 1 reproduces TRANSITION_COUNTS; a lag k pair counts when each of
+# the k lag 1 steps between its events does. Groups are hour bins for group_by=time (taken from the first event
+# of a pair), everything else is analysed as one group.
+#
+# z scores are either:
+#   ADJUSTED_RESIDUAL  (x_ab - e_ab) / sqrt(e_ab * (1 - x_a+ / x_++) * (1 - x_+b / x_++)), e_ab = x_a+ * x_+b / x_++
+#   ALLISON_LIKER      (x_ab - x_a+ * p_b) / sqrt(x_a+ * p_b * (1 - p_b) * (1 - p_a)), p_a/p_b being the simple
+#                      frequencies of the behaviors (so expected counts are x_a+ * p_b)
+
+DEFAULT_SIGNIFICANCE: float = 1.96 # |z| for p < 0.05, two tailed
+
+
+# (observed lag counts, simple behavior counts) as (lags, behaviors, behaviors, groups) and (behaviors, groups) tensors
+def count_lags(arrays: dict[str, np.ndarray], n_behaviors: int, n_groups: int, max_lag: int) -> tuple[np.ndarray, np.ndarray]:
+    codes = arrays['behavior_codes'].astype(np.int64)
+    group_codes = arrays['group_codes'].astype(np.int64)
+    has_time = arrays['behavior_valid']
+    # Invalid lag 1 steps before every event, so a run of steps is valid when the count doesn't change over it
+    invalid_steps = np.concatenate([[0], np.cumsum(~arrays['transition_valid'])])
+    offsets = arrays['file_offsets']
+    file_idx = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+
+    # (events, lags) index of the event k steps later; pairs running past the end of their file are masked out
+    later = np.arange(len(codes), dtype=np.int64)[:, None] + np.arange(1, max_lag + 1, dtype=np.int64)[None, :]
+    in_range = later < len(codes)
+    later = np.minimum(later, max(len(codes) - 1, 0))
+    valid = in_range & (file_idx[later] == file_idx[:, None]) & (invalid_steps[later] == invalid_steps[:len(codes), None])
+
+    lag_idx = np.broadcast_to(np.arange(max_lag, dtype=np.int64)[None, :], later.shape)
+    keys = ((lag_idx * n_behaviors + codes[:, None]) * n_behaviors + codes[later]) * n_groups + group_codes[:, None]
+    observed = np.bincount(keys[valid], minlength=max_lag * n_behaviors * n_behaviors * n_groups)
+    behavior_counts = np.bincount((codes * n_groups + group_codes)[has_time], minlength=n_behaviors * n_groups)
+    return (observed.reshape(max_lag, n_behaviors, n_behaviors, n_groups), behavior_counts.reshape(n_behaviors, n_groups))
+
+
+# (expected counts, z scores) for observed lag counts, NaN where a z score is undefined (e.g. a behavior that never starts a pair)
+def lag_statistics(observed: np.ndarray, behavior_counts: np.ndarray, statistic: str = const.ADJUSTED_RESIDUAL) -> tuple[np.ndarray, np.ndarray]:
+    observed = observed.astype(np.float64)
+    row_totals = observed.sum(axis=2, keepdims=True) # x_a+
+    column_totals = observed.sum(axis=1, keepdims=True) # x_+b
+    totals = observed.sum(axis=(1, 2), keepdims=True) # x_++
+
+    if statistic == const.ADJUSTED_RESIDUAL:
+        row_share = np.divide(row_totals, totals, out=np.zeros(row_totals.shape), where=totals > 0)
+        column_share = np.divide(column_totals, totals, out=np.zeros(column_totals.shape), where=totals > 0)
+        expected = row_totals * column_share
+        variance = expected * (1 - row_share) * (1 - column_share)
+    elif statistic == const.ALLISON_LIKER:
+        behavior_counts = behavior_counts.astype(np.float64)
+        behavior_totals = behavior_counts.sum(axis=0, keepdims=True)
+        frequencies = np.divide(behavior_counts, behavior_totals, out=np.zeros(behavior_counts.shape), where=behavior_totals > 0)
+        p_a = frequencies[None, :, None, :]
+        p_b = frequencies[None, None, :, :]
+        expected = row_totals * p_b
+        variance = expected * (1 - p_b) * (1 - p_a)
+    else:
+        raise Exception(f'Unknown lag statistic: {statistic}')
+
+    z_scores = np.divide(observed - expected, np.sqrt(variance), out=np.full(observed.shape, np.nan), where=variance > 0)
+    return (expected, z_scores)
+
+
+# One row per (lag, [hour,] behavior, next behavior) for every behavior that starts at least one pair at that lag:
+# LAG, BEHAVIOR, BEHAVIOR_NEXT, [HOUR_PERFORMED,] OBSERVED, EXPECTED, Z_SCORE, SIGNIFICANT
+# SIGNIFICANT is 1 when z >= significance (more often than chance), -1 when z <= -significance (less often) and 0 otherwise
+def lag_sequential_table(
+    df_map: dict[str, pd.DataFrame] | ScoreLogSet,
+    max_lag: int,
+    group_by: str = '',
+    fps: float | None = None,
+    statistic: str = const.ADJUSTED_RESIDUAL,
+    significance: float = DEFAULT_SIGNIFICANCE
+) -> pd.DataFrame:
+    if max_lag < 1:
+        raise Exception(f'The maximum lag must be at least 1, not {max_lag}')
+    encoded = encode_scorelogs(df_map, const.TIME if group_by == const.TIME else '', fps)
+    n_behaviors, n_groups = len(encoded.behaviors), len(encoded.groups)
+    observed, behavior_counts = count_lags(encoded.arrays, n_behaviors, n_groups, max_lag)
+    expected, z_scores = lag_statistics(observed, behavior_counts, statistic)
+
+    # np.nonzero walks the tensors in (lag, behavior, next behavior, group) order, so rows come out sorted
+    starts_pair = np.broadcast_to(observed.sum(axis=2, keepdims=True) > 0, observed.shape)
+    lag_idx, behavior_idx, next_idx, group_idx = np.nonzero(starts_pair)
+    behaviors = np.array(encoded.behaviors, dtype=object)
+    columns = {
+        'LAG': lag_idx + 1,
+        const.BEHAVIOR: behaviors[behavior_idx],
+        const.BEHAVIOR_NEXT: behaviors[next_idx],
+    }
+    if group_by == const.TIME:
+        columns['HOUR_PERFORMED'] = np.array(encoded.groups, dtype=np.int64)[group_idx]
+    z = z_scores[lag_idx, behavior_idx, next_idx, group_idx]
+    columns['OBSERVED'] = observed[lag_idx, behavior_idx, next_idx, group_idx].astype(np.int64)
+    columns['EXPECTED'] = expected[lag_idx, behavior_idx, next_idx, group_idx]
+    columns['Z_SCORE'] = z
+    columns['SIGNIFICANT'] = np.where(z >= significance, 1, np.where(z <= -significance, -1, 0))
+    return pd.DataFrame(columns)
@@ -0,0 +1,106 @@
+import os
+import glob
+import json
+import hashlib
+
+from utils import constants as const
+from utils.helper_utils import input_fingerprint
+
+# A run manifest records, for every job of a config, what the job was built from and what it produced:
+# {
+#   "code_version": "<hash>",
+#   "jobs": {
+#     "<job key>": {
+#       "job_name": "...",
+#       "input_fingerprint": "<hash>",
+#       "code_version": "<hash>",
+#       "rendered": true,
+#       "outputs": { "<file path>": "<sha256>", ... }
+#     }
+#   }
+# }
+# The job key is a hash of the normalized job config (the output of format_json_input), so any config change
+# produces a new key. A job is up to date when its key is present, its inputs and the code are unchanged,
+# and every recorded output file is still on disk with the same contents.
+
+CODE_ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Hash of the program's own source files, so upgrading the code invalidates previous results
+def code_version() -> str:
+    digest = hashlib.sha256()
+    source_files = [os.path.join(CODE_ROOT, 'main.py')] + glob.glob(os.path.join(CODE_ROOT, 'utils', '*.py'))
+    for source_file in sorted(source_files):
+        digest.update(os.path.relpath(source_file, CODE_ROOT).encode())
+        digest.update(file_sha256(source_file).encode())
+    return digest.hexdigest()
+
+
+# Must be called before the job runs, since BehaviorTransitionData adds default entries to the job's color map
+def job_key(job: dict) -> str:
+    return hashlib.sha256(json.dumps(job, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def default_manifest_path(config_path: str) -> str:
+    return f'{os.path.splitext(config_path)[0]}.manifest.json'
+
+
+def load_manifest(manifest_path: str) -> dict:
+    if not os.path.exists(manifest_path):
+        return { 'code_version': None, 'jobs': {} }
+    with open(manifest_path) as file:
+        return json.load(file)
+
+
+# Written to a temporary file first so an interrupted run never leaves a half written manifest behind
+def save_manifest(manifest_path: str, manifest: dict):
+    manifest_dir = os.path.dirname(manifest_path)
+    if manifest_dir and not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+    with open(f'{manifest_path}.tmp', 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+
+
+# rendered is False for --no-render runs, which only write data files
+def make_manifest_entry(job: dict, fingerprint: str, version: str, output_files: list[str], rendered: bool = True) -> dict:
+    return {
+        'job_name': job.get(const.JOB_NAME),
+        'input_fingerprint': fingerprint,
+        'code_version': version,
+        'rendered': rendered,
+        'outputs': { path: file_sha256(path) for path in output_files if os.path.isfile(path) },
+    }
+
+
+# Returns None if the job can be skipped, otherwise the reason it needs to be rebuilt
+def rebuild_reason(entry: dict | None, fingerprint: str, version: str, render: bool = True) -> str | None:
+    if entry is None:
+        return 'new or changed job config'
+    if entry.get('input_fingerprint') != fingerprint:
+        return 'input files changed'
+    if entry.get('code_version') != version:
+        return 'code changed'
+    if entry.get('rendered', True) != render:
+        return 'graphs not rendered yet' if render else 'previous run rendered graphs'
+    outputs: dict[str, str] = entry.get('outputs') or {}
+    if len(outputs) == 0:
+        return 'no outputs recorded'
+    for path, digest in outputs.items():
+        if not os.path.isfile(path):
+            return f'output missing: {path}'
+        if file_sha256(path) != digest:
+            return f'output modified: {path}'
+    return None
+
+
+def job_input_fingerprint(job: dict) -> str:
+    return input_fingerprint(job[const.INPUT_FOLDER])
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import functools
+from typing import TYPE_CHECKING
+
+from utils import constants as const
+from utils.count_utils import EncodedScorelogs, encode_scorelogs, empty_counts, count_encoded_arrays
+from utils.helper_utils import upper_snake
+from utils.import_utils import lazy_import
+from utils.scorelog_utils import ScoreLogSet, import_scorelogs_from_dir
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+else:
+    np = lazy_import('numpy')
+    pd = lazy_import('pandas')
+sparse = lazy_import('scipy.sparse', 'needed for sparse matrices, install it with python3 -m pip install scipy')
+
+# Stable library API for getting the transition matrices of a folder (or of scorelogs already in memory) as NumPy
+# arrays or Arrow tables, without building DataFrames, graphs or output files:
+#   matrices = load_matrices('some/input/folder', group_by='time')
+#   matrices.behaviors                    behavior names, the row/column order of every matrix
+#   matrices.transition_probabilities()   (groups, behaviors, behaviors), row i column j = P(j follows i)
+# Importing this module has no side effects: nothing is read or written, and numpy/pandas are only imported once data
+# is loaded (pyarrow and scipy only when to_arrow/sparse_transition_counts are used). Names not in __all__ may change.
+#
+# Groups are the hour bins for group_by 'TIME', the behavioral categories for 'BEHAVIORAL_CATEGORY' and a single group
+# otherwise. The counts follow the same rules as the data tables of a job (OUT_OF_VIEW dropped, untimed rows not counted).
+# Arrays returned by the methods are cached and shared between calls, so treat them as read-only.
+
+__all__ = ['TransitionMatrices', 'load_matrices', 'matrices_from_scorelogs']
+
+
+class TransitionMatrices:
+    def __init__(self, encoded: EncodedScorelogs, counts: dict[str, np.ndarray]):
+        self.behaviors: list[str] = list(encoded.behaviors)
+        self.groups: list = list(encoded.groups) if encoded.group_by in [const.TIME, const.BEHAVIORAL_CATEGORY] else [None]
+        self.group_by: str = encoded.group_by or const.BASIC
+        self.files: list[str] = list(encoded.file_names)
+        # Per scorelog counts as counted: (files, behaviors, behaviors, groups) and (files, behaviors, groups)
+        self.file_transition_counts: np.ndarray = counts['transition_counts']
+        self.file_behavior_counts: np.ndarray = counts['behavior_counts']
+
+    @property
+    def behavior_index(self) -> dict[str, int]:
+        return { behavior: idx for idx, behavior in enumerate(self.behaviors) }
+
+    # (behaviors, behaviors, groups) counts over every scorelog. A view of the per scorelog counts when there is only one
+    @functools.cached_property
+    def __pooled_transitions(self) -> np.ndarray:
+        if len(self.files) == 1:
+            return self.file_transition_counts[0]
+        return self.file_transition_counts.sum(axis=0)
+
+    @functools.cached_property
+    def __pooled_behaviors(self) -> np.ndarray:
+        if len(self.files) == 1:
+            return self.file_behavior_counts[0]
+        return self.file_behavior_counts.sum(axis=0)
+
+    # (groups, behaviors, behaviors) transition counts, a view of the pooled counts
+    def transition_counts(self) -> np.ndarray:
+        return np.moveaxis(self.__pooled_transitions, 2, 0)
+
+    # (groups, behaviors, behaviors) row stochastic matrices, rows of behaviors that are never followed by anything are 0
+    def transition_probabilities(self) -> np.ndarray:
+        return self.__transition_probabilities
+
+    @functools.cached_property
+    def __transition_probabilities(self) -> np.ndarray:
+        counts = self.transition_counts()
+        row_totals = counts.sum(axis=2, keepdims=True)
+        return np.divide(counts, row_totals, out=np.zeros(counts.shape), where=row_totals > 0)
+
+    # (groups, behaviors) behavior counts, a view of the pooled counts
+    def behavior_counts(self) -> np.ndarray:
+        return np.moveaxis(self.__pooled_behaviors, 1, 0)
+
+    # (groups, behaviors) share of every behavior, per hour for 'TIME' and of all behaviors otherwise (like the data tables)
+    def behavior_probabilities(self) -> np.ndarray:
+        return self.__behavior_probabilities
+
+    @functools.cached_property
+    def __behavior_probabilities(self) -> np.ndarray:
+        counts = self.behavior_counts()
+        totals = counts.sum(axis=1, keepdims=True) if self.group_by == const.TIME else counts.sum(keepdims=True)
+        return np.divide(counts, totals, out=np.zeros(counts.shape), where=totals > 0)
+
+    # The (behaviors, behaviors) matrix of one group (an hour bin or category name), or of the only group
+    def matrix(self, group=None, probabilities: bool = True) -> np.ndarray:
+        matrices = self.transition_probabilities() if probabilities else self.transition_counts()
+        if group is None and len(self.groups) == 1:
+            return matrices[0]
+        if group not in self.groups:
+            raise Exception(f'Unknown group {group}, the groups are {self.groups}')
+        return matrices[self.groups.index(group)]
+
+    # Non-zero transitions as flat arrays of group, behavior and next behavior indices, with their counts
+    def nonzero_transitions(self) -> dict[str, np.ndarray]:
+        return self.__nonzero_transitions
+
+    @functools.cached_property
+    def __nonzero_transitions(self) -> dict[str, np.ndarray]:
+        counts = self.transition_counts()
+        group_idx, behavior_idx, next_idx = np.nonzero(counts)
+        return {
+            'group': group_idx,
+            'behavior': behavior_idx,
+            'behavior_next': next_idx,
+            'count': counts[group_idx, behavior_idx, next_idx],
+            'probability': self.transition_probabilities()[group_idx, behavior_idx, next_idx],
+        }
+
+    # scipy.sparse CSR matrix of the transition counts (or probabilities) of one group. Requires scipy
+    def sparse_transition_counts(self, group=None, probabilities: bool = False):
+        return sparse.csr_matrix(self.matrix(group, probabilities))
+
+    # Arrow table with one row per non-zero transition: BEHAVIOR, BEHAVIOR_NEXT, [HOUR_PERFORMED or BEHAVIORAL_CATEGORY,]
+    # TRANSITION_COUNTS, TRANSITION_PROBABILITY. Behavior names are dictionary encoded, so every name is stored once. Requires pyarrow
+    def to_arrow(self):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise Exception('pyarrow is required for Arrow tables. Install it with `python3 -m pip install pyarrow`')
+
+        transitions = self.nonzero_transitions()
+        names = pa.array(self.behaviors, type=pa.string())
+        columns = {
+            const.BEHAVIOR: pa.DictionaryArray.from_arrays(pa.array(transitions['behavior'], type=pa.int32()), names),
+            const.BEHAVIOR_NEXT: pa.DictionaryArray.from_arrays(pa.array(transitions['behavior_next'], type=pa.int32()), names),
+        }
+        if self.group_by == const.TIME:
+            columns['HOUR_PERFORMED'] = pa.array(np.array(self.groups, dtype=np.int64)[transitions['group']])
+        elif self.group_by == const.BEHAVIORAL_CATEGORY:
+            columns[const.BEHAVIORAL_CATEGORY] = pa.DictionaryArray.from_arrays(pa.array(transitions['group'], type=pa.int32()), pa.array(self.groups, type=pa.string()))
+        columns['TRANSITION_COUNTS'] = pa.array(transitions['count'])
+        columns['TRANSITION_PROBABILITY'] = pa.array(transitions['probability'])
+        return pa.table(columns)
+
+
+# Scorelogs already in memory (scorelog name -> DataFrame, as returned by import_data_from_dir, or compact scorelogs)
+def matrices_from_scorelogs(df_map: dict[str, pd.DataFrame] | ScoreLogSet, group_by: str = const.BASIC, fps: float | None = None) -> TransitionMatrices:
+    encoded = encode_scorelogs(df_map, upper_snake(group_by), fps)
+    counts = empty_counts(encoded)
+    count_encoded_arrays(encoded.arrays, counts)
+    return TransitionMatrices(encoded, counts)
+
+
+# Reads every scorelog of an input folder as compact scorelogs (see import_scorelogs_from_dir). Files that can't be read
+# are recorded in errors (file name -> message) when given, and skipped
+def load_matrices(
+    input_folder: str,
+    group_by: str = const.BASIC,
+    fps: float | None = None,
+    ingest_workers: int | None = None,
+    errors: dict[str, str] | None = None
+) -> TransitionMatrices:
+    return matrices_from_scorelogs(import_scorelogs_from_dir(input_folder, fps, max_workers=ingest_workers, errors=errors), group_by, fps)
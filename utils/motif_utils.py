@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from utils.count_utils import encode_scorelogs
+from utils.import_utils import lazy_import
+from utils.scorelog_utils import ScoreLogSet
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+else:
+    np = lazy_import('numpy')
+    pd = lazy_import('pandas')
+
+# Frequent behavior sequences (motifs): every run of n consecutive behaviors within a scorelog (OUT_OF_VIEW events
+# dropped first, as for the chain graphs), counted over a whole folder.
+# Scorelogs are factorized into integer code arrays (see count_utils), and each run is packed into one integer key
+# (the codes as digits of a base <number of behaviors> number), built for length n from the keys of length n - 1.
+# Counting is then one np.unique per length, so it scales to millions of events. When the keys would overflow int64
+# (very large vocabularies with long motifs) the runs are compared as rows instead, which is exact but slower.
+
+DEFAULT_LENGTHS: tuple[int, int] = (3, 8)
+DEFAULT_TOP: int = 20
+
+
+# (keys or key rows, file index) of every run of `length` behaviors that doesn't cross into another file
+def _runs(codes: np.ndarray, file_idx: np.ndarray, length: int, packed: np.ndarray | None) -> tuple[np.ndarray, np.ndarray]:
+    n_runs = max(len(codes) - length + 1, 0)
+    same_file = file_idx[:n_runs] == file_idx[length - 1:length - 1 + n_runs]
+    if packed is not None:
+        return (packed[:n_runs][same_file], file_idx[:n_runs][same_file])
+    rows = np.lib.stride_tricks.sliding_window_view(codes, length)[:n_runs] if n_runs else np.zeros((0, length), dtype=codes.dtype)
+    return (rows[same_file], file_idx[:n_runs][same_file])
+
+
+# Ranked motif table: LENGTH, RANK, MOTIF, SUPPORT (occurrences), FILE_COUNT and FILES (the scorelogs it occurs in),
+# keeping the top most frequent motifs of every length that occur at least min_support times
+def mine_motifs(
+    df_map: dict[str, pd.DataFrame] | ScoreLogSet,
+    lengths: tuple[int, int] = DEFAULT_LENGTHS,
+    top: int = DEFAULT_TOP,
+    min_support: int = 2,
+    fps: float | None = None
+) -> pd.DataFrame:
+    min_length, max_length = lengths
+    if min_length < 1 or max_length < min_length:
+        raise Exception(f'Invalid motif lengths {min_length} to {max_length}')
+    encoded = encode_scorelogs(df_map, '', fps)
+    codes = encoded.arrays['behavior_codes'].astype(np.int64)
+    offsets = encoded.arrays['file_offsets']
+    file_idx = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+    n_behaviors = max(len(encoded.behaviors), 1)
+    behaviors = np.array(encoded.behaviors, dtype=object)
+    file_names = list(encoded.file_names)
+
+    rows = []
+    packed = codes.copy() # keys of length 1
+    for length in range(1, max_length + 1):
+        if length > 1:
+            fits = packed is not None and float(n_behaviors) ** length < np.iinfo(np.int64).max
+            packed = packed[:-1] * n_behaviors + codes[length - 1:] if fits else None
+        if length < min_length:
+            continue
+
+        keys, key_files = _runs(codes, file_idx, length, packed)
+        if len(keys) == 0:
+            continue
+        unique_keys, inverse, support = np.unique(keys, axis=0 if packed is None else None, return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+        # Distinct (motif, file) pairs, sorted by motif, give the files each motif occurs in
+        pairs = np.unique(inverse * len(file_names) + key_files)
+        pair_motifs, pair_files = pairs // len(file_names), pairs % len(file_names)
+        pair_starts = np.searchsorted(pair_motifs, np.arange(len(unique_keys) + 1))
+        file_counts = np.diff(pair_starts)
+
+        # Most frequent first, ties broken by the number of files and then by the motif itself
+        order = np.lexsort((np.arange(len(unique_keys)), -file_counts, -support))
+        order = order[support[order] >= min_support][:top]
+        for rank, motif_idx in enumerate(order):
+            if packed is not None:
+                motif_codes = [(int(unique_keys[motif_idx]) // n_behaviors ** power) % n_behaviors for power in range(length - 1, -1, -1)]
+            else:
+                motif_codes = unique_keys[motif_idx].tolist()
+            rows.append({
+                'LENGTH': length,
+                'RANK': rank + 1,
+                'MOTIF': ' > '.join(behaviors[motif_codes].tolist()),
+                'SUPPORT': int(support[motif_idx]),
+                'FILE_COUNT': int(file_counts[motif_idx]),
+                'FILES': ';'.join(file_names[file] for file in pair_files[pair_starts[motif_idx]:pair_starts[motif_idx + 1]]),
+            })
+
+    return pd.DataFrame(rows, columns=pd.Index(['LENGTH', 'RANK', 'MOTIF', 'SUPPORT', 'FILE_COUNT', 'FILES']))
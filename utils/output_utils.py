@@ -0,0 +1,133 @@
+import io
+import os
+import json
+import hashlib
+import tarfile
+import zipfile
+from abc import ABC, abstractmethod
+
+from utils import constants as const
+
+# Where a job's output files (svgs, legends, Graphviz sources, data tables) end up. Every writer skips files whose
+# bytes are unchanged, so re-running a job doesn't touch (or re-sync) outputs that came out the same:
+#   FILES              every output is its own file (the default)
+#   ZIP / TAR          every output of a job goes into one bundle next to where the files would have been
+#   CONTENT_ADDRESSED  outputs are stored once by their sha256 under <output folder>/objects, with a per-job index
+#                      mapping the usual file paths to those hashes (identical files of different jobs are kept once)
+# Bundles and indexes are only written when close() is called, after all of a job's outputs were added.
+
+
+def write_if_changed(file_path: str, data: bytes) -> bool:
+    if os.path.isfile(file_path) and os.path.getsize(file_path) == len(data):
+        with open(file_path, 'rb') as file:
+            if file.read() == data:
+                return False
+    file_dir = os.path.dirname(file_path)
+    if file_dir and not os.path.exists(file_dir):
+        os.makedirs(file_dir)
+    # Written to a temporary file first so a half written output never replaces a good one
+    with open(f'{file_path}.tmp', 'wb') as file:
+        file.write(data)
+    os.replace(f'{file_path}.tmp', file_path)
+    return True
+
+
+class OutputWriter(ABC):
+    def __init__(self):
+        self.written_count = 0
+        self.unchanged_count = 0
+
+    # Returns the path to record as an output file, or None when the output only lands on disk on close()
+    @abstractmethod
+    def write(self, file_path: str, data: bytes) -> str | None:
+        ...
+
+    # Returns any output files written when closing (bundles, indexes)
+    def close(self) -> list[str]:
+        return []
+
+    def _count(self, changed: bool):
+        if changed:
+            self.written_count += 1
+        else:
+            self.unchanged_count += 1
+
+
+class FileOutputWriter(OutputWriter):
+    def write(self, file_path: str, data: bytes) -> str | None:
+        self._count(write_if_changed(file_path, data))
+        return file_path
+
+
+class BundleOutputWriter(OutputWriter):
+    # Members are named by their path relative to root_dir
+    def __init__(self, bundle_path: str, root_dir: str):
+        super().__init__()
+        self.bundle_path = bundle_path
+        self.root_dir = root_dir
+        self.members: dict[str, bytes] = {}
+
+    def write(self, file_path: str, data: bytes) -> str | None:
+        self.members[os.path.relpath(file_path, self.root_dir).replace(os.sep, '/')] = data
+        return None
+
+    # Members are sorted and carry fixed timestamps, so the same outputs always give a byte-identical bundle
+    def close(self) -> list[str]:
+        if len(self.members) == 0:
+            return []
+        buffer = io.BytesIO()
+        if self.bundle_path.endswith('.zip'):
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as bundle:
+                for name in sorted(self.members):
+                    bundle.writestr(zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0)), self.members[name], zipfile.ZIP_DEFLATED)
+        else:
+            with tarfile.open(fileobj=buffer, mode='w') as bundle:
+                for name in sorted(self.members):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(self.members[name])
+                    info.mode = 0o644
+                    bundle.addfile(info, io.BytesIO(self.members[name]))
+        self._count(write_if_changed(self.bundle_path, buffer.getvalue()))
+        self.members = {}
+        return [self.bundle_path]
+
+
+class ContentAddressedOutputWriter(OutputWriter):
+    def __init__(self, store_dir: str, index_path: str, root_dir: str):
+        super().__init__()
+        self.store_dir = store_dir
+        self.index_path = index_path
+        self.root_dir = root_dir
+        self.index: dict[str, str] = {}
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.store_dir, digest[:2], digest)
+
+    def write(self, file_path: str, data: bytes) -> str | None:
+        digest = hashlib.sha256(data).hexdigest()
+        object_path = self.object_path(digest)
+        if os.path.isfile(object_path):
+            self._count(False)
+        else:
+            self._count(write_if_changed(object_path, data))
+        self.index[os.path.relpath(file_path, self.root_dir).replace(os.sep, '/')] = digest
+        return None
+
+    def close(self) -> list[str]:
+        if len(self.index) == 0:
+            return []
+        data = json.dumps({ 'objects': os.path.relpath(self.store_dir, os.path.dirname(self.index_path)), 'files': self.index }, indent=2, sort_keys=True)
+        self._count(write_if_changed(self.index_path, data.encode()))
+        self.index = {}
+        return [self.index_path]
+
+
+# bundle_base is the output path a job's bundle or index is named after (without extension)
+def make_output_writer(backend: str, output_dir_path: str, root_dir: str, bundle_base: str) -> OutputWriter:
+    if backend == const.FILES:
+        return FileOutputWriter()
+    if backend in [const.ZIP, const.TAR]:
+        return BundleOutputWriter(f'{bundle_base}.{backend.lower()}', root_dir)
+    if backend == const.CONTENT_ADDRESSED:
+        return ContentAddressedOutputWriter(os.path.join(output_dir_path, 'objects'), f'{bundle_base}.index.json', root_dir)
+    raise Exception(f'Unknown output backend: {backend}')
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from utils import constants as const
+from utils.import_utils import lazy_import
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+else:
+    np = lazy_import('numpy')
+    pd = lazy_import('pandas')
+
+# Absorbing chain analytics on the pooled transition probabilities, solved exactly rather than simulated:
+# - mean first passage times: the expected number of transitions from each behavior until a target behavior first
+#   occurs (the diagonal being the mean return time)
+# - absorption probabilities: with some behaviors made absorbing, the probability of reaching each of them first,
+#   plus the expected number of transitions until one is reached
+# Both are (I - Q) x = b systems built on the fundamental matrix N = (I - Q)^-1 of the chain's transient part. Every
+# target (and every hour bin for group_by=time) is one system of the same size, so they are all solved by a single
+# batched np.linalg.solve. Behaviors that cannot reach a target at all are pinned by identity rows so the systems stay
+# solvable, and any passage that may never happen (reached with probability < 1) is reported as infinite.
+
+# Reach probabilities this close to 1 count as certain
+CERTAIN_TOLERANCE: float = 1e-9
+
+
+# (groups, behaviors, behaviors) row stochastic transition matrices and the group keys (hour bins, or [None])
+def transition_matrices(transition_df: pd.DataFrame, behaviors: list[str], group_by: str = '') -> tuple[np.ndarray, list]:
+    groups = sorted(transition_df['HOUR_PERFORMED'].unique().tolist()) if group_by == const.TIME else [None]
+    behavior_idx = pd.Index(behaviors)
+
+    counts = np.zeros((len(groups), len(behaviors), len(behaviors)))
+    np.add.at(
+        counts,
+        (
+            pd.Index(groups).get_indexer(transition_df['HOUR_PERFORMED']) if group_by == const.TIME else np.zeros(len(transition_df), dtype=np.int64),
+            behavior_idx.get_indexer(transition_df[const.BEHAVIOR]),
+            behavior_idx.get_indexer(transition_df[const.BEHAVIOR_NEXT]),
+        ),
+        transition_df['TRANSITION_COUNTS'].to_numpy(dtype=np.float64)
+    )
+    row_totals = counts.sum(axis=2, keepdims=True)
+    return (np.divide(counts, row_totals, out=np.zeros(counts.shape), where=row_totals > 0), groups)
+
+
+# (groups, behaviors, behaviors) reachability in one or more steps, by repeated boolean squaring
+def reachability(matrices: np.ndarray) -> np.ndarray:
+    reach = matrices > 0
+    for _ in range(max(int(np.ceil(np.log2(max(matrices.shape[-1], 2)))), 1)):
+        reach = reach | ((reach.astype(np.float64) @ reach.astype(np.float64)) > 0)
+    return reach
+
+
+# (groups, sources, targets) mean first passage times, np.inf where the target may never be reached from the source
+def mean_first_passage_times(matrices: np.ndarray) -> np.ndarray:
+    n_groups, n = matrices.shape[0], matrices.shape[-1]
+    reach = reachability(matrices)
+    identity = np.eye(n)
+
+    # systems[g, j] is (I - P) of group g with target j made absorbing and the behaviors that can't reach j pinned
+    systems = np.broadcast_to(identity - matrices[:, None, :, :], (n_groups, n, n, n)).copy()
+    pinned = ~np.swapaxes(reach, 1, 2) | identity[None, :, :].astype(bool) # [g, j, i]: i can't reach j, or i is j
+    systems[pinned] = identity[np.nonzero(pinned)[2]]
+
+    # Two right hand sides: hitting probabilities (1 at the target) and expected steps (1 for every unpinned behavior)
+    rhs = np.zeros((n_groups, n, n, 2))
+    rhs[..., 0] = identity[None, :, :]
+    rhs[..., 1] = ~pinned
+    solved = np.linalg.solve(systems, rhs)
+    hit_probability, steps = solved[..., 0], solved[..., 1] # [g, j, i]
+    steps = np.where(hit_probability >= 1 - CERTAIN_TOLERANCE, steps, np.inf)
+    steps[:, np.arange(n), np.arange(n)] = 0
+
+    # Return times: one step, then the passage time back from wherever that step led
+    passage = np.swapaxes(steps, 1, 2) # [g, i, j]
+    back = np.swapaxes(passage, 1, 2) # [g, j, k]: passage time from k back to j
+    returns = 1 + (matrices * np.where(matrices > 0, back, 0)).sum(axis=2)
+    never_returns = ((matrices > 0) & np.isinf(back)).any(axis=2) | (matrices.sum(axis=2) == 0)
+    passage[:, np.arange(n), np.arange(n)] = np.where(never_returns, np.inf, returns)
+    return passage
+
+
+# (absorption probabilities (groups, behaviors, absorbing), expected steps until absorption (groups, behaviors))
+# Absorbing behaviors absorb themselves with probability 1 after 0 steps
+def absorption_probabilities(matrices: np.ndarray, absorbing: list[int]) -> tuple[np.ndarray, np.ndarray]:
+    n_groups, n = matrices.shape[0], matrices.shape[-1]
+    is_absorbing = np.zeros(n, dtype=bool)
+    is_absorbing[absorbing] = True
+    reaches_absorbing = reachability(matrices)[:, :, is_absorbing].any(axis=2) & ~is_absorbing[None, :]
+    pinned = ~reaches_absorbing # absorbing behaviors, and behaviors that never get to one
+
+    systems = np.eye(n)[None, :, :] - matrices
+    systems[pinned] = np.eye(n)[np.nonzero(pinned)[1]]
+    rhs = np.zeros((n_groups, n, len(absorbing) + 1))
+    rhs[:, absorbing, np.arange(len(absorbing))] = 1
+    rhs[..., -1] = reaches_absorbing
+    solved = np.linalg.solve(systems, rhs)
+
+    probabilities = solved[..., :-1]
+    steps = np.where(probabilities.sum(axis=2) >= 1 - CERTAIN_TOLERANCE, solved[..., -1], np.inf)
+    return (probabilities, steps)
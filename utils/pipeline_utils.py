@@ -0,0 +1,370 @@
+from __future__ import annotations
+
+import os
+import queue
+import threading
+import multiprocessing
+from typing import TYPE_CHECKING, Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+from utils import constants as const
+from utils.count_utils import format_data_shared, format_shared_scorelogs
+from utils.helper_utils import (
+    BehaviorTransitionData,
+    import_data_from_dir,
+    formatted_data_cache_key,
+    get_cached_formatted_data,
+    cache_formatted_data,
+)
+from utils.import_utils import lazy_import
+from utils.scorelog_utils import ScoreLogSet, import_scorelogs_from_dir, share_scorelogs
+from utils.shared_memory_utils import SharedArrays
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import graphviz as gv
+else:
+    pd = lazy_import('pandas')
+    gv = lazy_import('graphviz', 'needed to render graphs, use --no-render to skip rendering')
+
+# A job is split into four stages so that different jobs can be in different stages at the same time:
+#   ingest - read the input folder (I/O bound, threads)
+#   format - format_data (CPU bound, counted in separate processes through shared memory, see count_utils)
+#   build  - BehaviorTransitionData and the graph objects, plus any table outputs
+#   render - Graphviz rendering (each render runs the Graphviz executables as a subprocess)
+# Every stage has its own worker count and a bounded inbox. A stage whose inbox is full blocks the stage
+# before it, so at most (queue_size + workers) jobs are held by each stage no matter how long the config is.
+# Jobs on the same input folder (e.g. one per group_by) share one read of it and one copy of it in shared memory, which
+# the format workers of all of them read (see SharedFolders).
+
+
+class PipelineJob:
+    # render=False runs the job compute-only: no graphs are built or rendered (so Graphviz is never needed) and
+    # the data is written as CSVs unless the job sets another output_format
+    def __init__(self, idx: int, job: dict, render: bool = True):
+        self.idx = idx
+        self.job = job
+        self.render = render
+        self.cache_key: tuple | None = None
+        # Compact scorelogs (see scorelog_utils), or full DataFrames for jobs that read other columns (see needs_frames)
+        self.raw_data: ScoreLogSet | dict[str, pd.DataFrame] | None = None
+        self.ingest_errors: dict[str, str] = {}
+        self.formatted_data: tuple[pd.DataFrame, pd.DataFrame] | None = None
+        self.data: BehaviorTransitionData | None = None
+        self.render_tasks: list[tuple[gv.Digraph | gv.Source, str, bool]] = []
+        # Data derived from the job's scorelogs (actor -> partner interactions, single individuals) and their render tasks
+        self.derived: list[tuple[BehaviorTransitionData, list[tuple[gv.Digraph | gv.Source, str, bool]]]] = []
+        # (folders, spec) of the job's scorelogs in shared memory, while the job holds on to them (see SharedFolders)
+        self.shared_scorelogs: tuple[SharedFolders, dict] | None = None
+        self.error: Exception | None = None
+
+    # Analyses that work on the scorelogs themselves rather than the pooled counts
+    @property
+    def needs_raw_data(self) -> bool:
+        return bool(self.job.get(const.LAG_SEQUENTIAL) or self.job.get(const.INTERACTION_WINDOW) or self.job.get(const.MOTIFS)
+            or self.job.get(const.PER_INDIVIDUAL) or self.job.get(const.DISTANCE_METRIC))
+
+    # Interactions need the subject column, which compact scorelogs don't keep
+    @property
+    def needs_frames(self) -> bool:
+        return bool(self.job.get(const.INTERACTION_WINDOW))
+
+    @property
+    def output_files(self) -> list[str]:
+        if self.data is None:
+            return []
+        return self.data.output_files + [file for derived, _ in self.derived for file in derived.output_files]
+
+
+# The compact scorelogs of a pipeline run's input folders. Each (folder, fps) is read once and copied into shared memory
+# once, however many jobs use it, and the format workers of all of those jobs read the same shared arrays. They are
+# released once every job using the folder is past the format stage
+class SharedFolders:
+    def __init__(self, jobs: list[dict]):
+        # Jobs per folder that haven't called done() yet
+        self.__users: dict[tuple, int] = {}
+        for job in jobs:
+            self.__users[SharedFolders.key(job)] = self.__users.get(SharedFolders.key(job), 0) + 1
+        self.__entries: dict[tuple, tuple[ScoreLogSet, dict[str, str], SharedArrays, dict]] = {}
+        self.__folder_locks: dict[tuple, threading.Lock] = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(job: dict) -> tuple:
+        return (os.path.abspath(job[const.INPUT_FOLDER]), job.get(const.FPS))
+
+    # (scorelogs, ingest errors, shared memory spec) of the job's folder, reading it when no other job has yet
+    def acquire(self, job: dict) -> tuple[ScoreLogSet, dict[str, str], dict]:
+        key = SharedFolders.key(job)
+        with self.__lock:
+            folder_lock = self.__folder_locks.setdefault(key, threading.Lock())
+        with folder_lock:
+            if key not in self.__entries:
+                errors: dict[str, str] = {}
+                # Every scorelog is made compact as soon as it is read, so the folder's DataFrames are never all held at once
+                scorelogs = import_scorelogs_from_dir(
+                    job[const.INPUT_FOLDER],
+                    job.get(const.FPS),
+                    max_workers=job.get(const.INGEST_WORKERS),
+                    use_processes=job.get(const.INGEST_WITH_PROCESSES) or False,
+                    errors=errors
+                )
+                shared, spec = share_scorelogs(scorelogs)
+                with self.__lock:
+                    self.__entries[key] = (scorelogs, errors, shared, spec)
+            scorelogs, errors, _, spec = self.__entries[key]
+        return (scorelogs, dict(errors), spec)
+
+    # Called exactly once for every job, whether it used the folder or not (cached, interactions or failed)
+    def done(self, job: dict):
+        key = SharedFolders.key(job)
+        with self.__lock:
+            self.__users[key] -= 1
+            entry = self.__entries.pop(key) if self.__users[key] == 0 and key in self.__entries else None
+        if entry is not None:
+            entry[2].release()
+
+    # Releases the folders of jobs that never called done(), e.g. when the run is interrupted
+    def close(self):
+        with self.__lock:
+            entries = list(self.__entries.values())
+            self.__entries = {}
+        for entry in entries:
+            entry[2].release()
+
+
+def ingest_job(work: PipelineJob, folders: SharedFolders | None = None):
+    job = work.job
+    input_folder = job[const.INPUT_FOLDER]
+    work.cache_key = formatted_data_cache_key(input_folder, job[const.GROUP_BY], job.get(const.FPS))
+    cached = get_cached_formatted_data(work.cache_key)
+    if cached is not None:
+        work.formatted_data = (cached[0], cached[1])
+        work.ingest_errors = cached[2]
+        if folders is not None:
+            folders.done(job)
+        return
+
+    if folders is not None and not work.needs_frames:
+        try:
+            work.raw_data, work.ingest_errors, spec = folders.acquire(job)
+            work.shared_scorelogs = (folders, spec)
+        except Exception:
+            folders.done(job)
+            raise
+        return
+    if folders is not None:
+        folders.done(job)
+
+    if work.needs_frames:
+        work.raw_data = import_data_from_dir(
+            input_folder,
+            max_workers=job.get(const.INGEST_WORKERS),
+            use_processes=job.get(const.INGEST_WITH_PROCESSES) or False,
+            errors=work.ingest_errors
+        )
+        return
+    # Every scorelog is made compact as soon as it is read, so the folder's DataFrames are never all held at once
+    work.raw_data = import_scorelogs_from_dir(
+        input_folder,
+        job.get(const.FPS),
+        max_workers=job.get(const.INGEST_WORKERS),
+        use_processes=job.get(const.INGEST_WITH_PROCESSES) or False,
+        errors=work.ingest_errors
+    )
+
+
+def format_job(work: PipelineJob, executor: Executor | None = None):
+    if work.formatted_data is not None:
+        return
+    if work.raw_data is None:
+        raise Exception(f'Job #{work.idx + 1} has no scorelogs to format')
+    group_by = work.job[const.GROUP_BY]
+    fps = work.job.get(const.FPS)
+    # With an executor the compact scorelogs are encoded and counted in a worker process, which reads them from shared
+    # memory rather than having them pickled
+    if work.shared_scorelogs is not None:
+        folders, spec = work.shared_scorelogs
+        try:
+            if executor is not None:
+                work.formatted_data = executor.submit(format_shared_scorelogs, spec, group_by).result()
+            else:
+                work.formatted_data = format_data_shared(work.raw_data, group_by, fps)
+        finally:
+            work.shared_scorelogs = None
+            folders.done(work.job)
+    else:
+        work.formatted_data = format_data_shared(work.raw_data, group_by, fps, executor)
+    if not work.needs_raw_data:
+        work.raw_data = None # no longer needed, so don't hold on to it while the job waits in later stages
+
+    if work.cache_key is not None:
+        cache_formatted_data(work.cache_key, (work.formatted_data[0], work.formatted_data[1], work.ingest_errors))
+
+
+def build_job(work: PipelineJob):
+    job = work.job
+    input_folder = job[const.INPUT_FOLDER]
+    for filename, message in work.ingest_errors.items():
+        print(f'Skipped {os.path.join(input_folder, filename)} ({message})')
+
+    data = BehaviorTransitionData(
+        input_folder,
+        job[const.OUTPUT_FOLDER],
+        job[const.SUBJECT],
+        job[const.ENV],
+        dict(job[const.COLOR_MAP]),
+        job[const.GROUP_BY],
+        fps=job.get(const.FPS),
+        formatted_data=work.formatted_data,
+        raw_data=work.raw_data, # only kept when work.needs_raw_data, read again by data.raw_data if it came from the cache
+        output_backend=job.get(const.OUTPUT_BACKEND) or const.FILES,
+        keep_graph_sources=job.get(const.KEEP_GRAPH_SOURCES) is not False
+    )
+    data.ingest_errors = work.ingest_errors
+    work.data = data
+    work.raw_data = None
+    if work.render:
+        work.render_tasks = data.build_markov_chain_graphs(job.get(const.ATTACH_LEGEND) or False)
+
+    # Category jobs also get the chain collapsed to one node per category
+    if job[const.GROUP_BY] == const.BEHAVIORAL_CATEGORY:
+        data.output_category_chain()
+        if work.render:
+            work.render_tasks = work.render_tasks + data.build_category_chain_graph()
+
+    if job.get(const.FIRST_PASSAGE) or job.get(const.ABSORBING_BEHAVIORS):
+        data.output_first_passage(job.get(const.ABSORBING_BEHAVIORS))
+
+    if job.get(const.MOTIFS):
+        shortest, longest = job.get(const.MOTIF_LENGTHS) or (3, 8)
+        data.output_motifs((shortest, longest), job.get(const.MOTIF_TOP) or 20)
+
+    if job.get(const.LAG_SEQUENTIAL):
+        significance = job.get(const.LAG_SIGNIFICANCE) or 1.96
+        lag_df = data.output_lag_sequential(job[const.LAG_SEQUENTIAL], job.get(const.LAG_STATISTIC) or const.ADJUSTED_RESIDUAL, significance)
+        if work.render:
+            work.render_tasks = work.render_tasks + data.build_lag_graphs(lag_df, significance)
+
+    output_format = job.get(const.OUTPUT_FORMAT) or (const.CSV if not work.render else None)
+    dataset_folder = job.get(const.DATASET_FOLDER)
+    if output_format is not None:
+        data.output_dfs(output_format)
+
+    if job.get(const.INTERACTION_WINDOW):
+        for interaction in data.build_interaction_data(job[const.INTERACTION_WINDOW], job.get(const.SUBJECT_COLUMN) or 'Subject', dict(job[const.COLOR_MAP])):
+            interaction.output_dfs(output_format or const.CSV)
+            render_tasks = interaction.build_markov_chain_graphs(job.get(const.ATTACH_LEGEND) or False) if work.render else []
+            work.derived.append((interaction, render_tasks))
+
+    if job.get(const.DISTANCE_METRIC):
+        data.output_distances(job[const.DISTANCE_METRIC], job.get(const.DENDROGRAM_ORDER) or False)
+
+    # Per-individual graphs are opt-in, a folder of hundreds of scorelogs would otherwise mean hundreds of renders
+    if job.get(const.PER_INDIVIDUAL):
+        data.output_individuals()
+        if job.get(const.INDIVIDUAL_GRAPHS):
+            for individual in data.build_individual_data(dict(job[const.COLOR_MAP])):
+                individual.output_dfs(output_format or const.CSV)
+                render_tasks = individual.build_markov_chain_graphs(job.get(const.ATTACH_LEGEND) or False) if work.render else []
+                work.derived.append((individual, render_tasks))
+    if dataset_folder is not None:
+        data.append_to_dataset(dataset_folder, job.get(const.JOB_NAME) or f'Job{work.idx + 1}')
+
+
+def render_job(work: PipelineJob):
+    if work.data is None:
+        return
+    work.data.render_graphs(work.render_tasks)
+    work.render_tasks = []
+    work.data.close_outputs()
+    for derived, render_tasks in work.derived:
+        derived.render_graphs(render_tasks)
+        derived.close_outputs()
+
+
+# Runs every stage of a job one after the other in the calling thread
+# Like in the pipeline, a job that fails in any stage skips the remaining stages and is returned with its error set
+def run_job_sequentially(work: PipelineJob) -> PipelineJob:
+    try:
+        for stage in [ingest_job, format_job, build_job, render_job]:
+            stage(work)
+    except Exception as e:
+        work.error = e
+    return work
+
+
+_STOP = object()
+
+def _stage_worker(stage, inbox: queue.Queue, outbox: queue.Queue):
+    while True:
+        work = inbox.get()
+        if work is _STOP:
+            return
+        if work.error is None:
+            try:
+                stage(work)
+            except Exception as e:
+                work.error = e
+        outbox.put(work) # blocks while the next stage's inbox is full
+
+
+# Runs the given (index, job) pairs through the staged pipeline, yielding each PipelineJob as it finishes
+# Jobs finish in whatever order they complete, check PipelineJob.idx to tell them apart.
+# A job that fails in any stage skips the remaining stages and is yielded with its error set
+def run_pipeline(
+    jobs: list[tuple[int, dict]],
+    ingest_workers: int = 4,
+    format_workers: int | None = None,
+    build_workers: int = 1,
+    render_workers: int | None = None,
+    queue_size: int = 2,
+    render: bool = True
+) -> Iterator[PipelineJob]:
+    cpu_count = os.cpu_count() or 1
+    format_workers = format_workers or cpu_count
+    render_workers = render_workers or cpu_count
+
+    # spawn rather than fork, since forking a process that is already running the other stages' threads is unsafe
+    format_executor = ProcessPoolExecutor(max_workers=format_workers, mp_context=multiprocessing.get_context('spawn'))
+    folders = SharedFolders([job for _, job in jobs])
+    stages = [
+        (lambda work: ingest_job(work, folders), ingest_workers),
+        (lambda work: format_job(work, format_executor), format_workers),
+        (build_job, build_workers),
+        (render_job, render_workers),
+    ]
+    inboxes = [queue.Queue(maxsize=queue_size) for _ in stages]
+    results: queue.Queue = queue.Queue()
+    outboxes = inboxes[1:] + [results]
+
+    stage_threads = [
+        [threading.Thread(target=_stage_worker, args=(stage, inboxes[stage_idx], outboxes[stage_idx]), daemon=True) for _ in range(workers)]
+        for stage_idx, (stage, workers) in enumerate(stages)
+    ]
+    for threads in stage_threads:
+        for thread in threads:
+            thread.start()
+
+    # Feeds the jobs in, then shuts each stage down once the stage before it has drained
+    def feed():
+        for idx, job in jobs:
+            inboxes[0].put(PipelineJob(idx, job, render))
+        for stage_idx, threads in enumerate(stage_threads):
+            for _ in threads:
+                inboxes[stage_idx].put(_STOP)
+            for thread in threads:
+                thread.join()
+        results.put(_STOP)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        while True:
+            work = results.get()
+            if work is _STOP:
+                break
+            yield work
+    finally:
+        format_executor.shutdown(wait=True, cancel_futures=True)
+        folders.close()
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import threading
+from typing import TYPE_CHECKING
+
+from utils.helper_utils import canonical_code, normalize_time_column, import_data_from_dir
+from utils.import_utils import lazy_import
+from utils.shared_memory_utils import SharedArrays
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+else:
+    np = lazy_import('numpy')
+    pd = lazy_import('pandas')
+
+# Compact scorelogs: only what the counting, lag, motif and per-individual analyses read, as small contiguous arrays
+# rather than a DataFrame holding every column of the original file:
+#   behavior_codes  int16    canonical behavior names (OUT_OF_VIEW rows are kept, they still break transitions)
+#   category_codes  int8     canonical behavioral categories, -1 when the scorelog has no category column
+#   times           float32  seconds, NaN when the row has no time
+#   hours           int16    hour bin of each row, -1 when it has no time. Taken from the exact seconds, as float32
+#                            times can round across an hour boundary in long recordings
+# Codes index a Vocabulary shared by every scorelog of a folder, so each name is stored once. A ScoreLogSet holds
+# many scorelogs as one flat set of arrays with offsets marking where each one starts.
+# Codes are handed out in the order names are first seen, which may differ between runs when files are read
+# concurrently; they are only meaningful together with their vocabulary.
+
+MAX_BEHAVIOR_CODES: int = 32767 # int16
+MAX_CATEGORY_CODES: int = 127 # int8
+
+
+class Vocabulary:
+    __slots__ = ('names', 'codes', 'max_codes', 'lock')
+
+    def __init__(self, max_codes: int = MAX_BEHAVIOR_CODES):
+        self.names: list[str] = []
+        self.codes: dict[str, int] = {}
+        self.max_codes = max_codes
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_names(cls, names: list[str], max_codes: int = MAX_BEHAVIOR_CODES) -> Vocabulary:
+        vocabulary = cls(max_codes)
+        vocabulary.names = list(names)
+        vocabulary.codes = { name: code for code, name in enumerate(vocabulary.names) }
+        return vocabulary
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    # Canonicalizes a column (once per unique value) and returns the codes of its rows
+    def encode(self, col: pd.Series) -> np.ndarray:
+        row_codes, uniques = pd.factorize(col, use_na_sentinel=False)
+        with self.lock:
+            unique_codes = np.array([self.__code(canonical_code(str(value))) for value in uniques], dtype=np.int64)
+        return unique_codes[row_codes] if len(uniques) else np.zeros(0, dtype=np.int64)
+
+    def __code(self, name: str) -> int:
+        code = self.codes.get(name)
+        if code is None:
+            if len(self.names) >= self.max_codes:
+                raise Exception(f'More than {self.max_codes} distinct values, too many for compact scorelogs')
+            code = len(self.names)
+            self.codes[name] = code
+            self.names.append(name)
+        return code
+
+
+class ScoreLog:
+    __slots__ = ('name', 'behavior_codes', 'category_codes', 'times', 'hours')
+
+    def __init__(self, name: str, behavior_codes: np.ndarray, category_codes: np.ndarray, times: np.ndarray, hours: np.ndarray):
+        self.name = name
+        self.behavior_codes = behavior_codes
+        self.category_codes = category_codes
+        self.times = times
+        self.hours = hours
+
+    def __len__(self) -> int:
+        return len(self.behavior_codes)
+
+    @staticmethod
+    def from_frame(name: str, df: pd.DataFrame, behaviors: Vocabulary, categories: Vocabulary, fps: float | None = None) -> ScoreLog:
+        seconds = normalize_time_column(df, fps)
+        has_time = ~np.isnan(seconds)
+        return ScoreLog(
+            name,
+            behaviors.encode(df.loc[:, 'Behavior']).astype(np.int16),
+            categories.encode(df.loc[:, 'Behavioral category']).astype(np.int8) if 'Behavioral category' in df.columns else np.full(len(df), -1, dtype=np.int8),
+            seconds.astype(np.float32),
+            np.where(has_time, np.ceil(np.where(has_time, seconds, 0) / 3600), -1).astype(np.int16)
+        )
+
+
+class ScoreLogSet:
+    __slots__ = ('names', 'behaviors', 'categories', 'behavior_codes', 'category_codes', 'times', 'hours', 'offsets')
+    ARRAYS: tuple[str, ...] = ('behavior_codes', 'category_codes', 'times', 'hours', 'offsets')
+
+    def __init__(self, logs: list[ScoreLog], behaviors: Vocabulary, categories: Vocabulary):
+        self.names: list[str] = [log.name for log in logs]
+        self.behaviors = behaviors
+        self.categories = categories
+        self.behavior_codes = np.concatenate([log.behavior_codes for log in logs]) if len(logs) else np.zeros(0, dtype=np.int16)
+        self.category_codes = np.concatenate([log.category_codes for log in logs]) if len(logs) else np.zeros(0, dtype=np.int8)
+        self.times = np.concatenate([log.times for log in logs]) if len(logs) else np.zeros(0, dtype=np.float32)
+        self.hours = np.concatenate([log.hours for log in logs]) if len(logs) else np.zeros(0, dtype=np.int16)
+        self.offsets = np.concatenate([[0], np.cumsum([len(log) for log in logs])]).astype(np.int64)
+
+    # A set over existing flat arrays (see arrays), which are used as they are rather than copied
+    @classmethod
+    def from_arrays(cls, names: list[str], behaviors: Vocabulary, categories: Vocabulary, arrays: dict[str, np.ndarray]) -> ScoreLogSet:
+        logs = cls.__new__(cls)
+        logs.names = list(names)
+        logs.behaviors = behaviors
+        logs.categories = categories
+        for name in cls.ARRAYS:
+            setattr(logs, name, arrays[name])
+        return logs
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    # The scorelog at idx, as views of the flat arrays
+    def __getitem__(self, idx: int) -> ScoreLog:
+        start, stop = self.offsets[idx], self.offsets[idx + 1]
+        return ScoreLog(self.names[idx], self.behavior_codes[start:stop], self.category_codes[start:stop], self.times[start:stop], self.hours[start:stop])
+
+    def __iter__(self):
+        return (self[idx] for idx in range(len(self)))
+
+    @property
+    def arrays(self) -> dict[str, np.ndarray]:
+        return { name: getattr(self, name) for name in ScoreLogSet.ARRAYS }
+
+    @property
+    def nbytes(self) -> int:
+        return sum(values.nbytes for values in self.arrays.values())
+
+    # Scorelog index of every row
+    def file_index(self) -> np.ndarray:
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.offsets))
+
+
+# Converts scorelogs already read as DataFrames (scorelog name -> DataFrame)
+def scorelogs_from_frames(df_map: dict[str, pd.DataFrame], fps: float | None = None) -> ScoreLogSet:
+    behaviors, categories = Vocabulary(), Vocabulary(MAX_CATEGORY_CODES)
+    return ScoreLogSet([ScoreLog.from_frame(name, df, behaviors, categories, fps) for name, df in df_map.items()], behaviors, categories)
+
+
+# Places the arrays of a ScoreLogSet in shared memory (see shared_memory_utils) so worker processes can read them without
+# them being pickled. Returns the SharedArrays to release once the workers are done, and the small picklable spec they
+# attach with
+def share_scorelogs(logs: ScoreLogSet) -> tuple[SharedArrays, dict]:
+    shared = SharedArrays.create(logs.arrays)
+    return (shared, { 'arrays': shared.spec, 'names': logs.names, 'behaviors': logs.behaviors.names, 'categories': logs.categories.names })
+
+
+# Worker side of share_scorelogs: a read-only ScoreLogSet over the shared arrays, and the SharedArrays to close once
+# every reference to the set (and views of its arrays) is gone
+def attach_scorelogs(spec: dict) -> tuple[ScoreLogSet, SharedArrays]:
+    shared = SharedArrays.attach(spec['arrays'], writable=False)
+    logs = ScoreLogSet.from_arrays(
+        spec['names'],
+        Vocabulary.from_names(spec['behaviors']),
+        Vocabulary.from_names(spec['categories'], MAX_CATEGORY_CODES),
+        shared.arrays
+    )
+    return (logs, shared)
+
+
+# Reads an input folder like import_data_from_dir, converting every scorelog as soon as its file is read so the full
+# DataFrames of the folder are never held at the same time
+def import_scorelogs_from_dir(
+    dir_path: str,
+    fps: float | None = None,
+    max_workers: int | None = None,
+    use_processes: bool = False,
+    errors: dict[str, str] | None = None
+) -> ScoreLogSet:
+    behaviors, categories = Vocabulary(), Vocabulary(MAX_CATEGORY_CODES)
+    logs = import_data_from_dir(
+        dir_path,
+        max_workers=max_workers,
+        use_processes=use_processes,
+        errors=errors,
+        convert=lambda name, df: ScoreLog.from_frame(name, df, behaviors, categories, fps)
+    )
+    for name, log in logs.items():
+        log.name = name # names are only made unique once every file was read
+    return ScoreLogSet(list(logs.values()), behaviors, categories)
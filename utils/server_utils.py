@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from typing import TYPE_CHECKING
+
+from utils import constants as const
+from utils.helper_utils import BehaviorTransitionData, input_fingerprint, upper_snake
+from utils.watch_utils import IncrementalFolderCounts
+from utils.import_utils import lazy_import
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+else:
+    np = lazy_import('numpy')
+    pd = lazy_import('pandas')
+
+# Long running localhost service (python3 main.py serve) that answers queries for the input folders of a config
+# without paying for Python startup, imports and CSV parsing on every request:
+# - every folder's per-file counts are kept in memory (see IncrementalFolderCounts), files that change on disk are
+#   re-counted on the next request that needs them
+# - Graphviz renders run on a bounded pool; requests beyond what the pool can queue are turned away with a 503
+# - responses are cached (least recently used first out), keyed by the query and the folder's input fingerprint
+#
+# Endpoints (all GET):
+#   /jobs        the config's jobs that can be used as a starting point for queries
+#   /matrix      JSON count and probability matrices
+#   /graph.svg   the chain graph as svg
+# Query parameters: job (a job name, or Job<n> for unnamed jobs) and/or input_folder (one of the config's input folders),
+# then optionally subject, environment, group_by, fps, threshold (edge visibility, 0 to 1), legend (true/false)
+# and hour (1 to 3, for group_by=time graphs). Anything not given is taken from the job.
+
+DEFAULT_PORT: int = 8765
+DEFAULT_CACHE_SIZE: int = 256
+# Renders allowed to wait for a free render worker, per worker
+RENDER_QUEUE_PER_WORKER: int = 4
+
+
+class ServiceError(Exception):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class TransitionService:
+    def __init__(self, jobs: list[dict], render_workers: int | None = None, cache_size: int = DEFAULT_CACHE_SIZE):
+        self.jobs = { job.get(const.JOB_NAME) or f'Job{idx + 1}': job for idx, job in enumerate(jobs) }
+        # Only the config's own folders are served, so requests can't read arbitrary paths
+        self.input_folders = { os.path.abspath(job[const.INPUT_FOLDER]): job[const.INPUT_FOLDER] for job in jobs }
+        self.cache_size = cache_size
+
+        render_workers = render_workers or os.cpu_count() or 1
+        self.__render_pool = ThreadPoolExecutor(max_workers=render_workers)
+        self.__render_slots = threading.BoundedSemaphore(render_workers * (RENDER_QUEUE_PER_WORKER + 1))
+        # One lock per (input_folder, group_by, fps), so re-counting a cold or changed folder doesn't hold up queries on
+        # other folders. __counts_lock only guards creating the entries
+        self.__folder_counts: dict[tuple, tuple[IncrementalFolderCounts, threading.Lock]] = {}
+        self.__counts_lock = threading.Lock()
+        self.__responses: OrderedDict[tuple, tuple[str, bytes]] = OrderedDict()
+        self.__responses_lock = threading.Lock()
+        # BehaviorTransitionData needs an output folder, nothing is ever written to it
+        self.__scratch_dir = tempfile.mkdtemp(prefix='transition-service-')
+
+    def close(self):
+        self.__render_pool.shutdown(wait=False, cancel_futures=True)
+        shutil.rmtree(self.__scratch_dir, ignore_errors=True)
+
+    # Returns (content type, body) for a request path and its query parameters
+    def handle(self, path: str, params: dict[str, str]) -> tuple[str, bytes]:
+        if path == '/jobs':
+            return ('application/json', json.dumps(self.list_jobs()).encode())
+        if path not in ['/matrix', '/graph.svg']:
+            raise ServiceError(f'Unknown path {path}', status=404)
+
+        query = self.resolve_query(params)
+        cache_key = (path, tuple(sorted(query.items(), key=lambda item: item[0])), input_fingerprint(query['input_folder']))
+        with self.__responses_lock:
+            if cache_key in self.__responses:
+                self.__responses.move_to_end(cache_key)
+                return self.__responses[cache_key]
+
+        if path == '/matrix':
+            response = ('application/json', json.dumps(self.matrix(query)).encode())
+        else:
+            response = ('image/svg+xml', self.render_svg(query))
+
+        with self.__responses_lock:
+            self.__responses[cache_key] = response
+            while len(self.__responses) > self.cache_size:
+                self.__responses.popitem(last=False)
+        return response
+
+    def list_jobs(self) -> list[dict]:
+        return [
+            {
+                'job': name,
+                'input_folder': job.get(const.INPUT_FOLDER),
+                'subject': job.get(const.SUBJECT),
+                'environment': job.get(const.ENV),
+                'group_by': job.get(const.GROUP_BY),
+            }
+            for name, job in self.jobs.items()
+        ]
+
+    # Combines the named job's settings with the query parameters into one validated query
+    def resolve_query(self, params: dict[str, str]) -> dict:
+        job: dict = {}
+        if params.get('job') is not None:
+            if params['job'] not in self.jobs:
+                raise ServiceError(f'Unknown job {params["job"]}', status=404)
+            job = self.jobs[params['job']]
+
+        input_folder = params.get('input_folder') or job.get(const.INPUT_FOLDER)
+        if input_folder is None:
+            raise ServiceError('Either job or input_folder is required')
+        if os.path.abspath(input_folder) not in self.input_folders:
+            raise ServiceError(f'{input_folder} is not an input folder of this config', status=404)
+
+        try:
+            fps = params.get('fps') or job.get(const.FPS)
+            query = {
+                'input_folder': os.path.abspath(input_folder),
+                'job': params.get('job'),
+                'subject': params.get('subject', job.get(const.SUBJECT) or ''),
+                'environment': params.get('environment', job.get(const.ENV) or ''),
+                'group_by': upper_snake(params.get('group_by') or job.get(const.GROUP_BY) or const.BASIC),
+                'fps': float(fps) if fps is not None else None,
+                'threshold': float(params.get('threshold', 0.05)),
+                'legend': params.get('legend', str(job.get(const.ATTACH_LEGEND) or False)).lower() in ['1', 'true', 'yes'],
+                'hour': int(params.get('hour', 1)),
+            }
+        except ValueError as e:
+            raise ServiceError(f'Invalid query parameter ({e})')
+        if query['group_by'] not in [const.BASIC, const.TIME, const.BEHAVIORAL_CATEGORY]:
+            raise ServiceError(f'Unknown group_by {query["group_by"]}')
+        return query
+
+    # Brings the folder's counts up to date with what is on disk and returns the pooled (transition_df, behavior_df)
+    def formatted_data(self, input_folder: str, group_by: str, fps: float | None) -> tuple[pd.DataFrame, pd.DataFrame]:
+        key = (input_folder, group_by, fps)
+        with self.__counts_lock:
+            if key not in self.__folder_counts:
+                self.__folder_counts[key] = (IncrementalFolderCounts(*key), threading.Lock())
+            folder_counts, folder_lock = self.__folder_counts[key]
+        with folder_lock:
+            transition_df, behavior_df, _ = folder_counts.update()
+        if len(behavior_df) == 0:
+            raise ServiceError(f'{input_folder} has no readable scorelogs', status=404)
+        return (transition_df, behavior_df)
+
+    # Count and probability matrices indexed [behavior][next behavior], one per hour for group_by=time
+    def matrix(self, query: dict) -> dict:
+        transition_df, behavior_df = self.formatted_data(query['input_folder'], query['group_by'], query['fps'])
+        behaviors = sorted(behavior_df[const.BEHAVIOR].unique().tolist())
+        result: dict = { 'input_folder': query['input_folder'], 'group_by': query['group_by'], 'behaviors': behaviors, 'groups': [] }
+        if query['group_by'] == const.TIME:
+            for hour in sorted(behavior_df['HOUR_PERFORMED'].unique().tolist()):
+                group = matrix_group(
+                    transition_df.loc[transition_df['HOUR_PERFORMED'] == hour],
+                    behavior_df.loc[behavior_df['HOUR_PERFORMED'] == hour],
+                    behaviors
+                )
+                result['groups'].append({ 'hour': int(hour), **group })
+        else:
+            result['groups'].append(matrix_group(transition_df, behavior_df, behaviors))
+            if query['group_by'] == const.BEHAVIORAL_CATEGORY:
+                categories = behavior_df.drop_duplicates(const.BEHAVIOR).set_index(const.BEHAVIOR)[const.BEHAVIORAL_CATEGORY]
+                result['categories'] = [str(categories[behavior]) for behavior in behaviors]
+        return result
+
+    def render_svg(self, query: dict) -> bytes:
+        # The slot is taken before any counting or graph building, so a turned away request costs next to nothing
+        if not self.__render_slots.acquire(blocking=False):
+            raise ServiceError('Too many renders are queued, try again shortly', status=503)
+        try:
+            formatted = self.formatted_data(query['input_folder'], query['group_by'], query['fps'])
+            job = self.jobs.get(query['job']) or {}
+            data = BehaviorTransitionData(
+                query['input_folder'],
+                self.__scratch_dir,
+                query['subject'],
+                query['environment'],
+                dict(job.get(const.COLOR_MAP) or {}),
+                query['group_by'],
+                edge_visibility_threshold=query['threshold'],
+                fps=query['fps'],
+                formatted_data=formatted
+            )
+            # Only the chain graphs are served (legends are attached or left out), one per hour for group_by=time
+            graphs = [graph for graph, _, cleanup in data.build_markov_chain_graphs(True if query['legend'] else None) if cleanup is False]
+            if not 1 <= query['hour'] <= len(graphs):
+                raise ServiceError(f'hour must be between 1 and {len(graphs)}')
+            return self.__render_pool.submit(graphs[query['hour'] - 1].pipe, format='svg', quiet=True).result()
+        finally:
+            self.__render_slots.release()
+
+
+# Counts and probabilities of one group as nested lists, rows and columns following the behaviors list
+def matrix_group(transition_df: pd.DataFrame, behavior_df: pd.DataFrame, behaviors: list[str]) -> dict:
+    index = pd.Index(behaviors)
+    counts = np.zeros((len(behaviors), len(behaviors)), dtype=np.int64)
+    np.add.at(
+        counts,
+        (index.get_indexer(transition_df[const.BEHAVIOR]), index.get_indexer(transition_df[const.BEHAVIOR_NEXT])),
+        transition_df['TRANSITION_COUNTS'].to_numpy(dtype=np.int64)
+    )
+    row_totals = counts.sum(axis=1, keepdims=True)
+    probabilities = np.divide(counts, row_totals, out=np.zeros(counts.shape), where=row_totals > 0)
+
+    behavior_counts = np.zeros(len(behaviors), dtype=np.int64)
+    np.add.at(behavior_counts, index.get_indexer(behavior_df[const.BEHAVIOR]), behavior_df['BEHAVIOR_COUNTS'].to_numpy(dtype=np.int64))
+    total = behavior_counts.sum()
+    return {
+        'transition_counts': counts.tolist(),
+        'transition_probabilities': probabilities.tolist(),
+        'behavior_counts': behavior_counts.tolist(),
+        'behavior_probabilities': (behavior_counts / total if total else np.zeros(len(behaviors))).tolist(),
+    }
+
+
+def make_request_handler(service: TransitionService) -> type[BaseHTTPRequestHandler]:
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            params = { key: values[-1] for key, values in parse_qs(url.query).items() }
+            try:
+                content_type, body = service.handle(url.path, params)
+                status = 200
+            except ServiceError as e:
+                content_type, body, status = 'application/json', json.dumps({ 'error': str(e) }).encode(), e.status
+            except Exception as e:
+                content_type, body, status = 'application/json', json.dumps({ 'error': f'{type(e).__name__}: {e}' }).encode(), 500
+
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return RequestHandler
+
+
+# Serves the config's jobs on localhost until interrupted with Ctrl+C
+def serve(jobs: list[dict], port: int = DEFAULT_PORT, render_workers: int | None = None, cache_size: int = DEFAULT_CACHE_SIZE):
+    service = TransitionService(jobs, render_workers, cache_size)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_request_handler(service))
+    print(f'Serving {len(service.jobs)} job(s) on http://127.0.0.1:{server.server_address[1]} (Ctrl+C to stop)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopped serving.')
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,112 @@
+import os
+import re
+import glob
+
+from utils import constants as const
+from utils.input_utils import list_data_files, is_packed_file
+from utils.manifest_utils import load_manifest
+
+# Splits a config's jobs across N independent runs (e.g. one per machine on a shared filesystem).
+# Every shard computes the same assignment on its own, so no coordinator is needed: jobs are ordered by
+# estimated cost and greedily given to the least loaded shard. Each shard keeps its own run manifest,
+# and the merge step combines them into the config's regular manifest once all shards are done.
+
+# Rough per-row processing cost, in bytes, added on top of a file's size
+ROW_COST_BYTES: int = 64
+# How much of each file is read to estimate its row count
+ROW_SAMPLE_BYTES: int = 1 << 16
+# Compressed files and archives can't be sampled for rows, they are assumed to expand to this many times their size
+# with rows about ROW_COST_BYTES long
+ASSUMED_COMPRESSION_RATIO: int = 4
+
+
+# Parses 'i/N' (1-based shard index) into (i, N)
+def parse_shard(value: str) -> tuple[int, int]:
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', value)
+    if match is None:
+        raise Exception(f'Invalid shard "{value}", expected the form i/N (e.g. 1/4)')
+    shard_idx, shard_count = int(match.group(1)), int(match.group(2))
+    if shard_count < 1 or not 1 <= shard_idx <= shard_count:
+        raise Exception(f'Invalid shard "{value}", i must be between 1 and N')
+    return (shard_idx, shard_count)
+
+
+def estimate_row_count(file_path: str) -> int:
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as file:
+        sample = file.read(ROW_SAMPLE_BYTES)
+    if len(sample) == 0:
+        return 0
+    return round(size * sample.count(b'\n') / len(sample))
+
+
+# Estimated cost of a job from its input bytes and (sampled) row counts
+def estimate_job_cost(job: dict) -> int:
+    input_folder = job.get(const.INPUT_FOLDER)
+    if input_folder is None or not os.path.isdir(input_folder):
+        return 0
+    cost = 0
+    for filename in list_data_files(input_folder):
+        file_path = os.path.join(input_folder, filename)
+        if is_packed_file(filename):
+            cost += 2 * os.path.getsize(file_path) * ASSUMED_COMPRESSION_RATIO
+        else:
+            cost += os.path.getsize(file_path) + estimate_row_count(file_path) * ROW_COST_BYTES
+    return cost
+
+
+# Returns the (0-based) shard each job belongs to, balancing the total cost of every shard
+# Ties are broken by job index and shard index so the result is the same on every machine
+def assign_shards(costs: list[int], shard_count: int) -> list[int]:
+    loads = [0] * shard_count
+    assignment = [0] * len(costs)
+    for job_idx in sorted(range(len(costs)), key=lambda idx: (-costs[idx], idx)):
+        shard = min(range(shard_count), key=lambda s: (loads[s], s))
+        assignment[job_idx] = shard
+        loads[shard] += costs[job_idx]
+    return assignment
+
+
+# Indices of the jobs that belong to shard i of N (1-based i)
+def jobs_for_shard(jobs: list[dict], shard_idx: int, shard_count: int) -> list[int]:
+    assignment = assign_shards([estimate_job_cost(job) for job in jobs], shard_count)
+    return [job_idx for job_idx, shard in enumerate(assignment) if shard == shard_idx - 1]
+
+
+def shard_manifest_path(manifest_path: str, shard_idx: int, shard_count: int) -> str:
+    base = manifest_path[:-len('.manifest.json')] if manifest_path.endswith('.manifest.json') else manifest_path
+    return f'{base}.shard-{shard_idx}-of-{shard_count}.manifest.json'
+
+
+def find_shard_manifests(manifest_path: str) -> list[str]:
+    base = manifest_path[:-len('.manifest.json')] if manifest_path.endswith('.manifest.json') else manifest_path
+    return sorted(glob.glob(f'{glob.escape(base)}.shard-*-of-*.manifest.json'))
+
+
+# Combines shard manifests into one. Jobs that no shard recorded fall back to base_jobs (e.g. the existing main manifest,
+# for jobs that were already up to date). Returns (manifest, problems) where problems lists anything that keeps the
+# merged result from covering every job, e.g. missing shards or shards run with different code
+def merge_manifests(shard_manifest_paths: list[str], expected_job_keys: list[str], base_jobs: dict | None = None) -> tuple[dict, list[str]]:
+    problems: list[str] = []
+    merged: dict = { 'code_version': None, 'jobs': {} }
+    shard_counts: set[int] = set()
+    for path in shard_manifest_paths:
+        match = re.search(r'\.shard-(\d+)-of-(\d+)\.manifest\.json$', path)
+        if match is not None:
+            shard_counts.add(int(match.group(2)))
+        manifest = load_manifest(path)
+        if merged['code_version'] is None:
+            merged['code_version'] = manifest.get('code_version')
+        elif manifest.get('code_version') != merged['code_version']:
+            problems.append(f'{path} was produced by a different code version')
+        merged['jobs'].update(manifest.get('jobs') or {})
+
+    if len(shard_counts) > 1:
+        problems.append(f'shard manifests from different shard counts were found: {sorted(shard_counts)}')
+    # Only keep the jobs that are still in the config
+    available = { **(base_jobs or {}), **merged['jobs'] }
+    merged['jobs'] = { key: available[key] for key in expected_job_keys if key in available }
+    missing_count = len(expected_job_keys) - len(merged['jobs'])
+    if missing_count:
+        problems.append(f'{missing_count} job(s) have no results in any shard manifest')
+    return (merged, problems)
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import os
+import sys
+import uuid
+from multiprocessing import shared_memory
+from typing import TYPE_CHECKING
+
+from utils.import_utils import lazy_import
+
+if TYPE_CHECKING:
+    import numpy as np
+else:
+    np = lazy_import('numpy')
+
+
+# Named numpy arrays that other processes can attach to without copying (or pickling) the data.
+# Arrays live either in multiprocessing.shared_memory blocks (default) or in .npy files that are memory mapped,
+# which also works across machines on a shared filesystem and survives the creating process.
+#
+# Owner side:
+#   shared = SharedArrays.create({ 'codes': codes, 'counts': np.zeros(...) })
+#   executor.submit(worker, shared.spec)  # the spec is a small picklable dict
+#   ...
+#   shared.release()
+# Worker side:
+#   shared = SharedArrays.attach(spec)
+#   shared.arrays['counts'][...] = ...  # writes are seen by the owner
+#   shared.close()
+#
+# Array specs are { name: (location, shape, dtype string) } where location is a shared memory block name
+# or a .npy file path depending on the backend
+SHARED_MEMORY: str = 'shm'
+NPY: str = 'npy'
+
+
+class SharedArrays:
+    def __init__(self, spec: dict, arrays: dict[str, np.ndarray], handles: list[shared_memory.SharedMemory], owner: bool):
+        self.spec = spec
+        self.arrays = arrays
+        self.__handles = handles
+        self.__owner = owner
+
+    # npy_dir is required for the NPY backend. Zero sized arrays are supported
+    @classmethod
+    def create(cls, arrays: dict[str, np.ndarray], backend: str = SHARED_MEMORY, npy_dir: str | None = None) -> 'SharedArrays':
+        spec: dict = { 'backend': backend, 'arrays': {} }
+        views: dict[str, np.ndarray] = {}
+        handles: list[shared_memory.SharedMemory] = []
+        if backend == NPY:
+            if npy_dir is None:
+                raise Exception('npy_dir is required for .npy backed shared arrays')
+            if not os.path.exists(npy_dir):
+                os.makedirs(npy_dir)
+
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            if backend == SHARED_MEMORY:
+                # Blocks can't be 0 bytes, so empty arrays get a 1 byte block that is never read
+                handle = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                handles.append(handle)
+                location = handle.name
+                view = np.ndarray(array.shape, dtype=array.dtype, buffer=handle.buf)
+                view[...] = array
+            elif backend == NPY and npy_dir is not None: # checked above, so this only narrows npy_dir
+                location = os.path.join(npy_dir, f'{name}-{uuid.uuid4().hex}.npy')
+                view = np.lib.format.open_memmap(location, mode='w+', dtype=array.dtype, shape=array.shape)
+                view[...] = array
+                view.flush()
+            else:
+                raise Exception(f'Unknown shared array backend: {backend}')
+            spec['arrays'][name] = (location, array.shape, array.dtype.str)
+            views[name] = view
+
+        return cls(spec, views, handles, owner=True)
+
+    @classmethod
+    def attach(cls, spec: dict, writable: bool = True) -> 'SharedArrays':
+        views: dict[str, np.ndarray] = {}
+        handles: list[shared_memory.SharedMemory] = []
+        for name, (location, shape, dtype) in spec['arrays'].items():
+            if spec['backend'] == NPY:
+                views[name] = np.load(location, mmap_mode='r+' if writable else 'r')
+                continue
+
+            handle = attach_shared_memory(location)
+            handles.append(handle)
+            view = np.ndarray(tuple(shape), dtype=np.dtype(dtype), buffer=handle.buf)
+            view.flags.writeable = writable
+            views[name] = view
+
+        return cls(spec, views, handles, owner=False)
+
+    # Drops this process' views of the arrays. Copy out anything that is still needed before calling this
+    def close(self):
+        for name, view in self.arrays.items():
+            if isinstance(view, np.memmap):
+                view.flush()
+        self.arrays = {}
+        for handle in self.__handles:
+            handle.close()
+
+    # Closes and frees the underlying memory/files. Only the creating side should call this
+    def release(self):
+        self.close()
+        if not self.__owner:
+            return
+        if self.spec['backend'] == NPY:
+            for location, _, _ in self.spec['arrays'].values():
+                if os.path.exists(location):
+                    os.remove(location)
+        for handle in self.__handles:
+            handle.unlink()
+        self.__handles = []
+
+    def __enter__(self) -> 'SharedArrays':
+        return self
+
+    def __exit__(self, *_):
+        self.release() if self.__owner else self.close()
+
+
+# Attaches to an existing block without tracking it in this process where possible (Python 3.13+)
+# On older versions tracking is harmless for pool workers, since they share the owning process' resource tracker
+# and the tracker only frees blocks that are still registered once every process using it has exited
+def attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import os
+import difflib
+import tempfile
+from typing import TYPE_CHECKING
+
+from utils import constants as const
+from utils.count_utils import format_data_shared
+from utils.helper_utils import BehaviorTransitionData, import_data_from_dir, format_data
+from utils.import_utils import lazy_import
+from utils.lag_utils import lag_sequential_table
+from utils.watch_utils import IncrementalFolderCounts
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+else:
+    np = lazy_import('numpy')
+    pd = lazy_import('pandas')
+
+# Equivalence checks of the optimized paths against the legacy ones, on real input folders or randomized scorelogs.
+# The legacy path is format_data (a pandas groupby per scorelog, pooled by pool_counts) and the chain graphs built from
+# its frames. Each check returns a list of divergences, empty when the outputs match:
+#   ingest        the concurrent import_data_from_dir against reading the files one at a time
+#   counts        the array based counting of count_utils (in process and, given an executor, through shared memory)
+#                 and IncrementalFolderCounts against format_data: the same rows, counts exactly equal, probabilities
+#                 and totals within tolerance
+#   graphs        the Graphviz (DOT) sources built from the optimized frames against those built from the legacy frames
+#   lags          the lag 1 counts of the lag sequential analysis against the legacy TRANSITION_COUNTS (not for
+#                 group_by=behavioral category, which the lag analysis doesn't group by)
+# Divergences name the offending behavior pairs, at most MAX_REPORTED per compared frame.
+
+DEFAULT_TOLERANCE: float = 1e-9
+MAX_REPORTED: int = 20
+GROUP_BY_OPTIONS: list[str] = [const.BASIC, const.TIME, const.BEHAVIORAL_CATEGORY]
+
+RANDOM_CATEGORIES: list[str] = ['Aggressive', 'Reproductive', 'Aversive']
+
+
+# Scorelogs with the columns of a BORIS export, using messy behavior names (case, spacing) like real ones and a few
+# OUT_OF_VIEW events, spread over `hours` hours. missing_times is the share of events without a time (which
+# group_by=time rejects)
+def random_scorelogs(
+    n_files: int = 5,
+    n_events: int = 500,
+    n_behaviors: int = 8,
+    hours: int = 3,
+    missing_times: float = 0.0,
+    seed: int = 0
+) -> dict[str, pd.DataFrame]:
+    rng = np.random.default_rng(seed)
+    names = [f'behavior {idx}' for idx in range(n_behaviors)] + ['Out of view']
+    spellings = [[name, name.upper(), f' {name.title()} '] for name in names]
+    categories = [RANDOM_CATEGORIES[idx % len(RANDOM_CATEGORIES)] for idx in range(len(names))]
+    df_map = {}
+    for file_idx in range(n_files):
+        size = int(rng.integers(max(n_events // 2, 1), n_events + 1))
+        codes = rng.choice(len(names), size=size, p=rng.dirichlet(np.ones(len(names))))
+        times = np.sort(rng.uniform(0, hours * 3600, size=size))
+        times[rng.random(size) < missing_times] = np.nan
+        df_map[f'scorelog{file_idx}'] = pd.DataFrame({
+            'Time': times,
+            'Behavior': [spellings[code][rng.integers(3)] for code in codes],
+            'Behavioral category': [categories[code] for code in codes],
+        })
+    return df_map
+
+
+def frame_keys(group_by: str) -> tuple[list[str], list[str]]:
+    group_column = { const.TIME: ['HOUR_PERFORMED'], const.BEHAVIORAL_CATEGORY: [const.BEHAVIORAL_CATEGORY] }.get(group_by, [])
+    return ([const.BEHAVIOR, const.BEHAVIOR_NEXT] + group_column, [const.BEHAVIOR] + group_column)
+
+
+def _describe(row, keys: list[str]) -> str:
+    description = ' -> '.join(str(row[key]) for key in keys if key in [const.BEHAVIOR, const.BEHAVIOR_NEXT])
+    groups = [f'{key} {row[key]}' for key in keys if key not in [const.BEHAVIOR, const.BEHAVIOR_NEXT]]
+    return f'{description} ({", ".join(groups)})' if groups else description
+
+
+def _capped(label: str, problems: list[str]) -> list[str]:
+    if len(problems) <= MAX_REPORTED:
+        return problems
+    return problems[:MAX_REPORTED] + [f'{label}: ... and {len(problems) - MAX_REPORTED} more']
+
+
+# Row by row comparison of a frame of the optimized path with the legacy one, in any row order
+# Columns ending in _COUNTS must match exactly, every other value column within tolerance
+def compare_frames(label: str, legacy_df: pd.DataFrame, candidate_df: pd.DataFrame, keys: list[str], tolerance: float = DEFAULT_TOLERANCE) -> list[str]:
+    problems = []
+    if set(legacy_df.columns) != set(candidate_df.columns):
+        problems.append(f'{label}: columns differ (legacy {sorted(legacy_df.columns)}, optimized {sorted(candidate_df.columns)})')
+    merged = legacy_df.merge(candidate_df, on=keys, how='outer', suffixes=('', '_OPTIMIZED'), indicator=True)
+    for _, row in merged[merged['_merge'] != 'both'].iterrows():
+        problems.append(f'{label}: {_describe(row, keys)} is only in the {"legacy" if row["_merge"] == "left_only" else "optimized"} output')
+
+    both = merged[merged['_merge'] == 'both'].reset_index(drop=True)
+    for column in [column for column in legacy_df.columns if column in candidate_df.columns and column not in keys]:
+        legacy_values = both[column].to_numpy(dtype=np.float64)
+        candidate_values = both[f'{column}_OPTIMIZED'].to_numpy(dtype=np.float64)
+        allowed = 0 if column.endswith('_COUNTS') else tolerance
+        differs = ~np.isclose(legacy_values, candidate_values, rtol=0, atol=allowed, equal_nan=True)
+        for idx in np.nonzero(differs)[0]:
+            problems.append(f'{label}: {column} of {_describe(both.iloc[idx], keys)} is {legacy_values[idx]} (legacy) but {candidate_values[idx]} (optimized)')
+    return _capped(label, problems)
+
+
+def compare_formatted(label: str, legacy: tuple[pd.DataFrame, pd.DataFrame], candidate: tuple[pd.DataFrame, pd.DataFrame], group_by: str, tolerance: float = DEFAULT_TOLERANCE) -> list[str]:
+    transition_keys, behavior_keys = frame_keys(group_by)
+    return compare_frames(f'{label} transitions', legacy[0], candidate[0], transition_keys, tolerance) \
+        + compare_frames(f'{label} behaviors', legacy[1], candidate[1], behavior_keys, tolerance)
+
+
+# The chain graph sources built from both frames, compared file by file. Nothing is rendered or written
+def compare_graph_sources(label: str, legacy: tuple[pd.DataFrame, pd.DataFrame], candidate: tuple[pd.DataFrame, pd.DataFrame], group_by: str, color_map: dict[str, str] | None = None) -> list[str]:
+    sources = []
+    for formatted_data in [legacy, candidate]:
+        data = BehaviorTransitionData('', tempfile.gettempdir(), 'Verify', 'Verify', dict(color_map or {}), group_by, formatted_data=formatted_data, use_cache=False)
+        sources.append({ os.path.basename(file_path): graph.source for graph, file_path, _ in data.build_markov_chain_graphs(False) })
+
+    problems = []
+    for name in sorted(set(sources[0]) | set(sources[1])):
+        legacy_source, candidate_source = sources[0].get(name), sources[1].get(name)
+        if legacy_source is None or candidate_source is None:
+            problems.append(f'{label} graphs: {name} is only built from the {"legacy" if candidate_source is None else "optimized"} data')
+            continue
+        # Diffed rather than compared line by line, so a missing edge is reported once instead of shifting every later line
+        legacy_lines, candidate_lines = legacy_source.splitlines(), candidate_source.splitlines()
+        for tag, legacy_start, legacy_stop, candidate_start, candidate_stop in difflib.SequenceMatcher(None, legacy_lines, candidate_lines, autojunk=False).get_opcodes():
+            if tag == 'equal':
+                continue
+            for line_idx in range(legacy_start, legacy_stop):
+                problems.append(f'{label} graphs: {name} line {line_idx + 1} {legacy_lines[line_idx].strip()!r} is only in the legacy source')
+            for line_idx in range(candidate_start, candidate_stop):
+                problems.append(f'{label} graphs: {name} line {line_idx + 1} {candidate_lines[line_idx].strip()!r} is only in the optimized source')
+    return _capped(f'{label} graphs', problems)
+
+
+# Non-zero lag 1 OBSERVED counts against the non-zero TRANSITION_COUNTS of the legacy transition_df
+def compare_lag_counts(label: str, df_map: dict[str, pd.DataFrame], legacy_transition_df: pd.DataFrame, group_by: str, fps: float | None = None) -> list[str]:
+    keys = frame_keys(group_by)[0]
+    lag_df = lag_sequential_table(df_map, 1, group_by, fps)
+    lag_df = lag_df.loc[lag_df['OBSERVED'] > 0].rename(columns={ 'OBSERVED': 'TRANSITION_COUNTS' }).loc[:, keys + ['TRANSITION_COUNTS']]
+    legacy_df = legacy_transition_df.loc[legacy_transition_df['TRANSITION_COUNTS'] > 0, keys + ['TRANSITION_COUNTS']]
+    if 'HOUR_PERFORMED' in keys:
+        lag_df = lag_df.astype({ 'HOUR_PERFORMED': 'int64' })
+        legacy_df = legacy_df.astype({ 'HOUR_PERFORMED': 'int64' })
+    return compare_frames(f'{label} lag 1 counts', legacy_df, lag_df, keys)
+
+
+# Every optimized counting path (and the graphs built from it) against format_data, for scorelogs already in memory
+def verify_scorelogs(
+    label: str,
+    df_map: dict[str, pd.DataFrame],
+    group_by: str = const.BASIC,
+    fps: float | None = None,
+    tolerance: float = DEFAULT_TOLERANCE,
+    executor=None,
+    graphs: bool = True,
+    color_map: dict[str, str] | None = None
+) -> list[str]:
+    legacy = format_data(df_map, group_by, fps)
+    candidates = { 'array counts': format_data_shared(df_map, group_by, fps) }
+    if executor is not None:
+        candidates['shared memory counts'] = format_data_shared(df_map, group_by, fps, executor)
+
+    problems = []
+    for name, candidate in candidates.items():
+        problems += compare_formatted(f'{label} {name}', legacy, candidate, group_by, tolerance)
+        if graphs:
+            problems += compare_graph_sources(f'{label} {name}', legacy, candidate, group_by, color_map)
+    if group_by != const.BEHAVIORAL_CATEGORY:
+        problems += compare_lag_counts(label, df_map, legacy[0], group_by, fps)
+    return problems
+
+
+# verify_scorelogs for an input folder, plus the concurrent ingestion and the incremental folder counts
+def verify_folder(
+    input_folder: str,
+    group_by: str = const.BASIC,
+    fps: float | None = None,
+    tolerance: float = DEFAULT_TOLERANCE,
+    executor=None,
+    graphs: bool = True,
+    color_map: dict[str, str] | None = None
+) -> list[str]:
+    label = f'{input_folder} ({group_by})'
+    sequential = import_data_from_dir(input_folder, max_workers=1, errors={})
+    concurrent = import_data_from_dir(input_folder, errors={})
+    problems = []
+    if list(sequential) != list(concurrent):
+        problems.append(f'{label} ingest: the concurrent reader returned {list(concurrent)} rather than {list(sequential)}')
+    for name in [name for name in sequential if name in concurrent]:
+        if not sequential[name].equals(concurrent[name]):
+            problems.append(f'{label} ingest: {name} was read differently by the concurrent reader')
+
+    problems += verify_scorelogs(label, sequential, group_by, fps, tolerance, executor, graphs, color_map)
+    incremental = IncrementalFolderCounts(input_folder, group_by, fps).update()
+    problems += compare_formatted(f'{label} incremental counts', format_data(sequential, group_by, fps), incremental[:2], group_by, tolerance)
+    return problems
+
+
+# verify_scorelogs on randomized scorelogs, for every seed and group_by option
+def verify_random(seeds: list[int], tolerance: float = DEFAULT_TOLERANCE, executor=None, graphs: bool = True) -> list[str]:
+    problems = []
+    for seed in seeds:
+        for group_by in GROUP_BY_OPTIONS:
+            df_map = random_scorelogs(missing_times=0.0 if group_by == const.TIME else 0.01, seed=seed)
+            problems += verify_scorelogs(f'random scorelogs (seed {seed}, {group_by})', df_map, group_by, None, tolerance, executor, graphs)
+    return problems
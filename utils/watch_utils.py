@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import os
+import time
+from typing import TYPE_CHECKING
+
+from utils.helper_utils import list_data_files, read_data_source, count_scorelog, pool_counts
+from utils.import_utils import lazy_import
+
+if TYPE_CHECKING:
+    import pandas as pd
+else:
+    pd = lazy_import('pandas')
+
+# Support for main.py --watch: polling based change detection (no extra dependencies, and works on network shares
+# where file system events are unreliable) plus per-file count caching so that only new or changed scorelogs are
+# re-read and re-counted when a folder changes.
+
+
+# Snapshot of a path used to detect changes: (size, mtime) of a file, or of every data file in a folder
+def path_snapshot(path: str) -> object:
+    try:
+        if os.path.isdir(path):
+            snapshot = {}
+            for filename in list_data_files(path):
+                stat = os.stat(os.path.join(path, filename))
+                snapshot[filename] = (stat.st_size, stat.st_mtime_ns)
+            return snapshot
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+
+class PollingWatcher:
+    def __init__(self, paths: list[str], poll_interval: float = 1.0, debounce: float = 1.0):
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.snapshots: dict[str, object] = {}
+        self.set_paths(paths)
+
+    # Paths that are new to the watcher start from their current state
+    def set_paths(self, paths: list[str]):
+        self.snapshots = { path: self.snapshots[path] if path in self.snapshots else path_snapshot(path) for path in paths }
+
+    def __poll(self) -> set[str]:
+        changed = set()
+        for path, snapshot in self.snapshots.items():
+            current = path_snapshot(path)
+            if current != snapshot:
+                self.snapshots[path] = current
+                changed.add(path)
+        return changed
+
+    # Blocks until something changes, then keeps collecting changes until none have happened for `debounce` seconds,
+    # so a burst of writes (e.g. several scorelogs being copied in) is handled as one update
+    def wait_for_changes(self) -> set[str]:
+        changed: set[str] = set()
+        while len(changed) == 0:
+            time.sleep(self.poll_interval)
+            changed |= self.__poll()
+
+        quiet_since = time.monotonic()
+        while time.monotonic() - quiet_since < self.debounce:
+            time.sleep(min(self.poll_interval, self.debounce))
+            new_changes = self.__poll()
+            if len(new_changes):
+                changed |= new_changes
+                quiet_since = time.monotonic()
+        return changed
+
+
+# Keeps count_scorelog results for every file in a folder (every scorelog inside it, for archives), keyed by the file's size and mtime
+# update() only re-reads files that were added or changed since the last call, then re-pools the counts
+class IncrementalFolderCounts:
+    def __init__(self, dir_path: str, group_by: str = '', fps: float | None = None):
+        self.dir_path = dir_path
+        self.group_by = group_by
+        self.fps = fps
+        self.file_counts: dict[str, tuple[tuple[int, int], list[tuple[pd.DataFrame, pd.DataFrame]]]] = {}
+        self.file_errors: dict[str, dict[str, str]] = {}
+        self.__pooled: tuple[pd.DataFrame, pd.DataFrame] | None = None
+
+    # Files (or archive members) that could not be read, file name -> message
+    @property
+    def errors(self) -> dict[str, str]:
+        return { name: message for errors in self.file_errors.values() for name, message in errors.items() }
+
+    # Returns the pooled (transition_df, behavior_df) and the names of the files that had to be re-counted
+    def update(self) -> tuple[pd.DataFrame, pd.DataFrame, list[str]]:
+        recounted: list[str] = []
+        filenames = list_data_files(self.dir_path)
+        for filename in list(filenames):
+            file_path = os.path.join(self.dir_path, filename)
+            try:
+                stat = os.stat(file_path)
+                signature = (stat.st_size, stat.st_mtime_ns)
+                cached = self.file_counts.get(filename)
+                if cached is not None and cached[0] == signature:
+                    continue
+
+                recounted.append(filename)
+                frames, member_errors = read_data_source(file_path)
+                counts = [count_scorelog(sub_df, self.group_by, self.fps) for sub_df in frames.values()]
+                self.file_counts[filename] = (signature, counts)
+                self.file_errors[filename] = member_errors
+            except FileNotFoundError:
+                # Deleted since the folder was listed, so it is dropped below like any other removed file
+                filenames.remove(filename)
+            except Exception as e:
+                # A scorelog that is still being written may fail to parse, it is picked up again once it changes
+                self.file_counts.pop(filename, None)
+                self.file_errors[filename] = { filename: f'{type(e).__name__}: {e}' }
+
+        for filename in set(self.file_counts) - set(filenames):
+            del self.file_counts[filename]
+            if filename not in recounted:
+                recounted.append(filename)
+        for filename in set(self.file_errors) - set(filenames):
+            del self.file_errors[filename]
+
+        # Pooling is skipped when nothing changed, callers share the returned frames so treat them as read-only
+        if len(recounted) == 0 and self.__pooled is not None:
+            return (self.__pooled[0], self.__pooled[1], recounted)
+        ordered = [counts for filename in filenames if filename in self.file_counts for counts in self.file_counts[filename][1]]
+        transition_df, behavior_df = pool_counts([counts[0] for counts in ordered], [counts[1] for counts in ordered], self.group_by)
+        self.__pooled = (transition_df, behavior_df)
+        return (transition_df, behavior_df, recounted)